@@ -10,66 +10,16 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
+from collections import Counter
+from itertools import islice
+
 import file_utils as fu
 import utils as u
+import statements as st
+import backends
+from fragments import KNOWN_GENE_INDICES, collapseGeneNames, collapseRefSeq
 
-indicesKnownGenes=[12, 1, 3] #12 for gene
-
-def collapseGeneNames(row, indices, region, cnt):
-    names = ['bin', 'name', 'chrom', 'transcriptStrand', 'txStart', 'txEnd', 
-        'cdsStart', 'cdsEnd', 'exonCount', 'exonStarts', 'exonEnds', 'score',
-        'name2', 'cdsStartStat', 'cdsEndStat', 'exonFrames']
-    collapsed=[]
-    for i in indices:
-        mn = names[i]
-        r = str(row[i])
-        if(len(r) > 0 ):
-            collapsed.append(mn + '=' + r.strip())
-    collapsed.append(region)
-
-    return  ';'.join(collapsed)
-
-
-""""Collapces bigRefSegTable
-"""
-def collapseRefSeq(line):
-    names = ['chr', 'start', 'end', 'haplotypeReference', 
-        'haplotypeAlternate', 'name', 'name2', 'transcriptStrand', 
-        'positionType', 'frame', 'mrnaCoord', 'codonCoord', 'spliceDist',
-        'referenceCodon', 'referenceAA', 'variantCodon', 'variantAA',
-        'changesAA', 'functionalClass','codingCoordStr','proteinCoordStr',
-        'inCodingRegion', 'spliceInfo','uorfChange']
-    fields = line.strip().split('\t')
-    fcount = 0
-    collapsed = []
-
-    for f in fields:
-        if (fcount > 4):
-            if(len(str(f)) > 0 and str(f) !='0'):
-                collapsed.append(str(names[fcount]).strip() + '=' + str(f).strip())
-        fcount = fcount + 1
-
-    return  ';'.join(collapsed)
-
-
-def binarySearchUniqueAndSorted(arg0, key):
-    low = 0;
-    high = len(arg0) - 1
-    mid = 0;
-    obj = 0;
-
-    while (low <= high):
-        mid = (low + high) / 2
-        obj = arg0[mid]
-
-        if (obj < key):
-            low = mid + 1;
-        elif (obj > key):
-            high = mid - 1;
-        else:
-            return mid;
-
-    return -1 # NOT_FOUND
+indicesKnownGenes = KNOWN_GENE_INDICES #12 for gene
 
 
 """Cleans characters not accepted by MySQL
@@ -107,1297 +57,1033 @@ def getComplementary(nuc):
         return compNuc
 
 
-""""Format must be pileup or vcf
-    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
-""" 
-def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
-    varclass='SNV', sep='\t'):
-    
-    outfile = vcf + tmpextout
-    fh_out = open(outfile, "w")
-    logcountfile = vcf + '.count.log'
-    fh_log = open(logcountfile, 'w')
-    var_count = 0
+# Leading columns of a record the stages read or write (CHROM to INFO)
+RECORD_COLUMNS = 8
 
-    inds = getFormatSpecificIndices(format=format)
+# Chromosome ids: 1..22, then X, Y, M and MT; any other name gets the next
+# free id the first time this process sees it
+CHROM_X = 23
+CHROM_Y = 24
+CHROM_M = 25
+CHROM_MT = 26
+chromIds = dict([(str(c), c) for c in range(1, 23)] + [('X', CHROM_X),
+    ('Y', CHROM_Y), ('M', CHROM_M), ('MT', CHROM_MT)])
 
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+# 2-bit allele codes; the complement of code c is 3 - c
+ALLELE_CODES = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
+COMPLEMENTS = 'TGCA'
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql = 'select * from dbSNP where CHR="' + str(chr) + \
-                '" AND POS=' + str(pos) + ' AND ( REF="' + str(ref) + \
-                '" OR REF ="' + str(compRef) + '" )  AND INFO = "' + \
-                varclass + '" ;'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
 
-            fields[2] = '.'
-            rsids = []
-            mafs = []
-            if (len(rows) > 0):
-                for row in rows:
-                    rsids.append(str(row[3]))
-                    if (str(row[7]) != '.'):
-                        mafs.append('GMAF=' + str(row[7]))
+"""Id of a chromosome named without 'chr'
+"""
+def chromId(bare):
+    cid = chromIds.get(bare)
+    if cid is None:
+        cid = chromIds.setdefault(bare, len(chromIds) + 1)
+    return cid
 
-                maf_str=''
-                if (len(mafs) > 0):
-                    maf_str = ';' + ';'.join([str(x) for x in mafs])
 
-                var_count = var_count + 1
-                if (str(fields[7]) == '.'):
-                    fields[7] = 'DB' + maf_str
-                else:
-                    fields[7] = fields[7] + ';DB;VC=' + varclass + maf_str
+"""Chromosome and position packed into one int64 sort key (positions
+   below 2**32)
+"""
+def packKey(cid, pos):
+    return (cid << 32) | pos
 
-                fields[2] = str(';'.join(rsids))
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
 
-            else:
-                ## reset rsid to "." - in case there was annotation from old release of dbSNP
-                fh_out.write('\t'.join([str(x) for x in fields]) + '\n')
+"""Complement of an allele code, as getComplementary gives it
+"""
+def complementOf(code):
+    return COMPLEMENTS[code] if (code >= 0) else ''
 
-            linenum = linenum + 1
 
+"""INFO of a record as the stages build it up
+   Holds INFO as read and every piece the stages append, and joins them
+   only when the text is needed (str(), normally once, when the record is
+   written), so a heavily annotated variant doesn't copy its INFO over and
+   over. Entries are parsed on first lookup into an ordered list of
+   key/value pairs.
+"""
+class Info(object):
+    __slots__ = ('parts', 'entries')
+
+    def __init__(self, text):
+        self.parts = [text]
+        self.entries = None
+
+    def __str__(self):
+        if len(self.parts) > 1:
+            self.parts = [''.join(self.parts)]
+        return self.parts[0]
+
+    def startswith(self, prefix):
+        head = ''
+        for part in self.parts:
+            head = head + part
+            if len(head) >= len(prefix):
+                break
+        return head.startswith(prefix)
+
+    def endswith(self, suffix):
+        tail = ''
+        for part in reversed(self.parts):
+            tail = part + tail
+            if len(tail) >= len(suffix):
+                break
+        return tail.endswith(suffix)
+
+    """Appends text as it is; it carries its own separator
+    """
+    def append(self, text):
+        self.parts.append(text)
+        self.entries = None
+
+    """Appends a fragment, with a separator unless INFO already ends with
+       one
+    """
+    def add(self, fragment):
+        self.append(fragment if self.endswith(';') else (';' + fragment))
+
+    """Value of the first entry whose key contains key, or '.'
+       Keys are matched on INFO cleaned of quotes, as u.parse_field does
+    """
+    def value(self, key):
+        if self.entries is None:
+            self.entries = [entry.split('=') for entry in
+                clean_mysql_chars(str(self)).strip().split(';')]
+        for entry in self.entries:
+            if entry[0].find(key) > -1:
+                return entry[1]
+        return '.'
+
+
+"""A record whose first RECORD_COLUMNS columns are split into fields
+   Anything after INFO (FORMAT and the sample columns) is kept as the one
+   string rest, never split, and written back as it was read. INFO is
+   held as an Info. Indexing, assignment, slicing, len() and iteration
+   work on the leading fields, as on a list.
+   The keys the stages look up by are worked out once, here: chrom as
+   the UCSC tables spell it ('chr1') and chromBare without 'chr', their
+   chromId, pos (an int, or the text if it isn't a number), key (chromId
+   and pos packed by packKey, or None), ref and alt cleaned of quotes,
+   and their 2-bit allele codes (-1 for anything but A, C, G and T)
+   segment holds (segments, set id) of pos in a bundle segmentation once
+   a segmented lookup has resolved it (see reference.SegmentedRangeTable);
+   a one-item list, so the record's probes share it
+"""
+class Record(object):
+    __slots__ = ('fields', 'rest', 'chrom', 'chromBare', 'chromId', 'pos',
+        'key', 'ref', 'alt', 'refCode', 'altCode', 'segment')
+
+    def __init__(self, line, sep='\t', inds=None):
+        fields = line.split(sep, RECORD_COLUMNS)
+        self.rest = fields.pop() if (len(fields) > RECORD_COLUMNS) else None
+        if len(fields) > 7:
+            fields[7] = Info(fields[7])
+        self.fields = fields
+
+        inds = inds or getFormatSpecificIndices()
+        chr = fields[inds[0]].strip()
+        if chr.startswith("chr"):
+            self.chrom = chr
+            self.chromBare = chr.replace('chr', '')
         else:
-            fh_out.write(line + '\n')
-
-    ratioInDbSnp = (var_count / float(linenum)) * 100
-    fh_log.write("## Please notice that all Isoforms were counted\n")
-    fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
-    fh_log.write(f"Total: {str(linenum)}\n")
-    fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
-
-
-"""NOTE: all isoforms are collapsed in one record
-    1. chrom_pos_equal_base
-    2. chrom_pos_equal_nobase
-    3. chrom_pos_unequal
+            self.chrom = "chr" + chr
+            self.chromBare = chr
+        self.chromId = chromId(self.chromBare)
+
+        self.pos = fields[inds[1]].strip() if (len(fields) > inds[1]) \
+            else None
+        self.key = None
+        try:
+            self.pos = int(self.pos)
+            if (0 <= self.pos and self.pos < (1 << 32)):
+                self.key = packKey(self.chromId, self.pos)
+        except (TypeError, ValueError):
+            pass
+
+        self.ref = clean_mysql_chars(fields[inds[2]]).strip() \
+            if (len(fields) > inds[2]) else ''
+        self.alt = clean_mysql_chars(fields[inds[3]]).strip() \
+            if (len(fields) > inds[3]) else ''
+        self.refCode = ALLELE_CODES.get(self.ref, -1)
+        self.altCode = ALLELE_CODES.get(self.alt, -1)
+        self.segment = [None]
+
+    """Copy of the record with INFO replaced by info and nothing after it,
+       for running stages on the side
+    """
+    def probe(self, info):
+        record = Record.__new__(Record)
+        for name in Record.__slots__:
+            setattr(record, name, getattr(self, name))
+        record.fields = self.fields[:7] + [info]
+        record.rest = None
+        return record
+
+    def __getitem__(self, i):
+        return self.fields[i]
+
+    def __setitem__(self, i, value):
+        self.fields[i] = value
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def write(self, fh, sep='\t'):
+        fh.write(sep.join([str(field) for field in self.fields]))
+        if self.rest is not None:
+            fh.write(sep)
+            fh.write(self.rest)
+        fh.write('\n')
+
+
+"""Reads a VCF once, passing header lines straight to the output and
+   yielding every record as a Record
 """
-def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
+def readRecords(fh, fh_out, sep='\t', format='vcf'):
     inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    vcf_linenum = 1
-
     for line in fh:
         line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
+        if (line.startswith('#') or line.startswith('CHROM')):
+            fh_out.write(line + '\n')
+        else:
+            yield Record(line, sep, inds)
 
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
 
-            sql1 = 'select * from chrom_pos_equal_base where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + \
-                ' AND ((haplotypeReference="' + str(ref) + \
-                '" AND haplotypeAlternate ="' + str(alt) + \
-                '") OR (haplotypeReference="' + str(compRef) + \
-                '" AND haplotypeAlternate ="' + str(compAlt) + '"));'
+"""Writes records coming out of the last stage
+"""
+def writeRecords(records, fh_out, sep='\t'):
+    for fields in records:
+        fields.write(fh_out, sep)
 
-            sql2 = 'select * from chrom_pos_equal_nobase where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + ';'
 
-            sql3 = 'select * from chrom_pos_unequal where CHR="' + \
-                str(chr) + '" AND start <= ' + str(pos) + ' AND ' + \
-                str(pos) + ' <= end ;'
+"""Groups records into lists of up to size records
+"""
+def chunks(records, size):
+    records = iter(records)
+    block = list(islice(records, size))
+    while block:
+        yield block
+        block = list(islice(records, size))
+
+
+"""Keys of every record of a file for a server-side join (see
+   reference.LOOKUP_JOIN): (line, chrom as 'chr1', chrom as '1', pos, ref,
+   alt, complement of ref, complement of alt), with ref and alt cleaned as
+   the stages clean them. line counts records, not headers; records whose
+   position isn't a number are left out, the stages look those up one by
+   one
+"""
+def variantKeys(infile, format='vcf', sep='\t'):
+    inds = getFormatSpecificIndices(format=format)
+    fh = open(infile)
+    line = -1
+    for text in fh:
+        text = text.strip()
+        if (text.startswith('#') or text.startswith('CHROM')):
+            continue
+        record = Record(text, sep, inds)
+        line = line + 1
+        if not isinstance(record.pos, int):
+            continue
+        yield (line, record.chrom, record.chromBare, record.pos, record.ref,
+            record.alt, complementOf(record.refCode),
+            complementOf(record.altCode))
+    fh.close()
 
-            keep_going = True
-            cursor.execute(sql1)
-            rows = cursor.fetchall()
 
-            if (len(rows) > 0):
-                keep_going = False
-                m = set([])
-                for row in rows:
-                    m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)] ])))
+"""Passes records through unchanged, but lets a batched table (one with a
+   prefetch method, see reference.LOOKUP_BATCH) fetch the rows for each
+   batch first: one prefetch per chromosome in the batch, with the
+   positions on it, after newBlock() if the table keeps rows per block.
+   Batches follow the table's adaptive batch size.
+   A table with a resolve method (reference.LOOKUP_SEGMENTS) instead gets
+   each block of records to resolve, and then the record every lookup is
+   for, as table.record.
+   chromOf(fields, inds) gives the chromosome the stage queries with, or
+   None; by default the record's chrom
+"""
+def prefetched(records, table, inds, chromOf=None):
+    if hasattr(table, 'resolve'):
+        for block in chunks(records, table.block_size):
+            table.resolve(block)
+            for fields in block:
+                table.record = fields
+                yield fields
+        table.record = None
+        return
+
+    if not hasattr(table, 'prefetch'):
+        for fields in records:
+            yield fields
+        return
+
+    records = iter(records)
+    block = list(islice(records, table.batch.size))
+    while block:
+        byChrom = {}
+        for fields in block:
+            chrom = fields.chrom if (chromOf is None) else \
+                chromOf(fields, inds)
+            if chrom is not None:
+                byChrom.setdefault(chrom, []).append(fields.pos)
+        if hasattr(table, 'newBlock'):
+            table.newBlock()
+        for chrom, positions in byChrom.items():
+            table.prefetch(chrom, positions)
+        for fields in block:
+            yield fields
+        block = list(islice(records, table.batch.size))
+
+
+"""Runs a single stage over a whole file; used by the stand-alone annotators
+"""
+def runStageOnFile(infile, outfile, stage, sep='\t', format='vcf'):
+    fh = open(infile)
+    fh_out = open(outfile, "w")
+    writeRecords(stage(readRecords(fh, fh_out, sep=sep, format=format)),
+        fh_out, sep=sep)
+    fh.close()
+    fh_out.close()
 
-                fields[7] = fields[7] + ';' + ';'.join(m)
-                if (str(fields[7]).startswith(".;")):
-                    fields[7] = str(fields[7]).replace('.;', '', 1)
 
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
+"""Appends a fragment to INFO, unless INFO already ends with a separator
+"""
+def appendInfo(fields, fragment):
+    fields[7].add(fragment)
+
+
+"""Runs stages that only append to INFO side by side on each block of
+   records
+   stages are callables taking and returning an iterable of records (a
+   stage with its reference handle and counters bound). Each stage runs in
+   executor on copies of the block whose INFO is just ';', which leaves
+   exactly what the stage appended: a fragment added by appendInfo, or
+   one starting with ';' if the stage always adds its own separator. The
+   fragments are then applied in stage order, so INFO reads the same as if
+   the stages had run one after another.
+"""
+def concurrentStages(records, stages, executor, block_size=1000):
+    def fragments(stage, block):
+        probes = [fields.probe(Info(';')) for fields in block]
+        return [str(fields[7])[1:] for fields in stage(iter(probes))]
+
+    for block in chunks(records, block_size):
+        futures = [executor.submit(fragments, stage, block)
+            for stage in stages]
+        for future in futures:
+            for fields, fragment in zip(block, future.result()):
+                if fragment.startswith(';'):
+                    fields[7].append(fragment)
+                elif fragment:
+                    appendInfo(fields, fragment)
+        for fields in block:
+            yield fields
 
-            if (keep_going):
-                cursor.execute(sql2)
-                rows = cursor.fetchall()
 
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
+""""Format must be pileup or vcf
+    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+    Records are looked up block_size at a time, one dbSNP call per
+    chromosome in the block
+"""
+def dbSnpStage(records, refdb, counts, format='vcf', varclass='SNV',
+    block_size=10000):
+
+    snps = refdb.dbSnpTable(varclass=varclass)
+
+    for block in chunks(records, block_size):
+        byChrom = {}
+        for i, fields in enumerate(block):
+            byChrom.setdefault(fields.chromBare, []).append((i, fields.pos,
+                fields.ref, complementOf(fields.refCode)))
+
+        matches = [None] * len(block)
+        for chr, variants in byChrom.items():
+            indices, positions, refs, compRefs = zip(*variants)
+            for i, rows in zip(indices, snps.lookupBlock(chr, positions,
+                refs, compRefs)):
+                matches[i] = rows
+
+        for fields, rows in zip(block, matches):
+            ## reset rsid to "." - in case there was annotation from old release of dbSNP
+            fields[2] = '.'
+            if (len(rows) > 0):
+                rsids = []
+                mafs = []
+                for rsid, gmaf in rows:
+                    rsids.append(rsid)
+                    if (gmaf != '.'):
+                        mafs.append('GMAF=' + gmaf)
+
+                maf_str = ''
+                if (len(mafs) > 0):
+                    maf_str = ';' + ';'.join(mafs)
 
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
-                    
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
+                counts['var_count'] += 1
+                if (str(fields[7]) == '.'):
+                    fields[7] = Info('DB' + maf_str)
+                else:
+                    fields[7].append(';DB;VC=' + varclass + maf_str)
 
-            if (keep_going):
-                cursor.execute(sql3)
-                rows = cursor.fetchall()
+                fields[2] = ';'.join(rsids)
 
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
+            counts['linenum'] += 1
+            yield fields
 
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
 
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
+def writeDbSnpLog(fh_log, counts):
+    # Total has always been reported one above the number of variants
+    linenum = counts['linenum'] + 1
+    ratioInDbSnp = (counts['var_count'] / float(linenum)) * 100
+    fh_log.write("## Please notice that all Isoforms were counted\n")
+    fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
+    fh_log.write(f"Total: {str(linenum)}\n")
+    fh_log.write(f"In dbSNP: {str(counts['var_count'])} ({str(ratioInDbSnp)}%)\n")
 
-            if (keep_going):
-                fh_out.write(line + '\n')
 
-            vcf_linenum = vcf_linenum + 1
+def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
+    varclass='SNV', sep='\t'):
 
-        else:
-            fh_out.write(line + '\n')
+    counts = Counter()
+    refdb = backends.configured().reference()
+    runStageOnFile(vcf + tmpextin, vcf + tmpextout,
+        lambda records: dbSnpStage(records, refdb, counts, format=format,
+            varclass=varclass), sep=sep, format=format)
+    refdb.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    fh_log = open(vcf + '.count.log', 'w')
+    writeDbSnpLog(fh_log, counts)
+    fh_log.close()
 
 
-"""Get information about location in gene structures
+"""NOTE: all isoforms are collapsed in one record
+    1. chrom_pos_equal_base
+    2. chrom_pos_equal_nobase
+    3. chrom_pos_unequal
+    Records are resolved block_size at a time, one resolver call per
+    chromosome in the block
 """
-def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
-
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '" AND (txStart - ' + str(promoter_offset) +') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
-
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
-
+def bigRefGeneStage(records, refdb, counts, format='vcf', block_size=10000):
+    resolver = refdb.refSeqResolver()
+
+    for block in chunks(records, block_size):
+        byChrom = {}
+        for i, fields in enumerate(block):
+            byChrom.setdefault(fields.chromBare, []).append(
+                (i, (fields.pos, fields.ref, fields.alt,
+                complementOf(fields.refCode), complementOf(fields.altCode))))
+
+        matches = [None] * len(block)
+        for chr, variants in byChrom.items():
+            indices, probes = zip(*variants)
+            for i, rows in zip(indices, resolver.resolveBlock(chr, probes)):
+                matches[i] = rows
+
+        for fields, rows in zip(block, matches):
+            # The first table with a match wins; rows come as their
+            # fragments.refSeq annotations
             if (len(rows) > 0):
-                cnt = 1
-                for row in rows:
-                    #count location
-                    positionType = str(u.parse_field(info_field, 
-                        'positionType', ';', '='))
-                    
-                    if (positionType == 'intron'):
-                        intronic_count = intronic_count + 1
-                    elif (positionType == 'non_coding_intron'):
-                        non_coding_intronic_count = non_coding_intronic_count + 1
-                    elif (positionType == 'CDS'):
-                        cds_count = cds_count + 1
-                    elif (positionType == 'non_coding_exon'):
-                        non_coding_exonic_count = non_coding_exonic_count + 1
-                    elif (positionType == 'utr5'):
-                        utr5_count = utr5_count + 1
-                    elif (positionType == 'utr3'):
-                        utr3_count = utr3_count + 1
-
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
-
-                    if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
-                    elif (u.isBetween(pos, cdsStart, cdsEnd)):
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("exon=" +  "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count = exonic_count + 1
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
-
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and 
-                        (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-
-                        rows = cursor.fetchone()
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' +  \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
+                m = set(rows)
 
-                    else:
-                        region = ''
+                fields[7].append(';' + ';'.join(m))
+                if fields[7].startswith(".;"):
+                    fields[7] = Info(str(fields[7]).replace('.;', '', 1))
 
-                    if (region != ''):
-                        info.append(collapseGeneNames(row=row, 
-                            indices=indicesKnownGenes, region=region, cnt=cnt))
+            yield fields
 
-                    cnt = cnt + 1
 
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
+def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
+    refdb = backends.configured().reference()
+    runStageOnFile(vcf + tmpextin, vcf + tmpextout,
+        lambda records: bigRefGeneStage(records, refdb, Counter(),
+            format=format), sep=sep, format=format)
+    refdb.close()
 
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
-                interGenic_count = interGenic_count + 1
 
-            linenum = linenum + 1
+"""First CpG island (in table order) covering pos, or None
+   Islands are looked up once per position; memo remembers the answer
+"""
+def cpgIslandAt(islands, memo, chr, pos):
+    key = (chr, pos)
+    if key not in memo:
+        rows = islands.overlapping(chr, pos)
+        memo[key] = rows[0] if (len(rows) > 0) else None
+    return memo[key]
 
-        else:
-            fh_out.write(line + '\n')
 
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
+"""Get information about location in gene structures
+"""
+def genesStage(records, refdb, counts, format='vcf', table='refGene',
+    promoter_offset=500):
 
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
+    inds = getFormatSpecificIndices(format=format)
+    transcripts = refdb.transcriptTable(table, promoter_offset)
+    islands = refdb.rangeTable('cpgIslandExt',
+        columns=st.stageColumns('cpgIslandExt'), preload=True)
+    islandsAt = {}
+
+    for fields in prefetched(records, transcripts, inds):
+        chr = fields.chrom
+        pos = fields.pos
+
+        txs = transcripts.overlapping(chr, pos)
+        info = []
+
+        if (len(txs) > 0):
+            #count location
+            positionType = str(fields[7].value('positionType'))
+
+            for tx in txs:
+                if (positionType == 'intron'):
+                    counts['intronic_count'] += 1
+                elif (positionType == 'non_coding_intron'):
+                    counts['non_coding_intronic_count'] += 1
+                elif (positionType == 'CDS'):
+                    counts['cds_count'] += 1
+                elif (positionType == 'non_coding_exon'):
+                    counts['non_coding_exonic_count'] += 1
+                elif (positionType == 'utr5'):
+                    counts['utr5_count'] += 1
+                elif (positionType == 'utr3'):
+                    counts['utr3_count'] += 1
+
+                txtStart = tx.txStart
+                txtEnd = tx.txEnd
+                cdsStart = tx.cdsStart
+                cdsEnd = tx.cdsEnd
+                strand = tx.strand
+
+                promoter_plus = txtStart - int(promoter_offset)
+                promoter_minus = txtEnd + int(promoter_offset)
+                region = ""
+                pos = int(pos)
+                exons = []
+
+                if (cdsStart == cdsEnd):
+                    for e in tx.exonsAt(pos):
+                        exons.append("non_coding_exon=" + tx.labels[e])
+                    if (len(exons) > 0):
+                        region = ";".join(exons)
+                elif (u.isBetween(pos, cdsStart, cdsEnd)):
+                    for e in tx.exonsAt(pos):
+                        exons.append("exon=" + tx.labels[e])
+                        counts['exonic_count'] += 1
+                    if (len(exons) > 0):
+                        region = ";".join(exons)
+
+                elif (u.isBetween(pos, promoter_plus, txtStart) and
+                    (strand == "+")):
+                    island = cpgIslandAt(islands, islandsAt, chr, pos)
+
+                    if (island is not None):
+                        region = 'putativePromoterRegion=' + \
+                            "".join(str(island[0]).split())
+                        counts['promoter_count'] += 1
+
+                elif (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
+                    island = cpgIslandAt(islands, islandsAt, chr, pos)
+                    if (island is not None):
+                        region = 'putativePromoterRegion=' +  \
+                            "".join(str(island[0]).split())
+                        counts['promoter_count'] += 1
+
+                if (region != ''):
+                    info.append(tx.geneAnnotation(region))
+
+            fields[7].append(';' + ";".join(info))
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
+        else:
+            fields[7].append(";positionType=interGenic")
+            counts['interGenic_count'] += 1
 
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
+        yield fields
 
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic {str(intronic_count)}\n")
+def writeGenesLog(fh_log, counts):
+    lines = ["Variants located:",
+        f"In interGenic {str(counts['interGenic_count'])}",
+        f"In CDS {str(counts['cds_count'])}",
+        f"In \'3 UTR {str(counts['utr3_count'])}",
+        f"In \'5 UTR {str(counts['utr5_count'])}",
+        f"In Intronic {str(counts['intronic_count'])}",
+        f"In Non_coding_intronic {str(counts['non_coding_intronic_count'])}",
+        f"In Exonic {str(counts['exonic_count'])}",
+        f"In Non_coding_exonic {str(counts['non_coding_exonic_count'])}",
+        f"In Putative Promoter Region {str(counts['promoter_count'])}"]
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
+    for line in lines:
+        print(line)
+        fh_log.write(line + '\n')
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
+def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
+    tmpextin='.2', tmpextout='.3', sep='\t'):
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
+    counts = Counter()
+    refdb = backends.configured().reference()
+    runStageOnFile(vcf + tmpextin, vcf + tmpextout,
+        lambda records: genesStage(records, refdb, counts, format=format,
+            table=table, promoter_offset=promoter_offset), sep=sep,
+        format=format)
+    refdb.close()
 
-    fh_out.close()
+    fh_log = open(vcf + '.count.log', 'a')
+    writeGenesLog(fh_log, counts)
     fh_log.close()
-    fh.close()
-    conn.close()
 
 
 """Method used in INDELS, where bigRefGeneTable is not applicable
 """
-def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
+def exonsEtAlStage(records, refdb, counts, format='vcf', table='refGene',
+    promoter_offset=500):
 
     inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-            
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
-
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '"   AND (txStart - ' + str(promoter_offset) + ') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
-            if (len(rows) > 0):
-                cnt = 1
-                for row in rows:
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode('utf-8'))
-                    exonEnds = str(row[10].decode('utf-8'))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
-
-                    if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                non_coding_exonic_count = non_coding_exonic_count + 1
-                        if (len(exons) > 0):
-                            region='positionType=non_coding_exon;' + ";".join(exons)
-                        else:
-                            non_coding_intronic_count = non_coding_intronic_count + 1
-                            region = 'positionType=non_coding_intron'
-
-                    elif (u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd)):
-                        cds_count = cds_count + 1
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count=exonic_count+1
-                        if (len(exons) > 0):
-                            region = 'positionType=CDS;' + ";".join(exons)
-                        else:
-                            intronic_count = intronic_count + 1
-                            region = 'positionType=CDS;' + 'intron'
-
-                    elif (u.isBetween(pos, txtStart, cdsStart) and \
-                        (cdsStart < cdsEnd) and (strand == "+")):
-                        utr5_count = utr5_count + 1
-                        region = 'positionType=utr5'
-
-                    elif (u.isBetween(pos, cdsEnd, txtEnd) and \
-                        (cdsStart < cdsEnd) (strand == "+")):
-                        utr3_count = utr3_count + 1
-                        region = 'positionType=utr3'
-
-                    elif (u.isBetween(pos, cdsEnd, txtEnd) and 
-                        (cdsStart < cdsEnd) (strand == "-")):
-                        utr5_count = utr5_count + 1
-                        region = 'positionType=utr5'
-
-                    elif (u.isBetween(pos, txtStart, cdsStart) and \
-                        (cdsStart < cdsEnd) and (strand == "-")):
-                        utr3_count = utr3_count + 1
-                        region = 'positionType=utr3'
-
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and \
-                        (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) +  \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and \
-                        (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                            "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
+    transcripts = refdb.transcriptTable(table, promoter_offset)
+    islands = refdb.rangeTable('cpgIslandExt',
+        columns=st.stageColumns('cpgIslandExt'), preload=True)
+    islandsAt = {}
+
+    for fields in prefetched(records, transcripts, inds):
+        chr = fields.chrom
+        pos = fields.pos
+
+        txs = transcripts.overlapping(chr, pos)
+        info = []
+        if (len(txs) > 0):
+            for tx in txs:
+                txtStart = tx.txStart
+                txtEnd = tx.txEnd
+                cdsStart = tx.cdsStart
+                cdsEnd = tx.cdsEnd
+                strand = tx.strand
+
+                promoter_plus = txtStart - int(promoter_offset)
+                promoter_minus = txtEnd + int(promoter_offset)
+                region = ""
+                pos = int(pos)
+                exons = []
+
+                if (cdsStart == cdsEnd):
+                    for e in tx.exonsAt(pos):
+                        exons.append("non_coding_exon=" + tx.labels[e])
+                        counts['non_coding_exonic_count'] += 1
+                    if (len(exons) > 0):
+                        region='positionType=non_coding_exon;' + ";".join(exons)
                     else:
-                        region = ''
-
-                    if (region != ''):
-                        info.append(collapseGeneNames(
-                            row=row, indices=indicesKnownGenes, 
-                            region=region, cnt=cnt))
+                        counts['non_coding_intronic_count'] += 1
+                        region = 'positionType=non_coding_intron'
+
+                elif (u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd)):
+                    counts['cds_count'] += 1
+                    for e in tx.exonsAt(pos):
+                        exons.append("exon=" + tx.labels[e])
+                        counts['exonic_count'] += 1
+                    if (len(exons) > 0):
+                        region = 'positionType=CDS;' + ";".join(exons)
+                    else:
+                        counts['intronic_count'] += 1
+                        region = 'positionType=CDS;' + 'intron'
 
-                    cnt = cnt + 1
+                elif (u.isBetween(pos, txtStart, cdsStart) and \
+                    (cdsStart < cdsEnd) and (strand == "+")):
+                    counts['utr5_count'] += 1
+                    region = 'positionType=utr5'
 
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
+                elif (u.isBetween(pos, cdsEnd, txtEnd) and \
+                    (cdsStart < cdsEnd) and (strand == "+")):
+                    counts['utr3_count'] += 1
+                    region = 'positionType=utr3'
 
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
-                interGenic_count = interGenic_count + 1
+                elif (u.isBetween(pos, cdsEnd, txtEnd) and
+                    (cdsStart < cdsEnd) and (strand == "-")):
+                    counts['utr5_count'] += 1
+                    region = 'positionType=utr5'
 
-            linenum = linenum + 1
+                elif (u.isBetween(pos, txtStart, cdsStart) and \
+                    (cdsStart < cdsEnd) and (strand == "-")):
+                    counts['utr3_count'] += 1
+                    region = 'positionType=utr3'
 
-        else:
-            fh_out.write(line + '\n')
+                elif (u.isBetween(pos, promoter_plus, txtStart) and \
+                    (strand == "+")):
+                    island = cpgIslandAt(islands, islandsAt, chr, pos)
 
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
+                    if (island is not None):
+                        region = 'putativePromoterRegion=' + \
+                            "".join(str(island[0]).split())
+                        counts['promoter_count'] += 1
 
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
+                elif (u.isBetween(pos, txtEnd, promoter_minus) and \
+                    (strand == "-")):
+                    island = cpgIslandAt(islands, islandsAt, chr, pos)
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
+                    if (island is not None):
+                        region = 'putativePromoterRegion=' + \
+                        "".join(str(island[0]).split())
+                        counts['promoter_count'] += 1
 
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
+                if (region != ''):
+                    info.append(tx.geneAnnotation(region))
 
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
+            fields[7].append(';' + ";".join(info))
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic "+str(intronic_count) +'\n')
+        else:
+            fields[7].append(";positionType=interGenic")
+            counts['interGenic_count'] += 1
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
+        yield fields
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
+def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
+    tmpextin='.2', tmpextout='.3', sep='\t'):
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
+    counts = Counter()
+    refdb = backends.configured().reference()
+    runStageOnFile(vcf + tmpextin, vcf + tmpextout,
+        lambda records: exonsEtAlStage(records, refdb, counts, format=format,
+            table=table, promoter_offset=promoter_offset), sep=sep,
+        format=format)
+    refdb.close()
 
-    fh_out.close()
+    fh_log = open(vcf + '.count.log', 'a')
+    writeGenesLog(fh_log, counts)
     fh_log.close()
-    fh.close()
-    conn.close()
 
 
-"""Overlap with tfbsConsSites
+"""Log line shared by the overlap annotators
 """
-def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
+def writeOverlapLog(fh_log, counts, table):
+    fh_log.write(f"In {str(table)}: {str(counts['var_count'])} in " + \
+        f"{str(counts['line_count'])} variants\n")
 
-    allowed_chrom=['1','2','3','4','5','6','7','8','9','10','11','12','13',
-        '14','15','16','17','18','19','20','21','22','X','Y']
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+"""Runs an overlap stage over a file and appends its line to the log
+"""
+def runOverlapOnFile(vcf, tmpextin, tmpextout, stage, label, sep='\t'):
+    counts = Counter()
+    refdb = backends.configured().reference()
+    runStageOnFile(vcf + tmpextin, vcf + tmpextout,
+        lambda records: stage(records, refdb, counts), sep=sep)
+    refdb.close()
+
+    fh_log = open(vcf + '.count.log', 'a')
+    writeOverlapLog(fh_log, counts, label)
+    fh_log.close()
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+"""Overlap with tfbsConsSites
+"""
+def tfbsConsSitesStage(records, refdb, counts, format='vcf',
+    table='tfbsConsSites'):
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    ranges = refdb.rangeTable(table, columns=st.stageColumns(table),
+        split=True)
 
-    linenum = 1
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if (line.startswith("##")):
-            fh_out.write(line + '\n')
+    # There is a table for each of chromosomes 1..22, X and Y
+    def chromOf(fields, inds):
+        return fields.chromBare if (fields.chromId <= CHROM_Y) else None
 
-        #header line
-        elif (line.startswith('#CHROM') or line.startswith('CHROM')):
-            fh_out.write(line + '\n')
+    for fields in prefetched(records, ranges, inds, chromOf=chromOf):
+        pos = fields.pos
 
-        else:
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            # For some reason this table has no "chr" preceeding number
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos=fields[inds[1]].strip()
-            isOverlap = False
-            chrIndex=chr.replace('chr', '')
-
-            if (chrIndex in allowed_chrom):
-                isOverlap = False
-                sql = 'select chrom, chromStart, chromEnd, name ' + \
-                    'from tfbsConsSites' + chrIndex + \
-                    ' where  chromStart <= ' + str(pos) + ' AND ' + \
-                    str(pos) + ' <= chromEnd;'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(row[3]) + '.' + str(row[0]) + '.' + \
-                            str(row[1]) + '.' + str(row[2])
-                        t = t.strip()
-                        records.append('tfbsRegion' + '=' + t)
-                        records_count = records_count + 1
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
+        if (fields.chromId <= CHROM_Y):
+            rows = ranges.overlapping(fields.chromBare, pos)
+            records_found = []
 
-                    fh_out.write('\t'.join(fields) + '\n')
+            if (len(rows) > 0):
+                counts['line_count'] += 1
 
-                else: # chrom is not on the list
-                    fh_out.write(line + '\n')
+                for row in rows:
+                    counts['var_count'] += 1
+                    t = str(row[3]) + '.' + str(row[0]) + '.' + \
+                        str(row[1]) + '.' + str(row[2])
+                    t = t.strip()
+                    records_found.append('tfbsRegion' + '=' + t)
 
-            else: # chrom is not on the list
-                fh_out.write(line + '\n')
+                appendInfo(fields, ';'.join(records_found))
 
-        linenum = linenum + 1
+        yield fields
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites',
+    tmpextin='.2', tmpextout='.3', sep='\t'):
+    runOverlapOnFile(vcf, tmpextin, tmpextout,
+        lambda records, refdb, counts: tfbsConsSitesStage(records, refdb,
+            counts, format=format, table=table), table, sep=sep)
 
 
 """Overlap with GadAll table
 """
-def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
-    tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
+def gadAllStage(records, refdb, counts, format='vcf', table='gadAll'):
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    ranges = refdb.rangeTable(table, chrom_col='chromosome')
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                # For some reason this table has no "chr" preceeding number
-                if chr.startswith("chr"):
-                    chr = str(chr).replace("chr", "")
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chromosome="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        if not fu.isOnTheList(r_tmp, str(row[3])):
-                            r_tmp.append(str(row[3]) )
-                            records.append(str(table) + '=' + str(row[3]))
-                            records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t '.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+    def chromOf(fields, inds):
+        return fields.chromBare
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+    for fields in prefetched(records, ranges, inds, chromOf=chromOf):
+        # For some reason this table has no "chr" preceeding number
+        chr = fields.chromBare
+        pos = fields.pos
+        rows = ranges.overlapping(chr, pos)
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+        if (len(rows) > 0):
+            counts['line_count'] += 1
+            records_found = []
+            r_tmp = []
+            for row in rows:
+                counts['var_count'] += 1
+                if not fu.isOnTheList(r_tmp, str(row[3])):
+                    r_tmp.append(str(row[3]) )
+                    records_found.append(str(table) + '=' + str(row[3]))
+            appendInfo(fields, ';'.join(records_found))
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+        yield fields
 
 
-""" Overlap with gwasCatalog table """
-def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='',
+    tmpextout='.1', sep='\t'):
+    runOverlapOnFile(vcf, tmpextin, tmpextout,
+        lambda records, refdb, counts: gadAllStage(records, refdb, counts,
+            format=format, table=table), table, sep=sep)
 
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
 
+""" Overlap with gwasCatalog table """
+def gwasCatalogStage(records, refdb, counts, format='vcf', table='gwasCatalog'):
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    # Catalog entries are single positions, keyed by chromEnd
+    ranges = refdb.rangeTable(table, start_col='chromEnd', end_col='chromEnd',
+        columns=st.stageColumns(table))
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-                
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND chromEnd = ' + str(pos) + ';'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        records.append(str(table) + '=' + str('pubMedID') + \
-                            '=' + str(row[5]) + ',trait=' + str(row[10]))
-                        records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+    for fields in prefetched(records, ranges, inds):
+        chr = fields.chrom
+        pos = fields.pos
+        rows = ranges.overlapping(chr, pos)
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+        if (len(rows) > 0):
+            counts['line_count'] += 1
+            records_found = []
+            for row in rows:
+                counts['var_count'] += 1
+                records_found.append(str(table) + '=' + str('pubMedID') + \
+                    '=' + str(row[0]) + ',trait=' + str(row[1]))
+            appendInfo(fields, ';'.join(records_found))
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+        yield fields
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+
+def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
+    tmpextin='', tmpextout='.1', sep='\t'):
+    runOverlapOnFile(vcf, tmpextin, tmpextout,
+        lambda records, refdb, counts: gwasCatalogStage(records, refdb, counts,
+            format=format, table=table), table, sep=sep)
 
 
 """Overlap with HUGO Gene Nomenclature Committee (HGNC) table
 """
-def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+def hugoStage(records, refdb, counts, format='vcf', table='hugo'):
+    inds = getFormatSpecificIndices(format=format)
+    ranges = refdb.rangeTable(table)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    for fields in prefetched(records, ranges, inds):
+        chr = fields.chrom
+        pos = fields.pos
+        rows = ranges.overlapping(chr, pos)
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+        if (len(rows) > 0):
+            counts['line_count'] += 1
+            records_found = []
+            r_tmp = []
+            for row in rows:
+                counts['var_count'] += 1
+                t = str(str(row[5]) + ',' + str(row[6])).strip()
+                if not fu.isOnTheList(r_tmp, t):
+                    r_tmp.append(t)
+                    records_found.append('HGNC_GeneAnnotation' + '=' + t)
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos=fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(str(row[5]) + ',' + str(row[6])).strip()
-                        if not fu.isOnTheList(r_tmp, t):
-                            r_tmp.append(t)
-                            records.append('HGNC_GeneAnnotation' + '=' + t)
-                        records_count = records_count + 1
-
-                    records_str = ','.join(records).replace(';', ',')
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] +records_str
-                    else:
-                        fields[7] = fields[7] + ';' + records_str
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+            appendInfo(fields, ','.join(records_found).replace(';', ','))
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+        yield fields
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo',
+    tmpextin='', tmpextout='.1', sep='\t'):
+    runOverlapOnFile(vcf, tmpextin, tmpextout,
+        lambda records, refdb, counts: hugoStage(records, refdb, counts,
+            format=format, table=table), table, sep=sep)
 
 
 """Overlap with segdup regions genomicSuperDups
 """
-def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
-    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+def genomicSuperDupsStage(records, refdb, counts, format='vcf',
+    table='genomicSuperDups'):
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    inds = getFormatSpecificIndices(format=format)
+    ranges = refdb.rangeTable(table, columns=st.stageColumns(table))
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    for fields in prefetched(records, ranges, inds):
+        chr = fields.chrom
+        pos = fields.pos
+        rows = ranges.overlapping(chr, pos)
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+        if (len(rows) > 0):
+            row = rows[0]
+            counts['line_count'] += 1
+            counts['var_count'] += 1
+            fields[7].append(';' + str(table) + '=' + \
+                str(True) + ';' + 'otherChrom=' + \
+                str(row[0]) + ';otherStart=' + \
+                str(row[1]) + ';otherEnd=' + str(row[2]))
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                otherChrom = ''
-                otherStart = ''
-                otherEnd = ''
-                l = str(isOverlap)
-
-                sql = 'select * from ' + table + ' where chrom="'+ str(chr) + \
-                    '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    otherChrom = rows[7]
-                    otherStart = rows[8]
-                    otherEnd = rows[9]
-                    fields[7] = fields[7] + ';' + str(table) + '=' + \
-                        str(isOverlap) + ';' + 'otherChrom=' + \
-                        str(otherChrom) + ';otherStart=' + \
-                        str(otherStart) + ';otherEnd=' + str(otherEnd)
-
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+        yield fields
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithGenomicSuperDups(vcf, format='vcf',
+    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t'):
+    runOverlapOnFile(vcf, tmpextin, tmpextout,
+        lambda records, refdb, counts: genomicSuperDupsStage(records, refdb,
+            counts, format=format, table=table), table, sep=sep)
 
 
-"""Searches Genes Databases and returns Genes/Cytobands 
+"""Searches Genes Databases and returns Genes/Cytobands
    with which SNP or INDEL overlaps
 """
-def addOverlapWithRefGene(vcf, format='vcf', table='refGene', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+def refGeneOverlapStage(records, refdb, counts, format='vcf', table='refGene'):
     colindex = 1
-    colindex2 = 12
+    colindex2 = 0
     name = 'name'
     name2 = 'name2'
     startName = 'txStart'
     endName = 'txEnd'
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    ranges = refdb.rangeTable(table, start_col=startName, end_col=endName,
+        columns=st.stageColumns(table))
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName +');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(name2 + '=' + \
-                            str(row[colindex2]) + ';' + name + '=' + \
-                            str(row[colindex]))
-
-                    genes = ';'.join([str(x) for x in overlapsWith])
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(genes)
-                    else:
-                        fields[7] = fields[7] + ';' + str(genes)
-                fh_out.write('\t'.join(fields) + '\n')
+    for fields in prefetched(records, ranges, inds):
+        chr = fields.chrom
+        pos = fields.pos
+        rows = ranges.overlapping(chr, pos)
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+        if (len(rows) > 0):
+            counts['line_count'] += 1
+            overlapsWith = []
+            for row in rows:
+                counts['var_count'] += 1
+                overlapsWith.append(name2 + '=' + \
+                    str(row[colindex2]) + ';' + name + '=' + \
+                    str(row[colindex]))
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+            appendInfo(fields, ';'.join(overlapsWith))
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+        yield fields
 
 
-"""Method to find overlap with Cytoband table
-"""
-def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
+def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
     tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    runOverlapOnFile(vcf, tmpextin, tmpextout,
+        lambda records, refdb, counts: refGeneOverlapStage(records, refdb,
+            counts, format=format, table=table), table, sep=sep)
+
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-    colindex = 12
+"""Method to find overlap with Cytoband table
+"""
+def cytobandStage(records, refdb, counts, format='vcf', table='cytoBand'):
+    # name2 of refGene, name of cytoBand: the first column selected
+    colindex = 0
     startName = 'txStart'
     endName = 'txEnd'
 
     if (table == 'cytoBand'):
-        colindex = 3
         startName = 'chromStart'
         endName = 'chromEnd'
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    ranges = refdb.rangeTable(table, start_col=startName, end_col=endName,
+        columns=st.stageColumns(table))
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName + ');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(str(row[colindex]))
-                    overlapsWith = u.dedup(overlapsWith)
-                    cytoband = ';'.join([str(x) for x in overlapsWith])
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + str(cytoband)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + '=' + str(cytoband)
-                fh_out.write('\t'.join(fields) + '\n')
+    for fields in prefetched(records, ranges, inds):
+        chr = fields.chrom
+        pos = fields.pos
+        rows = ranges.overlapping(chr, pos)
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+        if (len(rows) > 0):
+            counts['line_count'] += 1
+            overlapsWith = []
+            for row in rows:
+                counts['var_count'] += 1
+                overlapsWith.append(str(row[colindex]))
+            overlapsWith = u.dedup(overlapsWith)
+            cytoband = ';'.join(overlapsWith)
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+            appendInfo(fields, str(table) + '=' + cytoband)
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+        yield fields
 
 
-"""Method to find overlap with CNV tables
-"""
-def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
+def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand',
     tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+    runOverlapOnFile(vcf, tmpextin, tmpextout,
+        lambda records, refdb, counts: cytobandStage(records, refdb, counts,
+            format=format, table=table), table, sep=sep)
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
 
+"""Method to find overlap with CNV tables
+"""
+def cnvDatabaseStage(records, refdb, counts, format='vcf', table='dgv_Cnv'):
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    ranges = refdb.rangeTable(table, columns=st.PRESENCE_COLUMNS)
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + \
-                        str(isOverlap)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + \
-                        '='+str(isOverlap)
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+    for fields in prefetched(records, ranges, inds):
+        chr = fields.chrom
+        pos = fields.pos
+        rows = ranges.overlapping(chr, pos)
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+        if (len(rows) > 0):
+            counts['line_count'] += 1
+            counts['var_count'] += 1
+            appendInfo(fields, str(table) + '=' + str(True))
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+        yield fields
 
 
-"""Method to find overlap with targetScanS tables
-"""
-def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
+def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv',
     tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    runOverlapOnFile(vcf, tmpextin, tmpextout,
+        lambda records, refdb, counts: cnvDatabaseStage(records, refdb, counts,
+            format=format, table=table), table, sep=sep)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
 
+"""Method to find overlap with targetScanS tables
+"""
+def miRNAStage(records, refdb, counts, format='vcf', table='targetScanS'):
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    ranges = refdb.rangeTable(table, columns=st.stageColumns(table))
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
-                        str(rows[2]) + '_' + str(rows[3])
-                    t = 'miRNAsites=' + t.strip()
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + t
-                    else:
-                        fields[7] = fields[7] + ';' + t
-                fh_out.write('\t'.join(fields) + '\n')
+    for fields in prefetched(records, ranges, inds):
+        chr = fields.chrom
+        pos = fields.pos
+        rows = ranges.overlapping(chr, pos)
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+        if (len(rows) > 0):
+            row = rows[0]
+            counts['line_count'] += 1
+            counts['var_count'] += 1
+            t = str(row[0]) + ',' +  str(row[1]) + '_' + \
+                str(row[2]) + '_' + str(row[3])
+            appendInfo(fields, 'miRNAsites=' + t.strip())
 
-    fh_log.write(f"In miRNAsites: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+        yield fields
 
-    conn.close()
-    fh.close()
-    fh_out.close()
 
-### EOF
\ No newline at end of file
+def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS',
+    tmpextin='', tmpextout='.1', sep='\t'):
+    runOverlapOnFile(vcf, tmpextin, tmpextout,
+        lambda records, refdb, counts: miRNAStage(records, refdb, counts,
+            format=format, table=table), 'miRNAsites', sep=sep)
+
+### EOF
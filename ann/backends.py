@@ -0,0 +1,172 @@
+# backends.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Where the annotation stages read the reference tables from: the MySQL
+# reference database, a SQLite copy of it (on disk or loaded into
+# memory), or a reference bundle alone
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sqlite3
+import threading
+
+import utils as u
+from reference import Reference, LOOKUP_SQL, LOOKUP_BUNDLE, \
+    LOOKUP_SWEEP, LOOKUP_COLUMNAR, LOOKUP_SEGMENTS, openBundle
+
+# Get ini configuration
+from configparser import ConfigParser
+config = ConfigParser(os.environ)
+config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'ann_config.ini'))
+
+BACKEND_MYSQL = 'mysql'
+BACKEND_SQLITE = 'sqlite'
+BACKEND_MEMORY = 'memory'
+BACKEND_BUNDLE = 'bundle'
+BACKENDS = [BACKEND_MYSQL, BACKEND_SQLITE, BACKEND_MEMORY, BACKEND_BUNDLE]
+
+# Lookups that read nothing but the bundle
+BUNDLE_LOOKUPS = [LOOKUP_BUNDLE, LOOKUP_SWEEP, LOOKUP_COLUMNAR,
+    LOOKUP_SEGMENTS]
+
+# SQLite copies loaded into memory: (process id, path) -> (URI of the
+# in-memory database, connection keeping it alive). A forked worker loads
+# a copy of its own
+memories = {}
+_memories_lock = threading.Lock()
+
+
+"""Reference database in MySQL; connections come from the process-wide
+   pool in utils
+"""
+class MySqlBackend(object):
+    name = BACKEND_MYSQL
+
+    def __init__(self, bundle=None):
+        self.bundle = bundle
+
+    def connect(self):
+        return u.db_connect()
+
+    def _database(self):
+        return 'mysql:annotator'
+
+    """Which reference data the backend reads: its database and the
+       checksum of its bundle; part of the annotation cache version, so
+       entries aren't served from other data under the same label
+    """
+    def identity(self):
+        identity = self._database()
+        if self.bundle:
+            identity = identity + '|' + openBundle(self.bundle).checksum
+        return identity
+
+    """Lookup the backend serves when lookup is asked for
+    """
+    def lookup(self, lookup):
+        return lookup
+
+    """Reference for one job (or one stage of it), on a connection of
+       its own; arguments as for reference.Reference
+    """
+    def reference(self, lookup=LOOKUP_SQL, bundle=None, version=None,
+        bins=False):
+        return Reference(self.connect(), lookup=self.lookup(lookup),
+            bundle=bundle or self.bundle, version=version, bins=bins)
+
+
+"""SQLite copy of the reference database (see build_sqlite.py), opened
+   read-only; every lookup works on it, with no network hop
+"""
+class SqliteBackend(MySqlBackend):
+    name = BACKEND_SQLITE
+
+    def __init__(self, path, bundle=None):
+        MySqlBackend.__init__(self, bundle=bundle)
+        if not (path and os.path.isfile(path)):
+            raise ValueError(f"{self.name.capitalize()} backend needs " + \
+                f"a SQLite reference database; '{path}' not found")
+        self.path = path
+
+    def connect(self):
+        return sqlite3.connect('file:' + os.path.abspath(self.path) + \
+            '?mode=ro', uri=True, check_same_thread=False)
+
+    # The file, and when it was last rebuilt; the memory backend reads the
+    # same data
+    def _database(self):
+        stat = os.stat(self.path)
+        return 'sqlite:' + os.path.abspath(self.path) + ':' + \
+            str(stat.st_size) + ':' + str(int(stat.st_mtime))
+
+
+"""SqliteBackend copied into memory the first time a process connects;
+   every connection of the process shares that copy
+"""
+class MemoryBackend(SqliteBackend):
+    name = BACKEND_MEMORY
+
+    def _load(self):
+        key = (os.getpid(), self.path)
+        with _memories_lock:
+            if key not in memories:
+                uri = 'file:reference' + str(len(memories)) + '_' + \
+                    str(key[0]) + '?mode=memory&cache=shared'
+                keeper = sqlite3.connect(uri, uri=True,
+                    check_same_thread=False)
+                source = SqliteBackend.connect(self)
+                source.backup(keeper)
+                source.close()
+                memories[key] = (uri, keeper)
+            return memories[key][0]
+
+    def connect(self):
+        return sqlite3.connect(self._load(), uri=True,
+            check_same_thread=False)
+
+
+"""Reference bundle alone, memory-mapped; lookups that would need a
+   database are served as LOOKUP_BUNDLE
+"""
+class BundleBackend(MySqlBackend):
+    name = BACKEND_BUNDLE
+
+    def __init__(self, bundle=None):
+        if not bundle:
+            raise ValueError("Bundle backend needs a reference bundle")
+        MySqlBackend.__init__(self, bundle=bundle)
+
+    def connect(self):
+        return None
+
+    def _database(self):
+        return 'bundle'
+
+    def lookup(self, lookup):
+        return lookup if (lookup in BUNDLE_LOOKUPS) else LOOKUP_BUNDLE
+
+
+"""Backend name (ReferenceBackend in ann_config.ini if not given), over
+   the SQLite file at ReferenceDatabase and the bundle (ReferenceBundle if
+   not given)
+"""
+def configured(name=None, bundle=None):
+    name = name or config['annotate'].get('ReferenceBackend') or \
+        BACKEND_MYSQL
+    bundle = bundle or config['annotate'].get('ReferenceBundle') or None
+    path = config['annotate'].get('ReferenceDatabase') or None
+    if name == BACKEND_MYSQL:
+        return MySqlBackend(bundle=bundle)
+    elif name == BACKEND_SQLITE:
+        return SqliteBackend(path, bundle=bundle)
+    elif name == BACKEND_MEMORY:
+        return MemoryBackend(path, bundle=bundle)
+    elif name == BACKEND_BUNDLE:
+        return BundleBackend(bundle=bundle)
+    raise ValueError(f"Unknown reference backend '{name}'")
+
+### EOF
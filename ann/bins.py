@@ -0,0 +1,126 @@
+# bins.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# UCSC hierarchical binning of the reference range tables
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+"""Standard UCSC bins: five levels of 128kb, 1Mb, 8Mb, 64Mb and 512Mb
+   blocks; a feature's bin is the smallest block holding all of it. Bin
+   numbers of the levels start at BIN_OFFSETS, finest first
+"""
+BIN_OFFSETS = [512 + 64 + 8 + 1, 64 + 8 + 1, 8 + 1, 1, 0]
+BIN_FIRST_SHIFT = 17
+BIN_NEXT_SHIFT = 3
+# Positions from here on aren't binned (UCSC's extended bins); queries
+# beyond it aren't restricted by bin
+BIN_MAX_END = 1 << 29
+# Widest query window restricted by bin; wider windows scan the chromosome
+BIN_MAX_SPAN = 1 << 26
+
+"""Range tables with a bin column: (table, chrom column, start column,
+   end column, split), bins over [start, end) as UCSC computes them
+   A split table is stored as one table per chromosome (tfbsConsSites1..22,
+   X, Y) and has no chrom column
+"""
+BIN_TABLES = [
+    ('refGene', 'chrom', 'txStart', 'txEnd', False),
+    ('cpgIslandExt', 'chrom', 'chromStart', 'chromEnd', False),
+    ('cytoBand', 'chrom', 'chromStart', 'chromEnd', False),
+    ('gadAll', 'chromosome', 'chromStart', 'chromEnd', False),
+    ('gwasCatalog', 'chrom', 'chromStart', 'chromEnd', False),
+    ('targetScanS', 'chrom', 'chromStart', 'chromEnd', False),
+    ('hugo', 'chrom', 'chromStart', 'chromEnd', False),
+    ('dgv_Cnv', 'chrom', 'chromStart', 'chromEnd', False),
+    ('abParts_IG_T_CelReceptors', 'chrom', 'chromStart', 'chromEnd', False),
+    ('mcCarroll_Cnv', 'chrom', 'chromStart', 'chromEnd', False),
+    ('conrad_Cnv', 'chrom', 'chromStart', 'chromEnd', False),
+    ('genomicSuperDups', 'chrom', 'chromStart', 'chromEnd', False),
+    ('tfbsConsSites', None, 'chromStart', 'chromEnd', True),
+    ('chrom_pos_unequal', 'CHR', 'start', 'end', False),
+]
+
+
+"""Bin of the feature [start, end); features reaching below 0 or beyond
+   BIN_MAX_END are put in bin 0, which every lookup reads
+"""
+def binOf(start, end):
+    last = (end - 1) if (end > start) else start
+    if (start < 0 or last >= BIN_MAX_END):
+        return 0
+    start = start >> BIN_FIRST_SHIFT
+    last = last >> BIN_FIRST_SHIFT
+    for offset in BIN_OFFSETS:
+        if start == last:
+            return offset + start
+        start = start >> BIN_NEXT_SHIFT
+        last = last >> BIN_NEXT_SHIFT
+    return 0
+
+
+"""SQL expression computing binOf(start column, end column) in the server
+"""
+def binSql(start_col, end_col):
+    last = '(CASE WHEN ' + end_col + ' > ' + start_col + ' THEN ' + \
+        end_col + ' - 1 ELSE ' + start_col + ' END)'
+    sql = 'CASE WHEN ' + start_col + ' < 0 OR ' + last + ' >= ' + \
+        str(BIN_MAX_END) + ' THEN 0'
+    shift = BIN_FIRST_SHIFT
+    for offset in BIN_OFFSETS:
+        sql = sql + ' WHEN (' + start_col + ' >> ' + str(shift) + ') = (' + \
+            last + ' >> ' + str(shift) + ') THEN ' + str(offset) + \
+            ' + (' + start_col + ' >> ' + str(shift) + ')'
+        shift = shift + BIN_NEXT_SHIFT
+    return sql + ' ELSE 0 END'
+
+
+"""Bins of the features that may hold a position in [lo, hi], as one
+   (first, last) range per level, finest first; None if the window can't
+   be restricted by bin
+   Features binned over [start, end) are looked up by their closed range
+   [start, end], so the window is widened by one on each side
+"""
+def binRanges(lo, hi):
+    lo = max(int(lo) - 1, 0)
+    hi = int(hi) + 1
+    if (hi >= BIN_MAX_END or hi - lo > BIN_MAX_SPAN):
+        return None
+    if hi < lo:
+        # Only features reaching below 0 can hold it
+        return [(0, 0)] * len(BIN_OFFSETS)
+    ranges = []
+    lo = lo >> BIN_FIRST_SHIFT
+    hi = hi >> BIN_FIRST_SHIFT
+    for offset in BIN_OFFSETS:
+        ranges.append((offset + lo, offset + hi))
+        lo = lo >> BIN_NEXT_SHIFT
+        hi = hi >> BIN_NEXT_SHIFT
+    return ranges
+
+
+"""Bins of every feature that may hold a position in [lo, hi]; None if
+   the window can't be restricted by bin
+"""
+def binsOverlapping(lo, hi):
+    ranges = binRanges(lo, hi)
+    if ranges is None:
+        return None
+    return sorted(set([b for first, last in ranges
+        for b in range(first, last + 1)]))
+
+
+"""Whether lookups of table on [start_col, end_col] can be restricted by
+   its bin column: the range looked up must lie within the binned one
+   (as it does for single positions at the binned end, e.g. gwasCatalog)
+"""
+def isBinned(table, start_col, end_col):
+    for name, chrom_col, bin_start, bin_end, split in BIN_TABLES:
+        if (table == name or (split and table.startswith(name))):
+            return ((start_col, end_col) == (bin_start, bin_end) or
+                (start_col == end_col == bin_end))
+    return False
+
+### EOF
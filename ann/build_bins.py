@@ -0,0 +1,85 @@
+# build_bins.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Fills the UCSC bin columns of the reference range tables and indexes
+# them by (bin, chrom), for ReferenceBins in ann_config.ini; in the MySQL
+# reference database, or in a SQLite copy of it (see build_sqlite.py)
+#
+# Usage: python build_bins.py [--add-columns] [SQLite file]
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import sys
+import sqlite3
+
+import utils as u
+import bins as bn
+import bundle as b
+
+
+# Tables read as whole rows with the bin column first (refGene transcripts,
+# the bigRefGene rows): one appended last would be read as data
+BIN_FIRST_TABLES = ['refGene', 'chrom_pos_unequal']
+
+
+"""Computes the bin of every row of the tables in bins.BIN_TABLES, in the
+   server, and indexes it. Bins the UCSC tables already carry are
+   recomputed to the same values
+   Tables without a bin column are left as they are, and looked up without
+   bins, unless add_columns is set: then they get one, appended after their
+   other columns so the stages reading them by position read what they did
+   before. Tables in BIN_FIRST_TABLES never do
+"""
+def build(conn=None, add_columns=False):
+    conn = conn or u.db_connect()
+    cursor = conn.cursor()
+
+    for table, chrom_col, start_col, end_col, split in bn.BIN_TABLES:
+        names = [table + c for c in b.TFBS_CHROMS] if split else [table]
+        for name in names:
+            cursor.execute('select * from ' + name + ' where 1 = 0;')
+            cursor.fetchall()
+            if 'bin' not in [d[0] for d in cursor.description]:
+                if not add_columns:
+                    print(f"{name}: no bin column; not binned " + \
+                        "(see --add-columns)")
+                    continue
+                if table in BIN_FIRST_TABLES:
+                    print(f"{name}: no bin column; not binned (read " + \
+                        "with the bin column first)")
+                    continue
+                cursor.execute('alter table ' + name + \
+                    ' add column bin integer;')
+            cursor.execute('update ' + name + ' set bin = ' + \
+                bn.binSql(start_col, end_col) + ';')
+            conn.commit()
+
+            # Bin first: lookups of a whole chromosome don't pick this
+            # index up and keep returning rows in table order
+            columns = 'bin' if (chrom_col is None) else ('bin, ' + chrom_col)
+            try:
+                cursor.execute('create index ' + name + '_bin on ' + name + \
+                    ' (' + columns + ');')
+            except Exception as e:
+                # Left from an earlier run; the bins have been refreshed
+                print(f"{name}: index {name}_bin not created ({e})")
+            conn.commit()
+            print(f"{name} - done.")
+
+    conn.close()
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    add_columns = ('--add-columns' in args)
+    args = [a for a in args if a != '--add-columns']
+    if len(args) > 1:
+        print("Usage: python build_bins.py [--add-columns] [SQLite file]")
+        sys.exit(1)
+    build(sqlite3.connect(args[0]) if args else None,
+        add_columns=add_columns)
+
+### EOF
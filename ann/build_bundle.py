@@ -0,0 +1,74 @@
+# build_bundle.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Exports the annotator reference tables into a reference bundle
+#
+# Usage: python build_bundle.py <bundle file> <reference version>
+#        python build_bundle.py --verify <bundle file>
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import sys
+
+import utils as u
+import bundle as b
+
+
+"""Copies every table in bundle.BUNDLE_TABLES into a new bundle,
+   one chromosome at a time, and intersects the range tables into the
+   genome segmentation
+"""
+def build(path, version, conn=None):
+    conn = conn or u.db_connect()
+    cursor = conn.cursor()
+    writer = b.BundleWriter(path, version)
+
+    for table, chrom_col, start_col, end_col, allele_col in b.BUNDLE_TABLES:
+        cursor.execute('select * from ' + table + ' where 1 = 0;')
+        columns = [d[0] for d in cursor.description]
+        writer.addTable(table, columns, chrom_col, start_col, end_col,
+            allele_col=allele_col)
+
+        if chrom_col is None:
+            cursor.execute('select * from ' + table + ';')
+            writer.addSegment(table, b.WHOLE_TABLE, cursor.fetchall())
+        else:
+            cursor.execute('select distinct ' + chrom_col + ' from ' + \
+                table + ';')
+            chroms = [row[0] for row in cursor.fetchall()]
+            for chrom in chroms:
+                cursor.execute('select * from ' + table + ' where ' + \
+                    chrom_col + '="' + str(chrom) + '";')
+                writer.addSegment(table, chrom, cursor.fetchall())
+
+        print(f"{table} - done.")
+
+    writer.addSegmentation()
+    print("Segmentation - done.")
+    writer.close()
+    conn.close()
+
+
+def verify(path):
+    bundle = b.Bundle(path)
+    ok = bundle.verify()
+    print(f"{path}: version {bundle.version}, {bundle.checksum} " + \
+        ('OK' if ok else 'CHECKSUM MISMATCH'))
+    return ok
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) == 3 and sys.argv[1] == '--verify'):
+        sys.exit(0 if verify(sys.argv[2]) else 1)
+    elif len(sys.argv) == 3:
+        build(sys.argv[1], sys.argv[2])
+        verify(sys.argv[1])
+    else:
+        print("Usage: python build_bundle.py <bundle file> <reference version>")
+        print("       python build_bundle.py --verify <bundle file>")
+        sys.exit(1)
+
+### EOF
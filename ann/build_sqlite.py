@@ -0,0 +1,93 @@
+# build_sqlite.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Copies the annotator reference tables into a SQLite file, for the
+# sqlite and memory reference backends (ReferenceBackend in
+# ann_config.ini)
+#
+# Usage: python build_sqlite.py <SQLite file>
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import sqlite3
+from decimal import Decimal
+
+import utils as u
+import bundle as b
+import statements as st
+
+# Rows per executemany into the SQLite file
+COPY_ROWS = 10000
+
+# Tables looked up at exact positions; they are indexed on (chrom,
+# position). The others are indexed on chrom alone, so lookups return
+# their rows in table order, as MySQL does
+POSITION_TABLES = ['dbSNP', 'chrom_pos_equal_base', 'chrom_pos_equal_nobase']
+
+# DECIMAL columns are copied as the text they print as
+sqlite3.register_adapter(Decimal, str)
+
+
+"""Copies every table in bundle.BUNDLE_TABLES, one chromosome at a time
+   and otherwise in table order, into a new SQLite file and indexes it
+"""
+def build(path, conn=None):
+    if os.path.exists(path):
+        raise ValueError(f"'{path}' already exists")
+    conn = conn or u.db_connect()
+    cursor = conn.cursor()
+    out = sqlite3.connect(path)
+
+    for table, chrom_col, start_col, end_col, allele_col in b.BUNDLE_TABLES:
+        cursor.execute('select * from ' + table + ' where 1 = 0;')
+        columns = [d[0] for d in cursor.description]
+        out.execute('create table ' + table + ' (' + \
+            ', '.join(['"' + c + '"' for c in columns]) + ');')
+        insert = 'insert into ' + table + ' values (' + \
+            ', '.join(['?'] * len(columns)) + ');'
+
+        if chrom_col is None:
+            cursor.execute('select * from ' + table + ';')
+            _copy(cursor, out, insert)
+        else:
+            cursor.execute('select distinct ' + chrom_col + ' from ' + \
+                table + ';')
+            chroms = [row[0] for row in cursor.fetchall()]
+            for chrom in chroms:
+                cursor.execute('select * from ' + table + ' where ' + \
+                    chrom_col + ' = ' + st.placeholder(cursor) + ';',
+                    [chrom])
+                _copy(cursor, out, insert)
+
+        if chrom_col is not None:
+            columns = chrom_col + (', ' + start_col
+                if (table in POSITION_TABLES) else '')
+            out.execute('create index ' + table + '_chrom on ' + table + \
+                ' (' + columns + ');')
+        out.commit()
+        print(f"{table} - done.")
+
+    out.close()
+    conn.close()
+
+
+def _copy(cursor, out, insert):
+    while True:
+        rows = cursor.fetchmany(COPY_ROWS)
+        if not rows:
+            break
+        out.executemany(insert, rows)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print("Usage: python build_sqlite.py <SQLite file>")
+        sys.exit(1)
+    build(sys.argv[1])
+
+### EOF
@@ -0,0 +1,584 @@
+# bundle.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Compiled, memory-mapped snapshot of the annotator reference tables
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import mmap
+import json
+import struct
+import hashlib
+import time
+from decimal import Decimal
+
+import numpy as np
+
+import intervals
+
+"""File layout (all arrays 8-byte aligned, little endian):
+
+   MAGIC
+   column arrays and string pools of every table segment
+   header (JSON)
+   header length (uint64), MAGIC
+
+   Each table is stored as one segment per chromosome. Rows of a segment
+   are sorted by their start column (ties in table order) and carry
+   derived arrays next to the table's own columns:
+     _order   position of the row in the original table scan
+     _start   start column, as int64
+     _end     end column, as int64
+     _maxEnd  interval-tree augmentation (see intervals.augment)
+     _refCode packed allele code of the allele column, if the table has one
+   Numeric columns are stored as arrays, string and blob columns as int32
+   codes into a per-segment string pool (offsets + data, -1 for NULL).
+   The header holds the layout, the reference version label and a SHA-256
+   checksum of everything that precedes it.
+
+   A bundle may also hold a segmentation of the genome over the
+   SEGMENT_TABLES: per chromosome, the sorted starts of the non-overlapping
+   segments the tables' rows cut it into (_bounds) and the interned id of
+   the annotation set covering each (_sets). Set s is one row of _combos,
+   the id of each table's own row set; set t of a table lists its rows,
+   as row indices into the table's segment in table order, at
+   rows[offsets[t]:offsets[t + 1]]. Set 0 is empty everywhere.
+"""
+MAGIC = b'GASREF\x00\x01'
+FORMAT_VERSION = 1
+ALIGN = 8
+
+# Tables split into one table per chromosome (tfbsConsSites1..22, X, Y)
+TFBS_CHROMS = [str(c) for c in range(1, 23)] + ['X', 'Y']
+
+"""Reference tables exported into a bundle:
+   (table, chrom column, start column, end column, allele column)
+   A chrom column of None means the table holds a single chromosome
+"""
+BUNDLE_TABLES = [
+    ('dbSNP', 'CHR', 'POS', 'POS', 'REF'),
+    ('chrom_pos_equal_base', 'CHR', 'start', 'end', None),
+    ('chrom_pos_equal_nobase', 'CHR', 'start', 'end', None),
+    ('chrom_pos_unequal', 'CHR', 'start', 'end', None),
+    ('refGene', 'chrom', 'txStart', 'txEnd', None),
+    ('cpgIslandExt', 'chrom', 'chromStart', 'chromEnd', None),
+    ('cytoBand', 'chrom', 'chromStart', 'chromEnd', None),
+    ('gadAll', 'chromosome', 'chromStart', 'chromEnd', None),
+    ('gwasCatalog', 'chrom', 'chromEnd', 'chromEnd', None),
+    ('targetScanS', 'chrom', 'chromStart', 'chromEnd', None),
+    ('hugo', 'chrom', 'chromStart', 'chromEnd', None),
+    ('dgv_Cnv', 'chrom', 'chromStart', 'chromEnd', None),
+    ('abParts_IG_T_CelReceptors', 'chrom', 'chromStart', 'chromEnd', None),
+    ('mcCarroll_Cnv', 'chrom', 'chromStart', 'chromEnd', None),
+    ('conrad_Cnv', 'chrom', 'chromStart', 'chromEnd', None),
+    ('genomicSuperDups', 'chrom', 'chromStart', 'chromEnd', None),
+] + [('tfbsConsSites' + c, None, 'chromStart', 'chromEnd', None)
+    for c in TFBS_CHROMS]
+
+# Segment key of tables without a chrom column
+WHOLE_TABLE = '*'
+
+"""Range tables intersected into the genome segmentation: (table, split)
+   A split table is stored as one table per chromosome, named by suffix
+"""
+SEGMENT_TABLES = [
+    ('cytoBand', False),
+    ('gadAll', False),
+    ('hugo', False),
+    ('dgv_Cnv', False),
+    ('abParts_IG_T_CelReceptors', False),
+    ('mcCarroll_Cnv', False),
+    ('conrad_Cnv', False),
+    ('genomicSuperDups', False),
+    ('targetScanS', False),
+    ('tfbsConsSites', True),
+    ('refGene', False),
+    ('cpgIslandExt', False),
+]
+
+BASES = ['A', 'C', 'G', 'T']
+
+
+class BundleError(Exception):
+    pass
+
+
+"""Chromosome name without 'chr', as segmentations are keyed
+"""
+def bareChrom(chrom):
+    chrom = str(chrom)
+    if chrom.startswith("chr"):
+        chrom = chrom.replace('chr', '')
+    return chrom
+
+
+"""Which of the SEGMENT_TABLES a table segment belongs to, as (index,
+   chromosome key the stages look it up with), or None
+"""
+def segmentTableOf(table, chrom):
+    for t, (name, split) in enumerate(SEGMENT_TABLES):
+        if (split and table.startswith(name) and chrom == WHOLE_TABLE):
+            return (t, table[len(name):])
+        if (not split and table == name):
+            return (t, str(chrom))
+    return None
+
+
+"""Row sets of one table along a chromosome: the set id at every one of
+   bounds, and the sets themselves as (offsets, rows)
+   Set 0 is the empty set; any other is the rows covering a stretch of
+   the chromosome, in table order, interned so that equal sets share an id
+"""
+def _tableSets(bounds, starts, ends, order):
+    ids = np.zeros(len(bounds), dtype=np.int32)
+    events = {}
+    for i, k in enumerate(np.searchsorted(bounds, starts).tolist()):
+        events.setdefault(k, []).append((True, i))
+    for i, k in enumerate(np.searchsorted(bounds, ends + 1).tolist()):
+        events.setdefault(k, []).append((False, i))
+
+    sets = {(): 0}
+    offsets = [0, 0]
+    rows = []
+    active = set()
+    steps = sorted(events)
+    for n, k in enumerate(steps):
+        for added, i in events[k]:
+            if added:
+                active.add(i)
+            else:
+                active.discard(i)
+        members = tuple(sorted(active, key=lambda i: order[i]))
+        if members not in sets:
+            sets[members] = len(sets)
+            rows.extend(members)
+            offsets.append(len(rows))
+        last = steps[n + 1] if (n + 1 < len(steps)) else len(bounds)
+        ids[k:last] = sets[members]
+
+    return (ids, np.array(offsets, dtype=np.int64),
+        np.array(rows, dtype=np.int64))
+
+
+"""Writes a bundle one table segment at a time; the file only appears
+   under its final name once close() has written the header
+"""
+class BundleWriter(object):
+    def __init__(self, path, version):
+        self.path = path
+        self.tmppath = path + '.tmp'
+        self.fh = open(self.tmppath, 'wb')
+        self.sha = hashlib.sha256()
+        self.offset = 0
+        self.alleles = dict((b, i) for i, b in enumerate(BASES))
+        self.header = {
+            'format': FORMAT_VERSION,
+            'version': str(version),
+            'created': int(time.time()),
+            'tables': {},
+        }
+        # (starts, ends, table order) of the segments of SEGMENT_TABLES,
+        # by chromosome, for addSegmentation()
+        self.spans = {}
+        self._write(MAGIC)
+
+    def _write(self, data):
+        offset = self.offset
+        pad = (-len(data)) % ALIGN
+        data = bytes(data) + b'\x00' * pad
+        self.fh.write(data)
+        self.sha.update(data)
+        self.offset = self.offset + len(data)
+        return offset
+
+    def _writeArray(self, array):
+        array = np.ascontiguousarray(array)
+        return [array.dtype.str, self._write(array.tobytes()), len(array)]
+
+    """Encodes one column; the storage type is inferred from its values
+    """
+    def _writeColumn(self, values):
+        kinds = set(type(v) for v in values if v is not None)
+        nulls = np.array([v is None for v in values], dtype=np.uint8)
+        column = {}
+
+        if kinds and kinds <= set([int]):
+            column['type'] = 'int'
+            column['values'] = self._writeArray(np.array(
+                [0 if v is None else v for v in values], dtype=np.int64))
+        elif kinds and kinds <= set([int, float]):
+            column['type'] = 'float'
+            column['values'] = self._writeArray(np.array(
+                [0.0 if v is None else v for v in values], dtype=np.float64))
+        else:
+            if kinds and kinds <= set([bytes, bytearray]):
+                column['type'] = 'bytes'
+            elif kinds == set([Decimal]):
+                column['type'] = 'decimal'
+            else:
+                column['type'] = 'str'
+
+            pool = {}
+            codes = np.empty(len(values), dtype=np.int32)
+            for i, v in enumerate(values):
+                if v is None:
+                    codes[i] = -1
+                    continue
+                v = bytes(v) if (column['type'] == 'bytes') \
+                    else str(v).encode('utf-8')
+                codes[i] = pool.setdefault(v, len(pool))
+
+            blobs = list(pool)
+            offsets = np.zeros(len(blobs) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(b) for b in blobs])
+            column['codes'] = self._writeArray(codes)
+            column['offsets'] = self._writeArray(offsets)
+            column['data'] = [self._write(b''.join(blobs)), int(offsets[-1])]
+
+        if nulls.any():
+            column['nulls'] = self._writeArray(nulls)
+        return column
+
+    def _alleleCode(self, allele):
+        allele = str(allele).upper()
+        if allele not in self.alleles:
+            self.alleles[allele] = len(self.alleles)
+        return self.alleles[allele]
+
+    def addTable(self, table, columns, chrom_col, start_col, end_col,
+        allele_col=None):
+        self.header['tables'][table] = {
+            'columns': list(columns),
+            'chrom_col': chrom_col,
+            'start_col': start_col,
+            'end_col': end_col,
+            'allele_col': allele_col,
+            'segments': {},
+        }
+
+    """Adds the rows of one chromosome (in table scan order)
+    """
+    def addSegment(self, table, chrom, rows):
+        spec = self.header['tables'][table]
+        names = spec['columns']
+        si = names.index(spec['start_col'])
+        ei = names.index(spec['end_col'])
+
+        starts = np.array([int(r[si]) for r in rows], dtype=np.int64)
+        ends = np.array([int(r[ei]) for r in rows], dtype=np.int64)
+        order = np.argsort(starts, kind='stable')
+        rows = [rows[i] for i in order]
+        starts = starts[order]
+        ends = ends[order]
+        maxEnds, maxLevel = intervals.augment(starts.tolist(), ends.tolist())
+
+        segment = {'rows': len(rows), 'maxLevel': maxLevel, 'arrays': {},
+            'columns': {}}
+        segment['arrays']['_order'] = self._writeArray(order.astype(np.int64))
+        segment['arrays']['_start'] = self._writeArray(starts)
+        segment['arrays']['_end'] = self._writeArray(ends)
+        segment['arrays']['_maxEnd'] = self._writeArray(
+            np.array(maxEnds, dtype=np.int64))
+        if spec['allele_col'] is not None:
+            ai = names.index(spec['allele_col'])
+            segment['arrays']['_refCode'] = self._writeArray(np.array(
+                [self._alleleCode(r[ai]) for r in rows], dtype=np.int32))
+
+        for c, name in enumerate(names):
+            segment['columns'][name] = self._writeColumn([r[c] for r in rows])
+
+        spec['segments'][str(chrom)] = segment
+
+        owner = segmentTableOf(table, str(chrom))
+        if owner is not None:
+            t, key = owner
+            spans = self.spans.setdefault(bareChrom(key), {})
+            # A table spelling one chromosome two ways keeps the first;
+            # lookups of the other are answered by the table itself
+            if t not in spans:
+                spans[t] = (key, starts, ends, order)
+
+    """Intersects the rows of the SEGMENT_TABLES added so far into the
+       genome segmentation, one chromosome at a time
+    """
+    def addSegmentation(self):
+        chroms = {}
+        for chrom, spans in sorted(self.spans.items()):
+            bounds = np.unique(np.concatenate([np.concatenate([span[1],
+                span[2] + 1]) for span in spans.values()]))
+            keys = [None] * len(SEGMENT_TABLES)
+            members = [None] * len(SEGMENT_TABLES)
+            ids = np.zeros((len(bounds), len(SEGMENT_TABLES)), dtype=np.int32)
+            for t, (key, starts, ends, order) in spans.items():
+                ids[:, t], offsets, rows = _tableSets(bounds, starts, ends,
+                    order)
+                keys[t] = key
+                members[t] = [self._writeArray(offsets),
+                    self._writeArray(rows)]
+
+            # Neighbouring segments with the same sets are one segment
+            keep = np.ones(len(bounds), dtype=bool)
+            keep[1:] = (ids[1:] != ids[:-1]).any(axis=1)
+            bounds = bounds[keep]
+            ids = ids[keep]
+            empty = np.zeros((1, len(SEGMENT_TABLES)), dtype=np.int32)
+            combos, sets = np.unique(np.concatenate([empty, ids]), axis=0,
+                return_inverse=True)
+            sets = sets.reshape(-1)
+            chroms[chrom] = {
+                'keys': keys,
+                'members': members,
+                'empty': int(sets[0]),
+                'combos': self._writeArray(combos.reshape(-1)),
+                'arrays': {
+                    '_bounds': self._writeArray(bounds.astype(np.int64)),
+                    '_sets': self._writeArray(sets[1:].astype(np.int32)),
+                },
+            }
+        self.spans = {}
+        self.header['segmentation'] = {
+            'tables': [[name, split] for name, split in SEGMENT_TABLES],
+            'chroms': chroms,
+        }
+
+    def close(self):
+        self.header['alleles'] = sorted(self.alleles,
+            key=lambda a: self.alleles[a])
+        self.header['checksum'] = 'sha256:' + self.sha.hexdigest()
+        header = json.dumps(self.header).encode('utf-8')
+        self.fh.write(header)
+        self.fh.write(struct.pack('<Q', len(header)) + MAGIC)
+        self.fh.close()
+        os.rename(self.tmppath, self.path)
+
+
+"""Read-only view of a bundle
+   The file is memory-mapped once; every array handed out is a zero-copy
+   NumPy view onto the map, so all processes on a node share the same
+   pages of the page cache
+"""
+class Bundle(object):
+    def __init__(self, path):
+        self.path = path
+        self.fh = open(path, 'rb')
+        self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        tail = len(MAGIC) + 8
+        if (len(self.mm) < len(MAGIC) + tail or
+            self.mm[:len(MAGIC)] != MAGIC or self.mm[-len(MAGIC):] != MAGIC):
+            raise BundleError(f"'{path}' is not a reference bundle")
+        (header_len,) = struct.unpack('<Q', self.mm[-tail:-len(MAGIC)])
+        self.header_start = len(self.mm) - tail - header_len
+        self.header = json.loads(
+            self.mm[self.header_start:len(self.mm) - tail].decode('utf-8'))
+        if self.header['format'] != FORMAT_VERSION:
+            raise BundleError(f"'{path}' has bundle format " + \
+                f"{self.header['format']}, expected {FORMAT_VERSION}")
+
+        self.version = self.header['version']
+        self.checksum = self.header['checksum']
+        self.alleles = dict((a, i) for i, a in enumerate(self.header['alleles']))
+        self.tables = {}
+        self.segments = None
+
+    """Recomputes the checksum; reads the whole file
+    """
+    def verify(self):
+        sha = hashlib.sha256()
+        step = 1 << 24
+        for offset in range(0, self.header_start, step):
+            sha.update(self.mm[offset:min(offset + step, self.header_start)])
+        return ('sha256:' + sha.hexdigest()) == self.checksum
+
+    def array(self, spec):
+        dtype, offset, count = spec
+        return np.frombuffer(self.mm, dtype=np.dtype(dtype), count=count,
+            offset=offset)
+
+    """The genome segmentation, or None if the bundle was built without
+    """
+    def segmentation(self):
+        if 'segmentation' not in self.header:
+            return None
+        if self.segments is None:
+            self.segments = Segmentation(self, self.header['segmentation'])
+        return self.segments
+
+    def hasTable(self, table):
+        return table in self.header['tables']
+
+    def table(self, table):
+        if table not in self.tables:
+            if not self.hasTable(table):
+                raise BundleError(f"Table '{table}' is not in bundle '{self.path}'")
+            self.tables[table] = BundleTable(self, table,
+                self.header['tables'][table])
+        return self.tables[table]
+
+    def close(self):
+        self.tables = {}
+        self.segments = None
+        self.mm.close()
+        self.fh.close()
+
+
+class BundleTable(object):
+    def __init__(self, bundle, name, spec):
+        self.bundle = bundle
+        self.name = name
+        self.columns = spec['columns']
+        self.chrom_col = spec['chrom_col']
+        self.start_col = spec['start_col']
+        self.end_col = spec['end_col']
+        self.specs = spec['segments']
+        self.segments = {}
+
+    def chroms(self):
+        return list(self.specs)
+
+    """Segment holding the rows of chrom, or None if there are none
+    """
+    def segment(self, chrom=WHOLE_TABLE):
+        chrom = str(chrom)
+        if chrom not in self.segments:
+            spec = self.specs.get(chrom)
+            self.segments[chrom] = None if (spec is None) \
+                else BundleSegment(self, spec)
+        return self.segments[chrom]
+
+
+"""Rows of one table on one chromosome
+"""
+class BundleSegment(object):
+    def __init__(self, table, spec):
+        bundle = table.bundle
+        self.table = table
+        self.rows = spec['rows']
+        self.maxLevel = spec['maxLevel']
+        self.arrays = dict((name, bundle.array(a))
+            for name, a in spec['arrays'].items())
+        self.decoders = [self._decoder(bundle, spec['columns'][name])
+            for name in table.columns]
+        self.colindex = dict((name, i) for i, name in enumerate(table.columns))
+
+    def _decoder(self, bundle, column):
+        nulls = bundle.array(column['nulls']) if ('nulls' in column) else None
+        kind = column['type']
+
+        if kind in ['int', 'float']:
+            values = bundle.array(column['values'])
+            cast = int if (kind == 'int') else float
+            def decode(i):
+                if (nulls is not None and nulls[i]):
+                    return None
+                return cast(values[i])
+            return decode
+
+        codes = bundle.array(column['codes'])
+        offsets = bundle.array(column['offsets'])
+        start = column['data'][0]
+        mm = bundle.mm
+        def decode(i):
+            code = codes[i]
+            if code < 0:
+                return None
+            value = mm[start + offsets[code]:start + offsets[code + 1]]
+            if kind == 'bytes':
+                return value
+            value = value.decode('utf-8')
+            return Decimal(value) if (kind == 'decimal') else value
+        return decode
+
+    def __len__(self):
+        return self.rows
+
+    """Row i as a tuple in the original column order
+    """
+    def row(self, i, columns=None):
+        if columns is None:
+            return tuple(decode(i) for decode in self.decoders)
+        return tuple(self.decoders[self.colindex[c]](i) for c in columns)
+
+    """Row indices with _start <= pos <= _end, in table order
+    """
+    def overlapping(self, pos):
+        a = self.arrays
+        hits = intervals.stab(a['_start'], a['_end'], a['_maxEnd'],
+            self.maxLevel, int(pos))
+        order = a['_order']
+        return sorted(hits, key=lambda i: order[i])
+
+"""Genome segmentation of a bundle (see SEGMENT_TABLES)
+"""
+class Segmentation(object):
+    def __init__(self, bundle, spec):
+        self.bundle = bundle
+        self.tables = [name for name, split in spec['tables']]
+        self.specs = spec['chroms']
+        self.chroms = {}
+
+    """Index of table in the segmentation, or None
+    """
+    def tableIndex(self, table):
+        return self.tables.index(table) if (table in self.tables) else None
+
+    """Segments of chrom (with or without 'chr'), or None if no table has
+       rows on it
+    """
+    def chrom(self, chrom):
+        chrom = bareChrom(chrom)
+        if chrom not in self.chroms:
+            spec = self.specs.get(chrom)
+            self.chroms[chrom] = None if (spec is None) \
+                else SegmentedChrom(self.bundle, spec, len(self.tables))
+        return self.chroms[chrom]
+
+
+"""Segments of one chromosome
+   A stage resolves the set ids of a block of variants at once (setsAt);
+   they are kept on the records, so the other stages don't search again
+"""
+class SegmentedChrom(object):
+    def __init__(self, bundle, spec, tables):
+        self.keys = spec['keys']
+        self.empty = spec['empty']
+        self.bounds = bundle.array(spec['arrays']['_bounds'])
+        self.sets = bundle.array(spec['arrays']['_sets'])
+        self.combos = bundle.array(spec['combos']).reshape(-1, tables)
+        self.members = [None if (m is None) else
+            (bundle.array(m[0]), bundle.array(m[1])) for m in spec['members']]
+
+    """Id of the annotation set covering pos
+    """
+    def setAt(self, pos):
+        k = int(np.searchsorted(self.bounds, pos, side='right')) - 1
+        return self.empty if (k < 0) else int(self.sets[k])
+
+    """Ids of the annotation sets covering positions, with one search
+    """
+    def setsAt(self, positions):
+        if len(self.bounds) == 0:
+            return [self.empty] * len(positions)
+        k = np.searchsorted(self.bounds, positions, side='right') - 1
+        return np.where(k < 0, self.empty,
+            self.sets[np.maximum(k, 0)]).tolist()
+
+    """Row indices of table t in annotation set s, in table order
+    """
+    def rowsIn(self, t, s):
+        if self.members[t] is None:
+            return []
+        offsets, rows = self.members[t]
+        s = self.combos[s, t]
+        return rows[offsets[s]:offsets[s + 1]].tolist()
+
+    """Row indices of table t covering pos, in table order
+    """
+    def rowsAt(self, t, pos):
+        return self.rowsIn(t, self.setAt(pos))
+
+### EOF
@@ -0,0 +1,190 @@
+# cache.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Node-local cache of finished variant annotations, shared by all jobs
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import json
+import time
+import sqlite3
+
+import annotate as ann
+
+# Bump whenever the stages change what they write, so that entries made by
+# older code are dropped
+CACHE_SCHEMA = 1
+
+# Share of max_entries kept when the cache is trimmed
+TRIM_TO = 0.9
+
+"""INFO a record is annotated from when it goes into the cache
+   The stages only append to INFO, except that dbSNP and bigRefGene
+   rewrite an INFO of '.', so a record is annotated either from '.' (and
+   the cache holds its whole final INFO) or from ';' (and the cache holds
+   what the stages appended after it)
+"""
+CONTEXT_DOT = '.'
+CONTEXT_APPEND = ';'
+
+
+"""Persistent annotation cache, keyed by (chrom, pos, ref, alt, context)
+   and the reference version
+   Each entry holds the ID and INFO the stages produced for the variant
+   and what each stage added to its counters, so a hit needs no reference
+   lookups at all. The cache keeps at most max_entries, evicting the
+   least recently used ones, and empties itself when opened with a
+   different reference version.
+"""
+class AnnotationCache(object):
+    def __init__(self, path, version, max_entries=1000000):
+        self.path = path
+        self.version = str(CACHE_SCHEMA) + ':' + str(version)
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('pragma journal_mode=wal')
+        self.conn.execute('create table if not exists meta (' + \
+            'key text primary key, value text);')
+        self.conn.execute('create table if not exists annotations (' + \
+            'chrom text, pos text, ref text, alt text, context text, ' + \
+            'version text, entry text, used real, ' + \
+            'primary key (chrom, pos, ref, alt, context, version));')
+        self.conn.execute('create index if not exists annotations_used ' + \
+            'on annotations (used);')
+
+        row = self.conn.execute(
+            'select value from meta where key = "version";').fetchone()
+        if (row is None or row[0] != self.version):
+            self.conn.execute('delete from annotations;')
+            self.conn.execute('insert or replace into meta values ' + \
+                '("version", ?);', (self.version,))
+        self.conn.commit()
+        self.entries = self.conn.execute(
+            'select count(*) from annotations;').fetchone()[0]
+
+    """Entries for the given keys that are in the cache, by key
+       Hits are marked as used
+    """
+    def get(self, keys):
+        found = {}
+        for key in keys:
+            row = self.conn.execute('select entry from annotations where ' + \
+                'chrom=? AND pos=? AND ref=? AND alt=? AND context=? ' + \
+                'AND version=?;', key + (self.version,)).fetchone()
+            if row is not None:
+                found[key] = json.loads(row[0])
+
+        if found:
+            now = time.time()
+            self.conn.executemany('update annotations set used=? where ' + \
+                'chrom=? AND pos=? AND ref=? AND alt=? AND context=? ' + \
+                'AND version=?;', [(now,) + key + (self.version,)
+                for key in found])
+            self.conn.commit()
+        return found
+
+    def put(self, entries):
+        if not entries:
+            return
+        now = time.time()
+        self.conn.executemany('insert or replace into annotations values ' + \
+            '(?, ?, ?, ?, ?, ?, ?, ?);', [key + (self.version,
+            json.dumps(entry), now) for key, entry in entries.items()])
+        self.entries = self.entries + len(entries)
+        if self.entries > self.max_entries:
+            self._evict()
+        self.conn.commit()
+
+    """Drops the least recently used entries
+    """
+    def _evict(self):
+        self.entries = self.conn.execute(
+            'select count(*) from annotations;').fetchone()[0]
+        excess = self.entries - int(self.max_entries * TRIM_TO)
+        if excess > 0:
+            self.conn.execute('delete from annotations where rowid in ' + \
+                '(select rowid from annotations order by used limit ?);',
+                (excess,))
+            self.entries = self.entries - excess
+
+    def close(self):
+        self.conn.close()
+
+
+"""Cache key of a record, or None if it can't be cached
+   Records whose INFO could change what the stages write (one starting
+   with '.;' or already holding a positionType) are always annotated
+"""
+def recordKey(fields, inds, format='vcf'):
+    if len(fields) < 8:
+        return None
+    info = str(fields[7])
+    if info == '.':
+        context = CONTEXT_DOT
+    elif (info.startswith('.;') or 'positionType' in info):
+        return None
+    else:
+        context = CONTEXT_APPEND
+    return (fields[inds[0]].strip(), fields[inds[1]].strip(),
+        fields[inds[2]].strip(), fields[inds[3]].strip(),
+        format + context)
+
+
+"""Annotates a record from its context with annotateOne and returns the
+   cache entry for it
+"""
+def makeEntry(fields, context, annotateOne):
+    probe = fields.probe(ann.Info(context))
+    counts = annotateOne(probe)
+    info = str(probe[7])
+    info = info if (context == CONTEXT_DOT) else info[1:]
+    return {'id': probe[2], 'info': info,
+        'counts': [dict(c) for c in counts]}
+
+
+def applyEntry(fields, entry, context):
+    fields[2] = entry['id']
+    info = entry['info']
+    if context == CONTEXT_DOT:
+        fields[7] = ann.Info(info)
+    elif info.startswith(';'):
+        fields[7].append(info)
+    elif info:
+        ann.appendInfo(fields, info)
+
+
+"""Annotates records through the cache, block_size records at a time
+   annotateOne(fields) runs all stages over one record in place and
+   returns their counters; it is only called for misses. The counters of
+   hits and misses alike are added to stage_counts.
+"""
+def cachedRecords(records, cache, annotateOne, stage_counts, format='vcf',
+    block_size=1000):
+    inds = ann.getFormatSpecificIndices(format=format)
+
+    for block in ann.chunks(records, block_size):
+        keys = [recordKey(fields, inds, format=format) for fields in block]
+        entries = cache.get(set(k for k in keys if k is not None))
+        new = {}
+
+        for fields, key in zip(block, keys):
+            if key is None:
+                counts = annotateOne(fields)
+            else:
+                entry = entries.get(key) or new.get(key)
+                if entry is None:
+                    entry = new[key] = makeEntry(fields, key[-1][-1],
+                        annotateOne)
+                applyEntry(fields, entry, key[-1][-1])
+                counts = entry['counts']
+            for total, c in zip(stage_counts, counts):
+                total.update(c)
+
+        cache.put(new)
+        for fields in block:
+            yield fields
+
+### EOF
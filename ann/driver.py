@@ -12,110 +12,284 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import sys
 import os
-import file_utils as fu
+from collections import Counter
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import annotate as ann
+import utils as u
+import shards
+import sorting
+import cache as c
+import backends
+import planner
+from reference import LOOKUP_JOIN
 
-def run(infile, format):
+# Get ini configuration
+from configparser import ConfigParser
+config = ConfigParser(os.environ)
+config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'ann_config.ini'))
+
+"""Annotation stages in the order they are applied to each record:
+   (progress name, stage, stage arguments, log writer)
+"""
+STAGES = [
+    ('dbSNP', ann.dbSnpStage, {}, ann.writeDbSnpLog),
+    ('BigRefGene', ann.bigRefGeneStage, {}, None),
+    ('refGene', ann.genesStage,
+        {'table': 'refGene', 'promoter_offset': 500}, ann.writeGenesLog),
+    ('Cytoband', ann.cytobandStage, {'table': 'cytoBand'},
+        partial(ann.writeOverlapLog, table='cytoBand')),
+    ('gadAll', ann.gadAllStage, {'table': 'gadAll'},
+        partial(ann.writeOverlapLog, table='gadAll')),
+    ('GwasCatalog', ann.gwasCatalogStage, {'table': 'gwasCatalog'},
+        partial(ann.writeOverlapLog, table='gwasCatalog')),
+    ('miRNA', ann.miRNAStage, {'table': 'targetScanS'},
+        partial(ann.writeOverlapLog, table='miRNAsites')),
+    ('HUGO Gene Nomenclature Committee', ann.hugoStage, {'table': 'hugo'},
+        partial(ann.writeOverlapLog, table='hugo')),
+    ('dgv_Cnv', ann.cnvDatabaseStage, {'table': 'dgv_Cnv'},
+        partial(ann.writeOverlapLog, table='dgv_Cnv')),
+    ('abParts_IG_T_CelReceptors', ann.cnvDatabaseStage,
+        {'table': 'abParts_IG_T_CelReceptors'},
+        partial(ann.writeOverlapLog, table='abParts_IG_T_CelReceptors')),
+    ('mcCarroll_Cnv', ann.cnvDatabaseStage, {'table': 'mcCarroll_Cnv'},
+        partial(ann.writeOverlapLog, table='mcCarroll_Cnv')),
+    ('conrad_Cnv', ann.cnvDatabaseStage, {'table': 'conrad_Cnv'},
+        partial(ann.writeOverlapLog, table='conrad_Cnv')),
+    ('genomicSuperDups', ann.genomicSuperDupsStage,
+        {'table': 'genomicSuperDups'},
+        partial(ann.writeOverlapLog, table='genomicSuperDups')),
+    ('addOverlapWithTfbsConsSites', ann.tfbsConsSitesStage,
+        {'table': 'tfbsConsSites'},
+        partial(ann.writeOverlapLog, table='tfbsConsSites')),
+]
+
+"""Stages that only look up the record's position and append to INFO;
+   they don't depend on one another and can run concurrently
+"""
+INDEPENDENT_STAGES = [ann.cytobandStage, ann.gadAllStage,
+    ann.gwasCatalogStage, ann.miRNAStage, ann.hugoStage,
+    ann.cnvDatabaseStage, ann.genomicSuperDupsStage, ann.tfbsConsSitesStage]
+
+
+"""Runs the stage chain over one input file and writes its records to
+   outfile; returns the counters of every stage, in STAGES order
+   Stages are chained as generators, so each line is parsed once,
+   annotated in memory and written once. With concurrent set, each run of
+   consecutive INDEPENDENT_STAGES is fanned out over a thread pool, every
+   stage with a reference handle (and DB connection) of its own. With a
+   cache, records are looked up there first, under the reference version
+   and the backend's identity, and only misses go through the stages,
+   one record at a time. With the join lookup, the file's variants are
+   loaded into the server first; they live in the session of the main
+   connection, so stages aren't run concurrently then, and every line
+   must reach the stages, so the cache isn't used either (with a warning
+   if either was asked for)
+   stage_lookups maps stages (by progress name) to the lookup they use
+   instead of lookup; with the auto lookup and none given the file is
+   planned here
+"""
+def annotateFile(infile, outfile, format, lookup, bundle, concurrent=False,
+    cache=None, backend=None, stage_lookups=None):
+    backend = backend or backends.configured(bundle=bundle)
+    if (stage_lookups is None and lookup == planner.LOOKUP_AUTO):
+        stage_lookups = planner.plan(infile, STAGES, backend, format=format,
+            cache=cache).lookups
+    lookups = [backend.lookup((stage_lookups or {}).get(name, lookup))
+        for name, stage, kwargs, log in STAGES]
+    fh = open(infile)
+    fh_out = open(outfile, 'w')
+    bins = config['annotate'].getboolean('ReferenceBins', fallback=False)
+    version = config['annotate'].get('ReferenceVersion')
+    refdbs = []
+    executor = None
+
+    # Stages run in the chain with the same lookup share its reference
+    shared = {}
+    def sharedReference(stage_lookup):
+        if stage_lookup not in shared:
+            shared[stage_lookup] = backend.reference(lookup=stage_lookup,
+                bundle=bundle, version=version, bins=bins)
+            refdbs.append(shared[stage_lookup])
+        return shared[stage_lookup]
+
+    if LOOKUP_JOIN in lookups:
+        sharedReference(LOOKUP_JOIN).loadVariants(ann.variantKeys(infile,
+            format=format))
+        ignored = [name for name, value in [('ConcurrentStages', concurrent),
+            ('AnnotationCache', cache)] if value]
+        if ignored:
+            print("Warning: the join lookup runs without " + \
+                ' and '.join(ignored) + "; they are ignored for " + infile)
+        concurrent = False
+        cache = None
+
+    # Nothing is read until the writer starts pulling records through
+    records = ann.readRecords(fh, fh_out, format=format)
+    if cache:
+        annotations = c.AnnotationCache(cache,
+            str(sharedReference(lookups[0]).version) + '|' + \
+                backend.identity(),
+            max_entries=config['annotate'].getint('AnnotationCacheEntries',
+                fallback=1000000))
+
+        def annotateOne(fields):
+            counts = [Counter() for stage in STAGES]
+            one = iter([fields])
+            for (name, stage, kwargs, log), stage_lookup, stage_count in \
+                zip(STAGES, lookups, counts):
+                one = stage(one, sharedReference(stage_lookup), stage_count,
+                    format=format, **kwargs)
+            for fields in one:
+                pass
+            return counts
+
+        stage_counts = [Counter() for stage in STAGES]
+        records = c.cachedRecords(records, annotations, annotateOne,
+            stage_counts, format=format)
+        ann.writeRecords(records, fh_out)
+        annotations.close()
+    else:
+        group = []
+        stage_counts = []
+        for (name, stage, kwargs, log), stage_lookup in \
+            zip(STAGES + [(None, None, None, None)], lookups + [None]):
+            if (concurrent and stage in INDEPENDENT_STAGES):
+                counts = Counter()
+                stage_refdb = backend.reference(lookup=stage_lookup,
+                    bundle=bundle, version=version, bins=bins)
+                refdbs.append(stage_refdb)
+                group.append(partial(stage, refdb=stage_refdb, counts=counts,
+                    format=format, **kwargs))
+                stage_counts.append(counts)
+                continue
+
+            if group:
+                executor = executor or \
+                    ThreadPoolExecutor(max_workers=len(group))
+                records = ann.concurrentStages(records, group, executor)
+                group = []
+            if stage is None:
+                break
+
+            counts = Counter()
+            records = stage(records, sharedReference(stage_lookup), counts,
+                format=format, **kwargs)
+            stage_counts.append(counts)
+
+        ann.writeRecords(records, fh_out)
+
+    if executor is not None:
+        executor.shutdown()
+    for stage_refdb in refdbs:
+        stage_refdb.close()
+    fh.close()
+    fh_out.close()
+    return stage_counts
+
+
+"""Annotates infile shard by shard in a pool of worker processes
+   Shards are planned by chromosome (large chromosomes are cut into
+   position ranges, small ones share shards), annotated concurrently,
+   merged back in the original line order and their counters summed
+"""
+def annotateSharded(infile, outfile, format, lookup, bundle, workers,
+    concurrent=False, cache=None, backend=None, stage_lookups=None):
+    plan = shards.planShards(infile, workers, format=format)
+    inputs, layout, headers = shards.splitShards(infile, plan, format=format)
+    outputs = [shards.shardPaths(infile, k)[1] for k in range(len(inputs))]
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # Largest shards first, so stragglers don't hold up the job
+            order = sorted(range(len(inputs)),
+                key=lambda k: -os.path.getsize(inputs[k]))
+            futures = dict((k, executor.submit(annotateFile, inputs[k],
+                outputs[k], format, lookup, bundle, concurrent, cache,
+                backend, stage_lookups))
+                for k in order)
+            results = [futures[k].result() for k in range(len(inputs))]
+
+        shards.mergeShards(outfile, outputs, layout, headers)
+    finally:
+        shards.removeShards(inputs + outputs)
+
+    stage_counts = [Counter() for stage in STAGES]
+    for shard_counts in results:
+        for total, counts in zip(stage_counts, shard_counts):
+            total.update(counts)
+    return stage_counts
+
+
+"""Annotates infile into .annot.vcf and writes the stage counts to
+   .count.log
+   lookup, bundle, backend, workers, concurrent, cache, sort and
+   sorted_output override the ReferenceLookup, ReferenceBundle,
+   ReferenceBackend, Workers, ConcurrentStages, AnnotationCache, SortInput
+   and SortedOutput settings in ann_config.ini; with more than one worker
+   the file is annotated in parallel shards. With sort, records are
+   annotated sorted by (chrom, pos) and written back in their original
+   order unless sorted_output is set. With the auto lookup every stage
+   gets the lookup planner.plan estimates cheapest for the job, and the
+   plan is appended to .count.log
+"""
+def run(infile, format, lookup=None, bundle=None, workers=None,
+    concurrent=None, cache=None, sort=None, sorted_output=None, backend=None):
 
     print("Running . . .")
+    lookup = lookup or config['annotate']['ReferenceLookup']
+    bundle = bundle or config['annotate'].get('ReferenceBundle') or None
+    backend = backends.configured(backend, bundle=bundle)
+    workers = int(workers or config['annotate'].get('Workers', 1))
+    if concurrent is None:
+        concurrent = config['annotate'].getboolean('ConcurrentStages',
+            fallback=False)
+    cache = cache or config['annotate'].get('AnnotationCache') or None
+    if sort is None:
+        sort = config['annotate'].getboolean('SortInput', fallback=False)
+    if sorted_output is None:
+        sorted_output = config['annotate'].getboolean('SortedOutput',
+            fallback=False)
+
+    finalout = (infile + '.annot').replace('.vcf.annot', '.annot.vcf')
+    source = infile
+    output = finalout
+    if sort:
+        # Spill files, the sorted input and its annotation stay in the
+        # job directory next to infile
+        source = infile + '.sorted'
+        output = source + '.annot'
+        sorting.sortFile(infile, source, infile + '.perm', format=format)
+
+    plan = None
+    if lookup == planner.LOOKUP_AUTO:
+        plan = planner.plan(source, STAGES, backend, format=format,
+            cache=cache)
+
+    stage_lookups = plan.lookups if plan else None
+    if workers > 1:
+        stage_counts = annotateSharded(source, output, format, lookup,
+            bundle, workers, concurrent=concurrent, cache=cache,
+            backend=backend, stage_lookups=stage_lookups)
+    else:
+        stage_counts = annotateFile(source, output, format, lookup, bundle,
+            concurrent=concurrent, cache=cache, backend=backend,
+            stage_lookups=stage_lookups)
+
+    if sort:
+        if sorted_output:
+            os.replace(output, finalout)
+        else:
+            sorting.restoreOrder(output, infile + '.perm', finalout)
+        shards.removeShards([source, output, infile + '.perm'])
+
+    fh_log = open(infile + '.count.log', 'w')
+    for (name, stage, kwargs, log), counts in zip(STAGES, stage_counts):
+        if log is not None:
+            log(fh_log, counts)
+        print(f"{name} - done.")
+    if plan is not None:
+        plan.write(fh_log)
+    fh_log.close()
 
-    ann.getSnpsFromDbSnp(vcf=infile, format='vcf', tmpextin='', 
-        tmpextout='.1')
-    print("dbSNP - done.")
-    tmpextin = 1
-    tmpextout = 2
-
-    ann.getBigRefGene(vcf=infile, format='vcf', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.getGenes(vcf=infile, format='vcf', table='refGene', 
-        promoter_offset=500, tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCytoband(vcf=infile, format='vcf', table='cytoBand', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("Cytoband - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGadAll(vcf=infile, format='vcf', table='gadAll', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("gadAll - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGwasCatalog(vcf=infile, format='vcf', 
-        table='gwasCatalog', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("GwasCatalog - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithMiRNA(vcf=infile, format='vcf', table='targetScanS', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("miRNA - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWitHUGOGeneNomenclature(vcf=infile, format='vcf', 
-        table='hugo', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("HUGO Gene Nomenclature Committee - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='dgv_Cnv', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("dgv_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='abParts_IG_T_CelReceptors', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("abParts_IG_T_CelReceptors - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='mcCarroll_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("mcCarroll_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='conrad_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("conrad_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGenomicSuperDups(vcf=infile, format='vcf', 
-        table='genomicSuperDups', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("genomicSuperDups - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithTfbsConsSites(vcf=infile, table='tfbsConsSites',
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("addOverlapWithTfbsConsSites - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ## Cleanup
-    for i in range(1, tmpextin):
-        fu.delete(infile + '.' + str(i))
-
-    os.rename(infile + '.' + str(tmpextin), infile + '.annot')
-    finalout=(infile + '.annot').replace('.vcf.annot', '.annot.vcf')
-    os.rename(infile + '.annot', finalout)
-
-### EOF
\ No newline at end of file
+### EOF
@@ -0,0 +1,74 @@
+# fragments.py
+#
+# Original code by: Vlad Makarov, Chris Yoon
+# Original copyright (c) 2011, The Mount Sinai School of Medicine
+# Available under BSD licence
+#
+# Modified code copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# INFO fragments rendered from reference rows
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import sys
+
+# refGene columns, as collapseGeneNames names them
+REFGENE_COLUMNS = ['bin', 'name', 'chrom', 'transcriptStrand', 'txStart',
+    'txEnd', 'cdsStart', 'cdsEnd', 'exonCount', 'exonStarts', 'exonEnds',
+    'score', 'name2', 'cdsStartStat', 'cdsEndStat', 'exonFrames']
+
+# refGene columns named in the gene annotations: name2, name, strand
+KNOWN_GENE_INDICES = [12, 1, 3]
+
+# bigRefGene columns after the first, as collapseRefSeq names them
+REFSEQ_COLUMNS = ['chr', 'start', 'end', 'haplotypeReference',
+    'haplotypeAlternate', 'name', 'name2', 'transcriptStrand',
+    'positionType', 'frame', 'mrnaCoord', 'codonCoord', 'spliceDist',
+    'referenceCodon', 'referenceAA', 'variantCodon', 'variantAA',
+    'changesAA', 'functionalClass','codingCoordStr','proteinCoordStr',
+    'inCodingRegion', 'spliceInfo','uorfChange']
+
+
+"""The 'name2=..;name=..;transcriptStrand=..' part of a refGene row's gene
+   annotation (its non-empty columns at indices), interned
+"""
+def geneNames(row, indices=KNOWN_GENE_INDICES):
+    collapsed = []
+    for i in indices:
+        r = str(row[i])
+        if (len(r) > 0):
+            collapsed.append(REFGENE_COLUMNS[i] + '=' + r.strip())
+    return sys.intern(';'.join(collapsed))
+
+
+def collapseGeneNames(row, indices, region, cnt):
+    names = geneNames(row, indices)
+    return (names + ';' + region) if names else region
+
+
+""""Collapces bigRefSegTable
+"""
+def collapseRefSeq(line):
+    fields = line.strip().split('\t')
+    fcount = 0
+    collapsed = []
+
+    for f in fields:
+        if (fcount > 4):
+            if(len(str(f)) > 0 and str(f) !='0'):
+                collapsed.append(str(REFSEQ_COLUMNS[fcount]).strip() + \
+                    '=' + str(f).strip())
+        fcount = fcount + 1
+
+    return  ';'.join(collapsed)
+
+
+"""The bigRefGene annotation of a row of chrom_pos_equal_base,
+   chrom_pos_equal_nobase or chrom_pos_unequal, interned
+"""
+def refSeq(row):
+    return sys.intern(collapseRefSeq('\t'.join([str(x) for x in row[1:]])))
+
+### EOF
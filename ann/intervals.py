@@ -0,0 +1,206 @@
+# intervals.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Static interval index answering "which ranges cover this position"
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+from heapq import heappush, heappop
+
+import numpy as np
+
+
+"""Computes the max-end augmentation of intervals sorted by start
+
+   The sorted intervals are laid out as an implicit balanced binary tree
+   (the layout used by cgranges): the node at index i on level k has k
+   trailing one bits, and maxEnds[i] holds the largest end in its
+   subtree. Returns (maxEnds, maxLevel).
+"""
+def augment(starts, ends):
+    n = len(starts)
+    maxEnds = list(ends)
+    if n == 0:
+        return (maxEnds, -1)
+
+    # Leaves (even indices) keep their own end
+    last_i = 0
+    last = 0
+    for i in range(0, n, 2):
+        last_i = i
+        last = ends[i]
+
+    k = 1
+    while (1 << k) <= n:
+        x = 1 << (k - 1)
+        for i in range((x << 1) - 1, n, x << 2):
+            el = maxEnds[i - x]
+            er = maxEnds[i + x] if (i + x < n) else last
+            maxEnds[i] = max(ends[i], el, er)
+        # Track the max end of the rightmost, partially filled subtree
+        last_i = last_i - x if ((last_i >> k) & 1) else last_i + x
+        if (last_i < n and maxEnds[last_i] > last):
+            last = maxEnds[last_i]
+        k = k + 1
+
+    return (maxEnds, k - 1)
+
+
+"""Indices of all intervals with start <= pos <= end
+
+   Works on anything indexable (lists or NumPy arrays, including ones
+   backed by a memory map). Subtrees whose maxEnd lies left of pos and
+   nodes starting right of it are pruned, so a query costs O(log n + k)
+   for k hits.
+"""
+def stab(starts, ends, maxEnds, maxLevel, pos):
+    n = len(starts)
+    if n == 0:
+        return []
+
+    hits = []
+    stack = [(maxLevel, (1 << maxLevel) - 1, False)]
+    while stack:
+        k, x, leftDone = stack.pop()
+        if k <= 3:
+            # Small subtree: a linear scan is cheaper than descending
+            i0 = (x >> k) << k
+            i1 = min(i0 + (1 << (k + 1)) - 1, n)
+            for i in range(i0, i1):
+                if starts[i] > pos:
+                    break
+                if pos <= ends[i]:
+                    hits.append(i)
+        elif not leftDone:
+            stack.append((k, x, True))
+            y = x - (1 << (k - 1))
+            if (y >= n or maxEnds[y] >= pos):
+                stack.append((k - 1, y, False))
+        elif (x < n and starts[x] <= pos):
+            if pos <= ends[x]:
+                hits.append(x)
+            stack.append((k - 1, x + (1 << (k - 1)), False))
+
+    return hits
+
+
+"""Interval index over closed ranges [start, end] of one chromosome
+   Payloads come back in insertion order
+"""
+class IntervalIndex(object):
+    def __init__(self, intervals):
+        # intervals: iterable of (start, end, payload)
+        items = sorted((int(s), int(e), order, p)
+            for order, (s, e, p) in enumerate(intervals))
+        self.starts = [it[0] for it in items]
+        self.ends = [it[1] for it in items]
+        self.order = [it[2] for it in items]
+        self.payloads = [it[3] for it in items]
+        self.maxEnds, self.maxLevel = augment(self.starts, self.ends)
+
+    def __len__(self):
+        return len(self.starts)
+
+    """Payloads of all intervals covering pos, in insertion order
+    """
+    def overlapping(self, pos):
+        order = self.order
+        payloads = self.payloads
+        hits = stab(self.starts, self.ends, self.maxEnds, self.maxLevel,
+            int(pos))
+        return [payloads[i] for i in sorted(hits, key=lambda i: order[i])]
+
+"""Sweep over the intervals of one chromosome for ascending positions
+   starts, ends and order (table order) are indexable and sorted by start,
+   like the arrays of IntervalIndex or of a bundle segment. Intervals are
+   pushed on a min-heap by end as the sweep passes their start and popped
+   once it passes their end, so a whole chromosome is merged in
+   O(n + m log k) with only the k active intervals held.
+"""
+class IntervalSweep(object):
+    def __init__(self, starts, ends, order):
+        self.starts = starts
+        self.ends = ends
+        self.order = order
+        self.next = 0
+        self.active = []
+        self.pos = None
+
+    """Indices of all intervals covering pos, in table order, or None if
+       pos lies behind the sweep
+    """
+    def advance(self, pos):
+        if (self.pos is not None and pos < self.pos):
+            return None
+        self.pos = pos
+
+        starts = self.starts
+        active = self.active
+        n = len(starts)
+        while (self.next < n and starts[self.next] <= pos):
+            i = self.next
+            heappush(active, (int(self.ends[i]), int(self.order[i]), i))
+            self.next = i + 1
+        while (active and active[0][0] < pos):
+            heappop(active)
+        return [i for end, order, i in sorted(active, key=lambda a: a[1])]
+
+"""Interval index answering a whole block of positions with NumPy
+   Intervals are split into classes by length (powers of two). Within a
+   class, an interval covering pos starts in [pos - longest, pos], so two
+   np.searchsorted calls give each position a short run of candidates,
+   which are expanded and checked against the ends in one vectorised
+   step. Long intervals (CNVs) thus don't widen the runs of short ones.
+"""
+class BlockIndex(object):
+    def __init__(self, starts, ends, order):
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        self.order = np.asarray(order, dtype=np.int64)
+        lengths = np.maximum(ends - starts, 0)
+        classes = np.zeros(len(lengths), dtype=np.int64)
+        nonzero = lengths > 0
+        classes[nonzero] = np.floor(np.log2(lengths[nonzero])).astype(
+            np.int64) + 1
+
+        self.classes = []
+        for c in np.unique(classes).tolist():
+            ids = np.flatnonzero(classes == c)
+            ids = ids[np.argsort(starts[ids], kind='stable')]
+            self.classes.append((starts[ids], ends[ids], ids,
+                int(lengths[ids].max())))
+
+    """Pairs (query, interval) of every interval covering every query
+       position, as two index arrays ordered by query and then by table
+       order
+    """
+    def stab(self, positions):
+        positions = np.asarray(positions, dtype=np.int64)
+        queries = []
+        found = []
+        for starts, ends, ids, longest in self.classes:
+            lo = np.searchsorted(starts, positions - longest, side='left')
+            hi = np.searchsorted(starts, positions, side='right')
+            counts = hi - lo
+            total = int(counts.sum())
+            if total == 0:
+                continue
+            q = np.repeat(np.arange(len(positions)), counts)
+            firsts = np.cumsum(counts) - counts
+            candidates = np.repeat(lo - firsts, counts) + np.arange(total)
+            hit = ends[candidates] >= positions[q]
+            queries.append(q[hit])
+            found.append(ids[candidates[hit]])
+
+        if not queries:
+            empty = np.zeros(0, dtype=np.int64)
+            return (empty, empty)
+        queries = np.concatenate(queries)
+        found = np.concatenate(found)
+        ordered = np.lexsort((self.order[found], queries))
+        return (queries[ordered], found[ordered])
+
+### EOF
@@ -0,0 +1,291 @@
+# planner.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Chooses the reference lookup of every annotation stage of a job from
+# the shape of its input and the size of the reference tables
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import bundle as b
+import shards
+import annotate as ann
+import statements as st
+from backends import BACKEND_MYSQL, BACKEND_SQLITE, BACKEND_MEMORY, \
+    BACKEND_BUNDLE
+from reference import LOOKUP_SQL, LOOKUP_BATCH, LOOKUP_INDEX, LOOKUP_SWEEP, \
+    LOOKUP_BUNDLE, LOOKUP_SEGMENTS, BATCH_SIZE, openBundle
+
+# ReferenceLookup that has the planner choose per stage
+LOOKUP_AUTO = 'auto'
+
+# hg19 chromosome lengths: the share of a table's rows a chromosome is
+# assumed to hold when the table's statistics have no breakdown, and the
+# share of it a job's variants span
+CHROM_LENGTHS = {'1': 249250621, '2': 243199373, '3': 198022430,
+    '4': 191154276, '5': 180915260, '6': 171115067, '7': 159138663,
+    '8': 146364022, '9': 141213431, '10': 135534747, '11': 135006516,
+    '12': 133851895, '13': 115169878, '14': 107349540, '15': 102531392,
+    '16': 90354753, '17': 81195210, '18': 78077248, '19': 59128983,
+    '20': 63025520, '21': 48129895, '22': 51304566, 'X': 155270560,
+    'Y': 59373566, 'M': 16571, 'MT': 16569}
+GENOME_LENGTH = sum(CHROM_LENGTHS.values())
+
+# Estimated seconds per SQL round trip, by backend
+QUERY_SECONDS = {BACKEND_MYSQL: 5e-4, BACKEND_SQLITE: 5e-5,
+    BACKEND_MEMORY: 2e-5}
+# Estimated seconds per row fetched from SQL and indexed
+ROW_SECONDS = 3e-6
+# Estimated seconds per lookup in an in-memory index
+PROBE_SECONDS = 2e-6
+# Estimated seconds per variant or row a sweep passes
+SWEEP_SECONDS = 1e-6
+# Estimated seconds per lookup in a bundle, and in its segmentation
+BUNDLE_SECONDS = 4e-6
+SEGMENT_SECONDS = 1.5e-6
+
+"""Reference tables each stage reads, by progress name in driver.STAGES;
+   the other stages read the table in their arguments
+"""
+STAGE_TABLES = {
+    'dbSNP': ['dbSNP'],
+    'BigRefGene': ['chrom_pos_equal_base', 'chrom_pos_equal_nobase',
+        'chrom_pos_unequal'],
+}
+
+# Stages that don't read range tables; sweeps and segmentations don't
+# serve them
+POINT_STAGES = ['dbSNP', 'BigRefGene', 'refGene']
+
+# Costs the plan leaves out, the same whichever lookups it picks; noted
+# in the plan written to .count.log
+UNCOSTED = ['cpgIslandExt index the refGene stage preloads for promoters']
+
+# Tables looked up at exact positions: a batch fetches only the rows it
+# matches
+POINT_TABLES = ['dbSNP', 'chrom_pos_equal_base', 'chrom_pos_equal_nobase']
+
+# Table statistics gathered by this process: (backend, database, bundle,
+# table) -> (rows by chromosome, or None, and total rows if not)
+statistics = {}
+
+
+"""Shape of a job's input: variants and the lowest and highest position
+   per chromosome (as the bundle keys them, without 'chr') and whether
+   the records are sorted the way the sweep and batch lookups need them:
+   every chromosome in one run, positions ascending within it, whatever
+   the order of the chromosomes (chr1, chr10, chr2 ... will do)
+"""
+class InputStats(object):
+    def __init__(self):
+        self.total = 0
+        self.counts = {}
+        self.lo = {}
+        self.hi = {}
+        self.sorted = True
+
+    """Fraction of chrom the variants on it span
+    """
+    def covered(self, chrom):
+        length = CHROM_LENGTHS.get(chrom)
+        if not length:
+            return 1.0
+        return min(1.0, (self.hi[chrom] - self.lo[chrom] + 1) / float(length))
+
+
+def _position(value):
+    try:
+        return int(value)
+    except ValueError:
+        return 0
+
+
+"""Counts the records of infile in one pass
+"""
+def inputStats(infile, format='vcf', sep='\t'):
+    inds = ann.getFormatSpecificIndices(format=format)
+    stats = InputStats()
+    last = None
+
+    fh = open(infile)
+    for line in fh:
+        line = line.strip()
+        if shards.isHeader(line):
+            continue
+        fields = line.split(sep, inds[1] + 1)
+        chrom = b.bareChrom(fields[inds[0]].strip())
+        pos = _position(fields[inds[1]]) if (len(fields) > inds[1]) else 0
+
+        if last is None:
+            pass
+        elif chrom == last[0]:
+            if pos < last[1]:
+                stats.sorted = False
+        elif chrom in stats.counts:
+            # Back on a chromosome whose run has ended
+            stats.sorted = False
+        last = (chrom, pos)
+        stats.total += 1
+        if chrom in stats.counts:
+            stats.counts[chrom] += 1
+            stats.lo[chrom] = min(stats.lo[chrom], pos)
+            stats.hi[chrom] = max(stats.hi[chrom], pos)
+        else:
+            stats.counts[chrom] = 1
+            stats.lo[chrom] = pos
+            stats.hi[chrom] = pos
+    fh.close()
+    return stats
+
+
+"""Rows of table on chrom (without 'chr'; the whole table if split, one
+   of tfbsConsSites1..22, X, Y): exact from the bundle if it has the table,
+   else the table's row count spread over the chromosomes by length.
+   Counted once per process
+"""
+def tableRows(backend, bundle, table, chrom, split=False):
+    key = (backend.name, getattr(backend, 'path', None), backend.bundle, table)
+    if key not in statistics:
+        if (bundle is not None and bundle.hasTable(table)):
+            specs = bundle.table(table).specs
+            statistics[key] = (dict((b.bareChrom(c), spec['rows'])
+                for c, spec in specs.items()), None)
+        else:
+            statistics[key] = (None, _countRows(backend, table))
+    rows, total = statistics[key]
+    if rows is not None:
+        return rows.get(b.WHOLE_TABLE if split else chrom, 0)
+    if split:
+        return total
+    return total * CHROM_LENGTHS.get(chrom, 0) / float(GENOME_LENGTH)
+
+
+"""Approximate rows of table: the server's statistics in MySQL, the
+   largest rowid in SQLite (whose copies are only ever appended to)
+"""
+def _countRows(backend, table):
+    conn = backend.connect()
+    if conn is None:
+        return 0
+    cursor = conn.cursor()
+    try:
+        if st.placeholder(cursor) == '?':
+            cursor.execute('select max(rowid) from ' + table + ';')
+        else:
+            cursor.execute('select table_rows from information_schema.' + \
+                'tables where table_schema = database() AND ' + \
+                'table_name = %s;', [table])
+        row = cursor.fetchone()
+        return int(row[0] or 0) if row else 0
+    finally:
+        conn.close()
+
+
+"""Estimated seconds to look up n variants on one chromosome in a table
+   holding rows there with lookup; the variants span covered of the
+   chromosome, and come in batches of its own if the input is sorted
+"""
+def lookupCost(lookup, n, rows, covered, stats, point, query):
+    if lookup == LOOKUP_SQL:
+        return n * (query + PROBE_SECONDS)
+    if lookup == LOOKUP_BATCH:
+        # A batch of an unsorted input spans every variant of the
+        # chromosome, and there is one per block of the whole input
+        batches = -(-n // BATCH_SIZE) if stats.sorted else \
+            min(n, -(-stats.total // BATCH_SIZE))
+        fetched = 0 if point else (rows * covered * \
+            (1 if stats.sorted else batches))
+        return batches * query + fetched * ROW_SECONDS + n * PROBE_SECONDS
+    if lookup == LOOKUP_INDEX:
+        return query + rows * ROW_SECONDS + n * PROBE_SECONDS
+    if lookup == LOOKUP_SWEEP:
+        load = 0 if (query is None) else (query + rows * ROW_SECONDS)
+        return load + (n + rows) * SWEEP_SECONDS
+    if lookup == LOOKUP_BUNDLE:
+        return n * BUNDLE_SECONDS
+    if lookup == LOOKUP_SEGMENTS:
+        return n * SEGMENT_SECONDS
+    raise ValueError(f"No cost model for lookup '{lookup}'")
+
+
+"""Lookups a stage can be planned with
+   Batches need the records to pass the stages together, which they don't
+   behind an annotation cache; sweeps are only worth it on sorted input
+   (they give up at the first record out of order); segmentations need a
+   bundle that has one
+"""
+def candidates(backend, bundle, stats, name, cache=None):
+    found = []
+    if backend.name != BACKEND_BUNDLE:
+        found = [LOOKUP_SQL, LOOKUP_INDEX] if cache else \
+            [LOOKUP_SQL, LOOKUP_BATCH, LOOKUP_INDEX]
+    if bundle is not None:
+        found.append(LOOKUP_BUNDLE)
+    if name not in POINT_STAGES:
+        if stats.sorted:
+            found.append(LOOKUP_SWEEP)
+        if (bundle is not None and bundle.segmentation() is not None):
+            found.append(LOOKUP_SEGMENTS)
+    return found
+
+
+"""Lookup chosen for every stage of a job, the estimated cost of each
+   candidate and the input statistics they were estimated from
+"""
+class Plan(object):
+    def __init__(self, stats):
+        self.stats = stats
+        self.lookups = {}
+        self.costs = {}
+
+    """Appends the plan to a job's .count.log
+    """
+    def write(self, fh_log):
+        fh_log.write(f"Lookup plan: {str(self.stats.total)} variants on " + \
+            f"{str(len(self.stats.counts))} chromosomes, " + \
+            ('sorted' if self.stats.sorted else 'unsorted') + "\n")
+        for name, lookup in self.lookups.items():
+            fh_log.write(f"{name}: {lookup} (" + ', '.join([c + ' ' + \
+                f"{cost:.3f} s" for c, cost in self.costs[name]]) + ")\n")
+        for cost in UNCOSTED:
+            fh_log.write(f"Not costed: {cost}\n")
+
+
+"""Plans the stages, driver.STAGES, of annotating infile over backend
+   (behind the annotation cache if one is given)
+   Every stage gets the candidate lookup with the lowest estimated cost,
+   summed over the tables it reads and the chromosomes of the input
+"""
+def plan(infile, stages, backend, format='vcf', cache=None):
+    stats = inputStats(infile, format=format)
+    bundle = openBundle(backend.bundle) if backend.bundle else None
+    query = QUERY_SECONDS.get(backend.name)
+    result = Plan(stats)
+
+    for name, stage, kwargs, log in stages:
+        tables = STAGE_TABLES.get(name) or [kwargs['table']]
+        split = (kwargs.get('table') == 'tfbsConsSites')
+        costs = []
+        for lookup in candidates(backend, bundle, stats, name, cache=cache):
+            cost = 0.0
+            for table in tables:
+                for chrom, n in stats.counts.items():
+                    if split:
+                        if chrom not in b.TFBS_CHROMS:
+                            continue
+                        count = tableRows(backend, bundle, table + chrom,
+                            chrom, split=True)
+                    else:
+                        count = tableRows(backend, bundle, table, chrom)
+                    cost += lookupCost(lookup, n, count,
+                        stats.covered(chrom), stats, table in POINT_TABLES,
+                        None if (bundle is not None and
+                        lookup == LOOKUP_SWEEP) else query)
+            costs.append((lookup, cost))
+        result.costs[name] = costs
+        result.lookups[name] = min(costs, key=lambda c: c[1])[0]
+    return result
+
+### EOF
@@ -0,0 +1,1325 @@
+# reference.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Access to the annotator reference tables used by the annotation stages
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import time
+import threading
+from collections import deque
+
+import numpy as np
+
+from intervals import IntervalIndex, IntervalSweep, BlockIndex
+from transcripts import Transcript
+import fragments
+import bundle as b
+import bins as bn
+import statements as st
+
+LOOKUP_SQL = 'sql'
+LOOKUP_INDEX = 'index'
+LOOKUP_BUNDLE = 'bundle'
+LOOKUP_BATCH = 'batch'
+LOOKUP_JOIN = 'join'
+LOOKUP_SWEEP = 'sweep'
+LOOKUP_COLUMNAR = 'columnar'
+LOOKUP_SEGMENTS = 'segments'
+LOOKUPS = [LOOKUP_SQL, LOOKUP_INDEX, LOOKUP_BUNDLE, LOOKUP_BATCH,
+    LOOKUP_JOIN, LOOKUP_SWEEP, LOOKUP_COLUMNAR, LOOKUP_SEGMENTS]
+
+# Variants per batched query (LOOKUP_BATCH): the size starts at BATCH_SIZE
+# and is doubled or halved, within BATCH_MIN..BATCH_MAX, to keep each
+# query near BATCH_LATENCY seconds
+BATCH_SIZE = 500
+BATCH_MIN = 50
+BATCH_MAX = 20000
+BATCH_LATENCY = 0.1
+
+# Records per block in LOOKUP_COLUMNAR
+BLOCK_SIZE = 10000
+
+# Records whose segments LOOKUP_SEGMENTS resolves at once
+SEGMENT_BLOCK = 1000
+# Held while records are resolved, so stages running side by side on a
+# block leave it to the first of them
+_segments_lock = threading.Lock()
+
+# Lines of the job each server-side join (LOOKUP_JOIN) returns per query
+JOIN_PAGE = 50000
+# Rows per executemany when the job's variants are loaded
+JOIN_LOAD_ROWS = 5000
+
+# Bundles opened by this process, by path
+bundles = {}
+
+# Compiled transcript indices, by (reference version, table,
+# promoter offset, chrom)
+transcriptIndices = {}
+
+
+"""Opens a reference bundle once per process
+"""
+def openBundle(path):
+    if path not in bundles:
+        bundles[path] = b.Bundle(path)
+    return bundles[path]
+
+
+"""Batch size that follows the measured latency of the batched queries
+"""
+class AdaptiveBatch(object):
+    def __init__(self, size=BATCH_SIZE, latency=BATCH_LATENCY):
+        self.size = size
+        self.latency = latency
+
+    def update(self, seconds):
+        if seconds < self.latency / 2:
+            self.size = min(self.size * 2, BATCH_MAX)
+        elif seconds > self.latency * 2:
+            self.size = max(self.size // 2, BATCH_MIN)
+
+    """Splits items into runs of at most size items, ordered by key
+    """
+    def split(self, items, key):
+        items = sorted(items, key=key)
+        i = 0
+        while i < len(items):
+            size = self.size
+            yield items[i:i + size]
+            i = i + size
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+"""(True, bin parameters) for a lookup of [lo, hi] in a binned table
+   that can be restricted by bin, else (False, [])
+"""
+def _bins(binned, lo, hi):
+    if (binned and _int(lo) is not None and _int(hi) is not None):
+        params = st.binParams(_int(lo), _int(hi))
+        if params is not None:
+            return (True, params)
+    return (False, [])
+
+
+"""Whether lookups of table (tfbsConsSites1 standing for a split table)
+   are restricted by bin: bins is set, the columns are binned (see
+   bins.isBinned) and the table has a bin column. Tables without one are
+   looked up unrestricted
+"""
+def _binned(cursor, bins, table, start_col, end_col, split=False):
+    if not (bins and bn.isBinned(table, start_col, end_col)):
+        return False
+    cursor.execute('select * from ' + \
+        (table + b.TFBS_CHROMS[0] if split else table) + ' where 1 = 0;')
+    cursor.fetchall()
+    return 'bin' in [d[0] for d in cursor.description]
+
+
+"""Range table answering chromStart <= pos <= chromEnd with one SQL
+   query per variant
+   If split is set, the table is stored as one table per chromosome
+   (e.g. tfbsConsSites1..22) and the chromosome is appended to its name
+   With bins set, lookups of tables in bins.BIN_TABLES are restricted to
+   the UCSC bins that can hold the position, so the server can use the
+   (bin, chrom) index instead of scanning the chromosome
+   Queries are the parameterized statements of statements.py, selecting
+   columns
+"""
+class SqlRangeTable(object):
+    def __init__(self, conn, table, chrom_col='chrom', start_col='chromStart',
+        end_col='chromEnd', columns='*', split=False, bins=False):
+        self.conn = conn
+        self.table = table
+        self.chrom_col = chrom_col
+        self.start_col = start_col
+        self.end_col = end_col
+        self.columns = columns
+        self.split = split
+        self.cursor = conn.cursor()
+        self.binned = _binned(self.cursor, bins, table, start_col, end_col,
+            split=split)
+
+    """Table holding the rows of chrom, its chrom column and the
+       parameters that name chrom in lookups of it
+    """
+    def _table(self, chrom):
+        if self.split:
+            return (self.table + str(chrom), None, [])
+        return (self.table, self.chrom_col, [str(chrom)])
+
+    """Statement and parameters fetching the rows that overlap [lo, hi]
+    """
+    def _window(self, chrom, lo, hi, bounds=False):
+        table, chrom_col, params = self._table(chrom)
+        binned, bins = _bins(self.binned, lo, hi)
+        return (st.rangeRows(self.cursor, table, chrom_col, self.start_col,
+            self.end_col, columns=self.columns, bounds=bounds,
+            binned=binned), params + bins + [hi, lo])
+
+    def overlapping(self, chrom, pos):
+        self.cursor.execute(*self._window(chrom, pos, pos))
+        return list(self.cursor.fetchall())
+
+
+"""Range table held in memory as one interval index per chromosome
+   Each chromosome is loaded with a single query the first time it is
+   asked for and kept for the lifetime of the table
+"""
+class IndexedRangeTable(SqlRangeTable):
+    def __init__(self, conn, table, chrom_col='chrom', start_col='chromStart',
+        end_col='chromEnd', columns='*', split=False, bins=False):
+        SqlRangeTable.__init__(self, conn, table, chrom_col=chrom_col,
+            start_col=start_col, end_col=end_col, columns=columns,
+            split=split, bins=bins)
+        self.indices = {}
+
+    def _load(self, chrom):
+        table, chrom_col, params = self._table(chrom)
+        self.cursor.execute(st.rangeRows(self.cursor, table, chrom_col,
+            self.start_col, self.end_col, columns=self.columns, bounds=True,
+            window=False), params)
+        return IntervalIndex((row[-2], row[-1], tuple(row[:-2]))
+            for row in self.cursor.fetchall())
+
+    def _index(self, chrom):
+        index = self.indices.get(chrom)
+        if index is None:
+            index = self.indices[chrom] = self._load(chrom)
+        return index
+
+    def overlapping(self, chrom, pos):
+        return self._index(chrom).overlapping(pos)
+
+    """Rows of chrom as (starts, ends, table order, row of interval i),
+       sorted by start
+    """
+    def view(self, chrom):
+        index = self._index(chrom)
+        return (index.starts, index.ends, index.order,
+            index.payloads.__getitem__)
+
+    def release(self, chrom):
+        self.indices.pop(chrom, None)
+
+
+"""Range table for data that has to stay in the database, queried one
+   batch of variants at a time
+   prefetch() fetches every row covering the [min, max] window of a batch
+   of positions on one chromosome with one query and indexes it; lookups
+   inside the window are answered from that index, anything else falls
+   back to a query per variant
+"""
+class BatchRangeTable(IndexedRangeTable):
+    def __init__(self, conn, table, chrom_col='chrom', start_col='chromStart',
+        end_col='chromEnd', columns='*', split=False, bins=False):
+        IndexedRangeTable.__init__(self, conn, table, chrom_col=chrom_col,
+            start_col=start_col, end_col=end_col, columns=columns,
+            split=split, bins=bins)
+        self.batch = AdaptiveBatch()
+
+    def prefetch(self, chrom, positions):
+        positions = [p for p in (_int(p) for p in positions) if p is not None]
+        if not positions:
+            return
+        lo = min(positions)
+        hi = max(positions)
+
+        started = time.time()
+        self.cursor.execute(*self._window(chrom, lo, hi, bounds=True))
+        rows = self.cursor.fetchall()
+        self.batch.update(time.time() - started)
+        self.indices[chrom] = (lo, hi, IntervalIndex(
+            (row[-2], row[-1], tuple(row[:-2])) for row in rows))
+
+    def overlapping(self, chrom, pos):
+        window = self.indices.get(chrom)
+        p = _int(pos)
+        if (window is not None and p is not None and
+            window[0] <= p and p <= window[1]):
+            return window[2].overlapping(p)
+        return SqlRangeTable.overlapping(self, chrom, pos)
+
+
+"""Range table served from a reference bundle without copying it into
+   memory; only the rows that match are decoded
+"""
+class BundleRangeTable(object):
+    def __init__(self, bundle, table, chrom_col='chrom',
+        start_col='chromStart', end_col='chromEnd', columns='*', split=False,
+        bins=False):
+        self.bundle = bundle
+        self.table = table
+        self.start_col = start_col
+        self.end_col = end_col
+        self.split = split
+        self.projection = None if (columns == '*') \
+            else [c.strip() for c in columns.split(',')]
+        # Indices over other columns than the ones the bundle is sorted by
+        self.indices = {}
+
+    def _segment(self, chrom):
+        if self.split:
+            table = self.bundle.table(self.table + str(chrom))
+            return (table, table.segment(b.WHOLE_TABLE))
+        table = self.bundle.table(self.table)
+        return (table, table.segment(chrom))
+
+    def _sorted(self, table):
+        return (self.start_col, self.end_col) == \
+            (table.start_col, table.end_col)
+
+    def _index(self, table, segment, chrom):
+        key = (table.name, chrom)
+        if key not in self.indices:
+            self.indices[key] = IntervalIndex(segment.row(i,
+                [self.start_col, self.end_col]) + (i,)
+                for i in range(len(segment)))
+        return self.indices[key]
+
+    def overlapping(self, chrom, pos):
+        table, segment = self._segment(chrom)
+        if segment is None:
+            return []
+
+        if self._sorted(table):
+            hits = segment.overlapping(pos)
+        else:
+            hits = self._index(table, segment, chrom).overlapping(pos)
+
+        return [segment.row(i, self.projection) for i in hits]
+
+    """Rows of chrom as (starts, ends, table order, row of interval i),
+       sorted by start; straight from the memory-mapped segment when it is
+       sorted by the table's own columns. None if the bundle has no rows
+       for chrom
+    """
+    def view(self, chrom):
+        table, segment = self._segment(chrom)
+        if segment is None:
+            return None
+        if self._sorted(table):
+            a = segment.arrays
+            return (a['_start'], a['_end'], a['_order'],
+                lambda i: segment.row(i, self.projection))
+        index = self._index(table, segment, chrom)
+        return (index.starts, index.ends, index.order,
+            lambda i: segment.row(index.payloads[i], self.projection))
+
+    def release(self, chrom):
+        table, segment = self._segment(chrom)
+        self.indices.pop((table.name, chrom), None)
+
+
+"""Range table for position-sorted input: a sweep line over the table's
+   rows of the current chromosome merges them with the variants as they
+   come, so a chromosome costs one linear pass and only the intervals
+   covering the current position are held. Rows come from source, an
+   IndexedRangeTable or a BundleRangeTable. A chromosome is released once
+   the input moves on; as soon as the input turns out not to be sorted (a
+   position behind the last one, or a chromosome coming back) every
+   further lookup is answered by source instead.
+"""
+class SweepRangeTable(object):
+    def __init__(self, source):
+        self.source = source
+        self.chrom = None
+        self.current = None
+        self.done = set()
+        self.sorted = True
+
+    def overlapping(self, chrom, pos):
+        p = _int(pos)
+        if (not self.sorted or p is None):
+            return self.source.overlapping(chrom, pos)
+
+        if chrom != self.chrom:
+            if chrom in self.done:
+                self.sorted = False
+                return self.source.overlapping(chrom, pos)
+            if self.chrom is not None:
+                self.done.add(self.chrom)
+                self.source.release(self.chrom)
+            self.chrom = chrom
+            view = self.source.view(chrom)
+            self.current = None if (view is None) else \
+                (IntervalSweep(view[0], view[1], view[2]), view[3])
+
+        if self.current is None:
+            return []
+        sweep, rowOf = self.current
+        hits = sweep.advance(p)
+        if hits is None:
+            self.sorted = False
+            return self.source.overlapping(chrom, pos)
+        return [rowOf(i) for i in hits]
+
+
+"""Range table evaluated a block of records at a time
+   prefetch() stabs all positions of a block on one chromosome at once
+   with a BlockIndex over the rows of source (an IndexedRangeTable or a
+   BundleRangeTable) and keeps the rows found per position, for every
+   chromosome of the block until newBlock(); lookups of those positions
+   are then answered from the block, anything else by source
+"""
+class ColumnarRangeTable(object):
+    def __init__(self, source):
+        self.source = source
+        self.batch = AdaptiveBatch(size=BLOCK_SIZE)
+        self.indices = {}
+        self.blocks = {}
+
+    def _index(self, chrom):
+        if chrom not in self.indices:
+            view = self.source.view(chrom)
+            self.indices[chrom] = None if (view is None) else \
+                (BlockIndex(view[0], view[1], view[2]), view[3])
+        return self.indices[chrom]
+
+    def prefetch(self, chrom, positions):
+        positions = np.unique(np.array([p for p in (_int(p)
+            for p in positions) if p is not None], dtype=np.int64))
+        block = self.blocks[chrom] = dict((p, []) for p in positions.tolist())
+        index = self._index(chrom)
+        if index is None:
+            return
+
+        blockIndex, rowOf = index
+        queries, found = blockIndex.stab(positions)
+        positions = positions.tolist()
+        for q, i in zip(queries.tolist(), found.tolist()):
+            block[positions[q]].append(rowOf(i))
+
+    """Drops the rows kept for the previous block
+    """
+    def newBlock(self):
+        self.blocks = {}
+
+    def overlapping(self, chrom, pos):
+        block = self.blocks.get(chrom)
+        if block is not None:
+            rows = block.get(_int(pos))
+            if rows is not None:
+                return list(rows)
+        return self.source.overlapping(chrom, pos)
+
+
+"""Range table answered from the genome segmentation of a bundle (see
+   bundle.SEGMENT_TABLES): one binary search finds the segment a position
+   lies in, and with it the rows of every segmented table covering it.
+   source is the table's BundleRangeTable; tables, chromosomes and
+   positions the segmentation doesn't cover are answered by source
+   Stages pass their records through resolve() a block at a time (see
+   annotate.prefetched), which finds the segments of the records not
+   resolved yet and keeps them on the records; a lookup for record is
+   then answered from it, so each variant is searched for once however
+   many stages (side by side or not) look it up
+"""
+class SegmentedRangeTable(object):
+    def __init__(self, source):
+        self.source = source
+        self.segmentation = source.bundle.segmentation()
+        self.index = self.segmentation.tableIndex(source.table)
+        self.block_size = SEGMENT_BLOCK
+        self.record = None
+
+    """Finds the sets of the records in block that have none yet, with
+       one search per chromosome
+    """
+    def resolve(self, block):
+        with _segments_lock:
+            byChrom = {}
+            for fields in block:
+                if (fields.key is not None and fields.segment[0] is None):
+                    byChrom.setdefault(fields.chromBare, []).append(fields)
+            for chrom, records in byChrom.items():
+                segments = self.segmentation.chrom(chrom)
+                if segments is None:
+                    continue
+                for fields, s in zip(records,
+                    segments.setsAt([fields.pos for fields in records])):
+                    fields.segment[0] = (segments, s)
+
+    def overlapping(self, chrom, pos):
+        p = _int(pos)
+        if (self.index is None or p is None):
+            return self.source.overlapping(chrom, pos)
+        segments = self.segmentation.chrom(chrom)
+        if (segments is None or segments.keys[self.index] != str(chrom)):
+            return self.source.overlapping(chrom, pos)
+        table, segment = self.source._segment(chrom)
+        if not self.source._sorted(table):
+            return self.source.overlapping(chrom, pos)
+
+        record = self.record
+        resolved = record.segment[0] if (record is not None and
+            record.pos == p) else None
+        if (resolved is not None and resolved[0] is segments):
+            rows = segments.rowsIn(self.index, resolved[1])
+        else:
+            rows = segments.rowsAt(self.index, p)
+        return [segment.row(i, self.source.projection) for i in rows]
+
+
+"""Candidate dbSNP rows for a block of variants
+   positions must be sorted; returns (variant, row) index arrays of the
+   rows at each variant's position whose allele code is qref or qcomp
+"""
+def matchAlleles(positions, codes, qpos, qref, qcomp):
+    lo = np.searchsorted(positions, qpos, side='left')
+    hi = np.searchsorted(positions, qpos, side='right')
+    nhits = hi - lo
+
+    # Expand every variant into its candidate rows and compare alleles
+    # for all of them at once
+    owner = np.repeat(np.arange(len(qpos)), nhits)
+    firsts = np.repeat(np.cumsum(nhits) - nhits, nhits)
+    rows = np.repeat(lo, nhits) + (np.arange(len(owner)) - firsts)
+    hit = (codes[rows] == qref[owner]) | (codes[rows] == qcomp[owner])
+    return (owner[hit], rows[hit])
+
+
+"""dbSNP matches for variants of one class (SNV, DIV, ...), with one SQL
+   query per variant
+   A variant matches rows at its position whose REF is either its own
+   reference allele or the complement of it
+"""
+class SqlDbSnpTable(object):
+    def __init__(self, conn, varclass='SNV'):
+        self.conn = conn
+        self.varclass = varclass
+        self.cursor = conn.cursor()
+
+    """Looks up a block of variants on one chromosome
+       Returns one list of (rsid, GMAF) per variant, in table order
+    """
+    def lookupBlock(self, chrom, positions, refs, compRefs):
+        matches = []
+        sql = st.dbSnpRows(self.cursor, alleles=True)
+        for pos, ref, compRef in zip(positions, refs, compRefs):
+            self.cursor.execute(sql, [str(chrom), self.varclass, pos,
+                str(ref), str(compRef)])
+            matches.append([(str(row[3]), str(row[7]))
+                for row in self.cursor.fetchall()])
+        return matches
+
+
+"""dbSNP held in memory as per-chromosome NumPy arrays
+   Positions are kept sorted (ties in table order) next to a packed
+   allele code per row: A, C, G and T are 0..3 and any other REF string
+   is interned into the same code space on load. rsID and GMAF are kept
+   in lists aligned with the arrays. A block of variants is resolved
+   with two np.searchsorted calls and one vectorised allele comparison.
+"""
+class IndexedDbSnpTable(SqlDbSnpTable):
+    def __init__(self, conn, varclass='SNV'):
+        SqlDbSnpTable.__init__(self, conn, varclass=varclass)
+        self.alleles = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
+        self.chroms = {}
+
+    """Allele code; MySQL compares REF case-insensitively, so do we
+       Unknown alleles get -1 unless add is set
+    """
+    def _alleleCode(self, allele, add=False):
+        allele = str(allele).upper()
+        code = self.alleles.get(allele)
+        if code is None:
+            if not add:
+                return -1
+            code = self.alleles[allele] = len(self.alleles)
+        return code
+
+    def _load(self, chrom):
+        self.cursor.execute(st.dbSnpRows(self.cursor),
+            [str(chrom), self.varclass])
+        return self._arrays(self.cursor.fetchall())
+
+    """Sorted positions, allele codes and payloads of rows selected as
+       t.*, t.POS, t.REF
+    """
+    def _arrays(self, rows):
+        positions = np.fromiter((int(row[-2]) for row in rows),
+            dtype=np.int64, count=len(rows))
+        codes = np.fromiter((self._alleleCode(row[-1], add=True)
+            for row in rows), dtype=np.int32, count=len(rows))
+        order = np.argsort(positions, kind='stable')
+        payload = [(str(rows[i][3]), str(rows[i][7])) for i in order]
+
+        return (positions[order], codes[order], payload)
+
+    def lookupBlock(self, chrom, positions, refs, compRefs):
+        keys = self.chroms.get(chrom)
+        if keys is None:
+            keys = self.chroms[chrom] = self._load(chrom)
+        snpPositions, snpCodes, payload = keys
+
+        qpos = np.asarray([int(p) for p in positions], dtype=np.int64)
+        qref = np.asarray([self._alleleCode(r) for r in refs],
+            dtype=np.int32)
+        qcomp = np.asarray([self._alleleCode(c) for c in compRefs],
+            dtype=np.int32)
+
+        matches = [[] for p in positions]
+        owner, rows = matchAlleles(snpPositions, snpCodes, qpos, qref, qcomp)
+        for v, r in zip(owner.tolist(), rows.tolist()):
+            matches[v].append(payload[r])
+        return matches
+
+
+"""dbSNP for data that has to stay in the database
+   A block of variants is cut into batches by position and each batch is
+   fetched with one query for all of its positions, then matched as in
+   IndexedDbSnpTable
+"""
+class BatchDbSnpTable(IndexedDbSnpTable):
+    def __init__(self, conn, varclass='SNV'):
+        IndexedDbSnpTable.__init__(self, conn, varclass=varclass)
+        self.batch = AdaptiveBatch()
+
+    def lookupBlock(self, chrom, positions, refs, compRefs):
+        matches = [[] for p in positions]
+        variants = [(i, _int(p)) for i, p in enumerate(positions)]
+        for i, p in variants:
+            if p is None:
+                matches[i] = SqlDbSnpTable.lookupBlock(self, chrom,
+                    [positions[i]], [refs[i]], [compRefs[i]])[0]
+        variants = [(i, p) for i, p in variants if p is not None]
+
+        for batch in self.batch.split(variants, key=lambda v: v[1]):
+            unique = sorted(set(p for i, p in batch))
+            started = time.time()
+            self.cursor.execute(st.dbSnpRows(self.cursor,
+                n=st.listSize(len(unique))),
+                [str(chrom), self.varclass] + st.listParams(unique))
+            rows = self.cursor.fetchall()
+            self.batch.update(time.time() - started)
+            self.chroms[chrom] = self._arrays(rows)
+
+            indices = [i for i, p in batch]
+            for i, found in zip(indices, IndexedDbSnpTable.lookupBlock(self,
+                chrom, [positions[i] for i in indices],
+                [refs[i] for i in indices], [compRefs[i] for i in indices])):
+                matches[i] = found
+        return matches
+
+
+"""dbSNP served from a reference bundle
+   The bundle already stores dbSNP sorted by position with packed REF
+   codes (_refCode), so lookups search the mapped arrays directly
+"""
+class BundleDbSnpTable(object):
+    def __init__(self, bundle, varclass='SNV'):
+        self.bundle = bundle
+        self.varclass = varclass
+        self.table = bundle.table('dbSNP')
+
+    def _alleleCode(self, allele):
+        return self.bundle.alleles.get(str(allele).upper(), -1)
+
+    def lookupBlock(self, chrom, positions, refs, compRefs):
+        matches = [[] for p in positions]
+        segment = self.table.segment(chrom)
+        if segment is None:
+            return matches
+
+        qpos = np.asarray([int(p) for p in positions], dtype=np.int64)
+        qref = np.asarray([self._alleleCode(r) for r in refs],
+            dtype=np.int32)
+        qcomp = np.asarray([self._alleleCode(c) for c in compRefs],
+            dtype=np.int32)
+
+        owner, rows = matchAlleles(segment.arrays['_start'],
+            segment.arrays['_refCode'], qpos, qref, qcomp)
+        varclass = self.varclass.upper()
+        for v, r in zip(owner.tolist(), rows.tolist()):
+            if str(segment.row(r, ['INFO'])[0]).upper() == varclass:
+                row = segment.row(r)
+                matches[v].append((str(row[3]), str(row[7])))
+        return matches
+
+
+"""refGene transcripts within promoter_offset of a position, with one SQL
+   query per variant
+   Every row comes back compiled into a Transcript; a row seen before
+   reuses its compiled model. With bins set, lookups are restricted to the
+   UCSC bins within promoter_offset of the position
+"""
+class SqlTranscriptTable(object):
+    def __init__(self, conn, table='refGene', promoter_offset=500,
+        version=None, bins=False):
+        self.table = table
+        self.promoter_offset = int(promoter_offset)
+        self.version = version
+        self.cursor = conn.cursor()
+        self.binned = _binned(self.cursor, bins, table, 'txStart', 'txEnd')
+        self.models = {}
+
+    def _model(self, row):
+        model = self.models.get(row)
+        if model is None:
+            model = self.models[row] = Transcript(row)
+        return model
+
+    """Statement and parameters fetching the transcripts within
+       promoter_offset of [lo, hi]
+    """
+    def _window(self, chrom, lo, hi):
+        offset = self.promoter_offset
+        binned, bins = (False, []) if (_int(lo) is None) else \
+            _bins(self.binned, _int(lo) - offset, _int(hi) + offset)
+        return (st.transcriptRows(self.cursor, self.table, binned=binned),
+            [str(chrom)] + bins + [offset, hi, lo, offset])
+
+    def overlapping(self, chrom, pos):
+        self.cursor.execute(*self._window(chrom, pos, pos))
+        return [self._model(row) for row in self.cursor.fetchall()]
+
+
+"""refGene transcripts held in memory as one interval index per
+   chromosome over [txStart - promoter_offset, txEnd + promoter_offset]
+   A chromosome is compiled the first time it is asked for. With a
+   reference version, the compiled index is kept for the life of the
+   process and shared by every job on that version
+"""
+class IndexedTranscriptTable(SqlTranscriptTable):
+    def __init__(self, conn, table='refGene', promoter_offset=500,
+        version=None, bins=False):
+        SqlTranscriptTable.__init__(self, conn, table=table,
+            promoter_offset=promoter_offset, version=version, bins=bins)
+        self.indices = {}
+
+    """Rows of one chromosome, in table order
+    """
+    def _rows(self, chrom):
+        self.cursor.execute(st.transcriptRows(self.cursor, self.table,
+            window=False), [str(chrom)])
+        return self.cursor.fetchall()
+
+    def _load(self, chrom):
+        key = (self.version, self.table, self.promoter_offset, chrom)
+        index = transcriptIndices.get(key)
+        if index is None:
+            offset = self.promoter_offset
+            models = [Transcript(row) for row in self._rows(chrom)]
+            index = IntervalIndex((m.txStart - offset, m.txEnd + offset, m)
+                for m in models)
+            if self.version is not None:
+                transcriptIndices[key] = index
+        return index
+
+    def overlapping(self, chrom, pos):
+        index = self.indices.get(chrom)
+        if index is None:
+            index = self.indices[chrom] = self._load(chrom)
+        return index.overlapping(pos)
+
+
+"""refGene transcripts for data that has to stay in the database
+   prefetch() compiles every transcript within promoter_offset of a
+   batch's [min, max] window with one query; lookups outside the window
+   fall back to a query per variant
+"""
+class BatchTranscriptTable(IndexedTranscriptTable):
+    def __init__(self, conn, table='refGene', promoter_offset=500,
+        version=None, bins=False):
+        IndexedTranscriptTable.__init__(self, conn, table=table,
+            promoter_offset=promoter_offset, version=version, bins=bins)
+        self.batch = AdaptiveBatch()
+
+    def prefetch(self, chrom, positions):
+        positions = [p for p in (_int(p) for p in positions) if p is not None]
+        if not positions:
+            return
+        lo = min(positions)
+        hi = max(positions)
+        offset = self.promoter_offset
+
+        started = time.time()
+        self.cursor.execute(*self._window(chrom, lo, hi))
+        models = [self._model(row) for row in self.cursor.fetchall()]
+        self.batch.update(time.time() - started)
+        self.indices[chrom] = (lo, hi, IntervalIndex(
+            (m.txStart - offset, m.txEnd + offset, m) for m in models))
+
+    def overlapping(self, chrom, pos):
+        window = self.indices.get(chrom)
+        p = _int(pos)
+        if (window is not None and p is not None and
+            window[0] <= p and p <= window[1]):
+            return window[2].overlapping(p)
+        return SqlTranscriptTable.overlapping(self, chrom, pos)
+
+
+"""refGene transcripts compiled from a reference bundle
+"""
+class BundleTranscriptTable(IndexedTranscriptTable):
+    def __init__(self, bundle, table='refGene', promoter_offset=500,
+        version=None, bins=False):
+        self.table = table
+        self.promoter_offset = int(promoter_offset)
+        self.version = version
+        self.bundle = bundle
+        self.indices = {}
+
+    def _rows(self, chrom):
+        segment = self.bundle.table(self.table).segment(chrom)
+        if segment is None:
+            return []
+        order = np.argsort(segment.arrays['_order'], kind='stable')
+        return [segment.row(i) for i in order.tolist()]
+
+
+"""bigRefGene annotations of a variant, from the first of three tables
+   that has any:
+     1. chrom_pos_equal_base    same position and same (or complementary)
+                                REF and ALT
+     2. chrom_pos_equal_nobase  same position
+     3. chrom_pos_unequal       start <= position <= end
+   Matching rows are handed out as their annotation, rendered and
+   interned by fragments.refSeq. This one sends up to three SQL queries
+   per variant; with bins set, chrom_pos_unequal is looked up by UCSC bin
+"""
+class SqlRefSeqResolver(object):
+    def __init__(self, conn, bins=False):
+        self.conn = conn
+        self.cursor = conn.cursor()
+        self.binned = _binned(self.cursor, bins, 'chrom_pos_unequal', 'start',
+            'end')
+
+    """Resolves a block of variants on one chromosome; variants are
+       (pos, ref, alt, compRef, compAlt). Returns one list of annotations
+       per variant, in table order
+    """
+    def resolveBlock(self, chrom, variants):
+        matches = []
+        chrom = str(chrom)
+        for pos, ref, alt, compRef, compAlt in variants:
+            binned, bins = _bins(self.binned, pos, pos)
+            rows = []
+            for sql, params in [
+                (st.refSeqRows(self.cursor, 'chrom_pos_equal_base', n=1,
+                    alleles=True), [chrom, pos, str(ref), str(alt),
+                    str(compRef), str(compAlt)]),
+                (st.refSeqRows(self.cursor, 'chrom_pos_equal_nobase', n=1),
+                    [chrom, pos]),
+                (st.refSeqRows(self.cursor, 'chrom_pos_unequal', window=True,
+                    binned=binned), [chrom] + bins + [pos, pos])]:
+                self.cursor.execute(sql, params)
+                rows = list(self.cursor.fetchall())
+                if (len(rows) > 0):
+                    break
+            matches.append([fragments.refSeq(row) for row in rows])
+        return matches
+
+
+"""bigRefGene tables of a chromosome held together in memory: the two
+   exact-position tables as hashes keyed by start, chrom_pos_unequal as an
+   interval index. A variant is resolved with a single local probe that
+   applies the same precedence as SqlRefSeqResolver. Annotations are
+   rendered once, when the tables are loaded.
+"""
+class IndexedRefSeqResolver(SqlRefSeqResolver):
+    def __init__(self, conn, bins=False):
+        SqlRefSeqResolver.__init__(self, conn, bins=bins)
+        self.chroms = {}
+
+    """Rows of one table on one chromosome, in table order
+    """
+    def _rows(self, table, chrom):
+        self.cursor.execute(st.refSeqRows(self.cursor, table), [str(chrom)])
+        return self.cursor.fetchall()
+
+    def _load(self, chrom):
+        return self._tables(self._rows('chrom_pos_equal_base', chrom),
+            self._rows('chrom_pos_equal_nobase', chrom),
+            self._rows('chrom_pos_unequal', chrom))
+
+    def _tables(self, baseRows, nobaseRows, unequalRows):
+        # Alleles are compared upper-cased, as MySQL compares them
+        base = {}
+        for row in baseRows:
+            base.setdefault(int(row[2]), []).append((str(row[4]).upper(),
+                str(row[5]).upper(), fragments.refSeq(row)))
+        nobase = {}
+        for row in nobaseRows:
+            nobase.setdefault(int(row[2]), []).append(fragments.refSeq(row))
+        unequal = IntervalIndex((row[2], row[3], fragments.refSeq(row))
+            for row in unequalRows)
+        return (base, nobase, unequal)
+
+    def resolveBlock(self, chrom, variants):
+        tables = self.chroms.get(chrom)
+        if tables is None:
+            tables = self.chroms[chrom] = self._load(chrom)
+        return self._probe(tables, variants)
+
+    def _probe(self, tables, variants):
+        base, nobase, unequal = tables
+
+        matches = []
+        for pos, ref, alt, compRef, compAlt in variants:
+            pos = int(pos)
+            alleles = [(str(ref).upper(), str(alt).upper()),
+                (str(compRef).upper(), str(compAlt).upper())]
+            rows = [row for hRef, hAlt, row in base.get(pos, [])
+                if (hRef, hAlt) in alleles]
+            if not rows:
+                rows = list(nobase.get(pos, []))
+            if not rows:
+                rows = unequal.overlapping(pos)
+            matches.append(rows)
+        return matches
+
+
+"""bigRefGene tables for data that has to stay in the database
+   A block of variants is cut into batches by position; each batch costs
+   one query per table (exact positions for the two equal tables, the
+   batch's [min, max] window for chrom_pos_unequal) and is then probed as
+   in IndexedRefSeqResolver
+"""
+class BatchRefSeqResolver(IndexedRefSeqResolver):
+    def __init__(self, conn, bins=False):
+        IndexedRefSeqResolver.__init__(self, conn, bins=bins)
+        self.batch = AdaptiveBatch()
+
+    def resolveBlock(self, chrom, variants):
+        matches = [None] * len(variants)
+        numbered = [(i, _int(v[0])) for i, v in enumerate(variants)]
+        for i, p in numbered:
+            if p is None:
+                matches[i] = SqlRefSeqResolver.resolveBlock(self, chrom,
+                    [variants[i]])[0]
+        numbered = [(i, p) for i, p in numbered if p is not None]
+
+        chrom = str(chrom)
+        for batch in self.batch.split(numbered, key=lambda v: v[1]):
+            positions = sorted(set(p for i, p in batch))
+            n = st.listSize(len(positions))
+            lo = positions[0]
+            hi = positions[-1]
+            binned, bins = _bins(self.binned, lo, hi)
+            started = time.time()
+            rows = []
+            for sql, params in [
+                (st.refSeqRows(self.cursor, 'chrom_pos_equal_base', n=n),
+                    [chrom] + st.listParams(positions)),
+                (st.refSeqRows(self.cursor, 'chrom_pos_equal_nobase', n=n),
+                    [chrom] + st.listParams(positions)),
+                (st.refSeqRows(self.cursor, 'chrom_pos_unequal', window=True,
+                    binned=binned), [chrom] + bins + [hi, lo])]:
+                self.cursor.execute(sql, params)
+                rows.append(self.cursor.fetchall())
+            self.batch.update(time.time() - started)
+
+            tables = self._tables(*rows)
+            for (i, p), found in zip(batch, self._probe(tables,
+                [variants[i] for i, p in batch])):
+                matches[i] = found
+        return matches
+
+
+"""bigRefGene tables read from a reference bundle
+"""
+class BundleRefSeqResolver(IndexedRefSeqResolver):
+    def __init__(self, bundle):
+        self.bundle = bundle
+        self.chroms = {}
+
+    def _rows(self, table, chrom):
+        segment = self.bundle.table(table).segment(chrom)
+        if segment is None:
+            return []
+        order = np.argsort(segment.arrays['_order'], kind='stable')
+        return [segment.row(i) for i in order.tolist()]
+
+
+"""Results of one server-side LEFT JOIN of the job's variants
+   (job_variants, see Reference.loadVariants) against a reference table
+   sql is a select with {lo} and {hi} placeholders for a range of lines,
+   returning line, chrom, pos, a matched flag, the row's place in table
+   order and then the table columns, ordered by line and then in table
+   order, so a variant gets its rows as the sql lookup returns them. The
+   join is read JOIN_PAGE lines at a time. Results
+   follow the file's lines: find() hands out the first unclaimed result at
+   a (chrom, pos), which is the caller's own line only if every line of
+   the file is looked up, in order, at each position. Stages must not skip
+   lines (an annotation cache does, so the join isn't run behind one)
+"""
+class JoinStream(object):
+    def __init__(self, conn, sql, lines, page=JOIN_PAGE):
+        self.cursor = conn.cursor()
+        self.sql = sql
+        self.lines = lines
+        self.page = page
+        self.lo = 0
+        self.groups = {}
+
+    def _nextPage(self):
+        if self.lo >= self.lines:
+            return False
+        hi = self.lo + self.page
+        self.cursor.execute(self.sql.format(lo=self.lo, hi=hi))
+        line = None
+        for row in self.cursor.fetchall():
+            if row[0] != line:
+                line = row[0]
+                rows = []
+                self.groups.setdefault((str(row[1]), int(row[2])),
+                    deque()).append(rows)
+            if row[3]:
+                rows.append(tuple(row[5:]))
+        self.lo = hi
+        return True
+
+    """Rows joined to the next variant at (chrom, pos), or None if the job
+       has no such variant left
+    """
+    def find(self, chrom, pos):
+        key = (str(chrom), pos)
+        while True:
+            found = self.groups.get(key)
+            if found:
+                rows = found.popleft()
+                if not found:
+                    del self.groups[key]
+                return rows
+            if not self._nextPage():
+                return None
+
+
+"""The select behind a JoinStream, without its order: the variants' chrom
+   column vchrom, the table columns and the join condition on t and v
+"""
+def joinSelect(cursor, table, vchrom, marker, columns, condition, where=''):
+    return 'select v.line, v.' + vchrom + ', v.pos, (t.' + marker + \
+        ' is not null), ' + st.tableOrder(cursor, table) + ', ' + \
+        columns + ' from job_variants v left join ' + table + ' t on ' + \
+        condition + ' where ' + where + 'v.line >= {lo} AND v.line < {hi}'
+
+
+"""Builds the select behind a JoinStream, ordered by line and then in
+   table order; arguments as for joinSelect
+"""
+def joinSql(cursor, table, vchrom, marker, columns, condition, where=''):
+    return joinSelect(cursor, table, vchrom, marker, columns, condition,
+        where=where) + ' order by 1, 5;'
+
+
+"""Range table answered by a server-side join of the whole job
+   Positions the join can't answer fall back to a query per variant
+"""
+class JoinRangeTable(SqlRangeTable):
+    def __init__(self, conn, table, chrom_col='chrom', start_col='chromStart',
+        end_col='chromEnd', columns='*', split=False, lines=0):
+        SqlRangeTable.__init__(self, conn, table, chrom_col=chrom_col,
+            start_col=start_col, end_col=end_col, columns=columns,
+            split=split)
+        self.lines = lines
+        self.stream = None
+
+    def _stream(self, chrom):
+        columns = 't.*' if (self.columns == '*') else \
+            ', '.join('t.' + c.strip() for c in self.columns.split(','))
+        within = 't.' + self.start_col + ' <= v.pos AND v.pos <= t.' + \
+            self.end_col
+        if self.split:
+            # One table per chromosome: join each with its own variants
+            sql = 'select * from (' + ' union all '.join(
+                joinSelect(self.cursor, self.table + c, 'chrom_bare',
+                    self.start_col, columns, within,
+                    where='v.chrom_bare="' + c + '" AND ')
+                for c in b.TFBS_CHROMS) + ') u order by 1, 5;'
+        else:
+            # Stages ask with 'chr1' or with '1'; join on the same spelling
+            vchrom = 'chrom_ucsc' if str(chrom).startswith('chr') \
+                else 'chrom_bare'
+            sql = joinSql(self.cursor, self.table, vchrom, self.start_col,
+                columns, 't.' + self.chrom_col + ' = v.' + vchrom + ' AND ' + \
+                within)
+        return JoinStream(self.conn, sql, self.lines)
+
+    def overlapping(self, chrom, pos):
+        p = _int(pos)
+        if p is not None:
+            if self.stream is None:
+                self.stream = self._stream(chrom)
+            rows = self.stream.find(chrom, p)
+            if rows is not None:
+                return rows
+        return SqlRangeTable.overlapping(self, chrom, pos)
+
+
+"""dbSNP answered by a server-side join of the whole job
+"""
+class JoinDbSnpTable(SqlDbSnpTable):
+    def __init__(self, conn, varclass='SNV', lines=0):
+        SqlDbSnpTable.__init__(self, conn, varclass=varclass)
+        self.stream = JoinStream(conn, joinSql(self.cursor, 'dbSNP',
+            'chrom_bare', 'POS', 't.*', 't.CHR = v.chrom_bare AND ' + \
+            't.POS = v.pos AND (t.REF = v.ref OR t.REF = v.comp_ref) AND ' + \
+            't.INFO = "' + varclass + '"'), lines)
+
+    def lookupBlock(self, chrom, positions, refs, compRefs):
+        matches = []
+        for pos, ref, compRef in zip(positions, refs, compRefs):
+            p = _int(pos)
+            rows = None if (p is None) else self.stream.find(chrom, p)
+            if rows is None:
+                matches.extend(SqlDbSnpTable.lookupBlock(self, chrom, [pos],
+                    [ref], [compRef]))
+            else:
+                matches.append([(str(row[3]), str(row[7])) for row in rows])
+        return matches
+
+
+"""refGene transcripts answered by a server-side join of the whole job
+"""
+class JoinTranscriptTable(SqlTranscriptTable):
+    def __init__(self, conn, table='refGene', promoter_offset=500,
+        version=None, lines=0):
+        SqlTranscriptTable.__init__(self, conn, table=table,
+            promoter_offset=promoter_offset, version=version)
+        offset = str(self.promoter_offset)
+        self.stream = JoinStream(conn, joinSql(self.cursor, table,
+            'chrom_ucsc', 'txStart', 't.*', 't.chrom = v.chrom_ucsc AND ' + \
+            '(t.txStart - ' + offset + ') <= v.pos AND v.pos <= (t.txEnd + ' + \
+            offset + ')'), lines)
+
+    def overlapping(self, chrom, pos):
+        p = _int(pos)
+        rows = None if (p is None) else self.stream.find(chrom, p)
+        if rows is None:
+            return SqlTranscriptTable.overlapping(self, chrom, pos)
+        return [self._model(row) for row in rows]
+
+
+"""bigRefGene tables answered by three server-side joins of the whole job,
+   one per table; the precedence between them is applied here
+"""
+class JoinRefSeqResolver(SqlRefSeqResolver):
+    def __init__(self, conn, lines=0):
+        SqlRefSeqResolver.__init__(self, conn)
+        self.streams = [
+            JoinStream(conn, joinSql(self.cursor, 'chrom_pos_equal_base',
+                'chrom_bare', 'start', 't.*', 't.CHR = v.chrom_bare AND ' + \
+                't.start = v.pos AND ((t.haplotypeReference = v.ref AND ' + \
+                't.haplotypeAlternate = v.alt) OR (t.haplotypeReference = ' + \
+                'v.comp_ref AND t.haplotypeAlternate = v.comp_alt))'), lines),
+            JoinStream(conn, joinSql(self.cursor, 'chrom_pos_equal_nobase',
+                'chrom_bare', 'start', 't.*', 't.CHR = v.chrom_bare AND ' + \
+                't.start = v.pos'), lines),
+            JoinStream(conn, joinSql(self.cursor, 'chrom_pos_unequal',
+                'chrom_bare', 'start', 't.*', 't.CHR = v.chrom_bare AND ' + \
+                't.start <= v.pos AND v.pos <= t.end'), lines)]
+
+    def resolveBlock(self, chrom, variants):
+        matches = []
+        for variant in variants:
+            p = _int(variant[0])
+            found = [None] if (p is None) else \
+                [stream.find(chrom, p) for stream in self.streams]
+            if None in found:
+                matches.extend(SqlRefSeqResolver.resolveBlock(self, chrom,
+                    [variant]))
+                continue
+            rows = []
+            for rows in found:
+                if (len(rows) > 0):
+                    break
+            matches.append([fragments.refSeq(row) for row in rows])
+        return matches
+
+
+"""Handle on the reference data shared by all stages of a job
+   lookup selects how range tables and dbSNP are queried (LOOKUP_SQL,
+   LOOKUP_INDEX or LOOKUP_BUNDLE, which needs the path of a bundle built
+   by build_bundle.py); tables are opened once and reused by every stage
+   that asks. Stages that still query SQL directly use cursor()
+   version labels the reference data; a bundle carries its own
+   bins restricts SQL range lookups by UCSC bin; the bin columns and
+   indexes must have been built with build_bins.py
+   conn is None when everything is read from the bundle (see backends.py)
+"""
+class Reference(object):
+    def __init__(self, conn, lookup=LOOKUP_SQL, bundle=None, version=None,
+        bins=False):
+        if lookup not in LOOKUPS:
+            raise ValueError(f"Unknown reference lookup '{lookup}'")
+        if (lookup in [LOOKUP_BUNDLE, LOOKUP_SEGMENTS] and not bundle):
+            raise ValueError(f"{lookup.capitalize()} lookup needs a " + \
+                "reference bundle")
+        self.conn = conn
+        # Sweeps and blocks run over the bundle if there is one and over
+        # in-memory indices otherwise, segments over the bundle; tables
+        # other than range tables use those directly
+        self.ranges = {LOOKUP_SWEEP: SweepRangeTable,
+            LOOKUP_COLUMNAR: ColumnarRangeTable,
+            LOOKUP_SEGMENTS: SegmentedRangeTable}.get(lookup)
+        if self.ranges is not None:
+            lookup = LOOKUP_BUNDLE if bundle else LOOKUP_INDEX
+        self.lookup = lookup
+        self.bundle = openBundle(bundle) if bundle else None
+        if (self.ranges is SegmentedRangeTable and
+            self.bundle.segmentation() is None):
+            raise ValueError(f"Bundle '{bundle}' has no genome " + \
+                "segmentation; rebuild it with build_bundle.py")
+        self.version = self.bundle.version if self.bundle else version
+        self.bins = bins
+        self.tables = {}
+        self.lines = None
+
+    def cursor(self):
+        return self.conn.cursor()
+
+    """Loads the job's variants into the temporary table job_variants for
+       LOOKUP_JOIN; variants are (line, chrom as 'chr1', chrom as '1', pos,
+       ref, alt, complement of ref, complement of alt) in line order, as
+       annotate.variantKeys reads them
+    """
+    def loadVariants(self, variants):
+        cursor = self.conn.cursor()
+        placeholder = st.placeholder(cursor)
+        # Left over in a pooled session by a job that failed
+        cursor.execute('drop temporary table if exists job_variants;'
+            if (placeholder == '%s') else
+            'drop table if exists temp.job_variants;')
+        cursor.execute('create temporary table job_variants (' + \
+            'line integer primary key, chrom_ucsc varchar(64), ' + \
+            'chrom_bare varchar(64), pos integer, ref varchar(255), ' + \
+            'alt varchar(255), comp_ref varchar(255), ' + \
+            'comp_alt varchar(255));')
+
+        sql = 'insert into job_variants values (' + \
+            ', '.join([placeholder] * 8) + ');'
+        lines = 0
+        rows = []
+        for variant in variants:
+            rows.append(variant)
+            lines = variant[0] + 1
+            if len(rows) >= JOIN_LOAD_ROWS:
+                cursor.executemany(sql, rows)
+                rows = []
+        if rows:
+            cursor.executemany(sql, rows)
+
+        cursor.execute('create index job_variants_ucsc on ' + \
+            'job_variants (chrom_ucsc, pos);')
+        cursor.execute('create index job_variants_bare on ' + \
+            'job_variants (chrom_bare, pos);')
+        self.conn.commit()
+        self.lines = lines
+
+    """Range table for the configured lookup; preload asks for an
+       in-memory index even in LOOKUP_SQL mode (for small tables that are
+       hit many times per variant)
+    """
+    def rangeTable(self, table, chrom_col='chrom', start_col='chromStart',
+        end_col='chromEnd', columns='*', split=False, preload=False):
+        key = (table, chrom_col, start_col, end_col, columns, split)
+        if key not in self.tables:
+            if self.lookup == LOOKUP_BUNDLE:
+                cls, source = BundleRangeTable, self.bundle
+            elif (self.lookup == LOOKUP_INDEX or preload):
+                cls, source = IndexedRangeTable, self.conn
+            elif self.lookup == LOOKUP_BATCH:
+                cls, source = BatchRangeTable, self.conn
+            elif self.lookup == LOOKUP_JOIN:
+                self.tables[key] = JoinRangeTable(self.conn, table,
+                    chrom_col=chrom_col, start_col=start_col, end_col=end_col,
+                    columns=columns, split=split, lines=self._lines())
+                return self.tables[key]
+            else:
+                cls, source = SqlRangeTable, self.conn
+            self.tables[key] = cls(source, table, chrom_col=chrom_col,
+                start_col=start_col, end_col=end_col, columns=columns,
+                split=split, bins=self.bins)
+            # Sweeps and blocks need the positions in input order, which
+            # preloaded tables (looked up around each variant) don't get
+            if (self.ranges is SegmentedRangeTable or
+                (self.ranges is not None and not preload)):
+                self.tables[key] = self.ranges(self.tables[key])
+        return self.tables[key]
+
+    def dbSnpTable(self, varclass='SNV'):
+        key = ('dbSNP', varclass)
+        if key not in self.tables:
+            if self.lookup == LOOKUP_BUNDLE:
+                cls, source = BundleDbSnpTable, self.bundle
+            elif self.lookup == LOOKUP_INDEX:
+                cls, source = IndexedDbSnpTable, self.conn
+            elif self.lookup == LOOKUP_BATCH:
+                cls, source = BatchDbSnpTable, self.conn
+            elif self.lookup == LOOKUP_JOIN:
+                self.tables[key] = JoinDbSnpTable(self.conn,
+                    varclass=varclass, lines=self._lines())
+                return self.tables[key]
+            else:
+                cls, source = SqlDbSnpTable, self.conn
+            self.tables[key] = cls(source, varclass=varclass)
+        return self.tables[key]
+
+    def refSeqResolver(self):
+        key = ('bigRefGene',)
+        if key not in self.tables:
+            if self.lookup == LOOKUP_BUNDLE:
+                self.tables[key] = BundleRefSeqResolver(self.bundle)
+            elif self.lookup == LOOKUP_INDEX:
+                self.tables[key] = IndexedRefSeqResolver(self.conn,
+                    bins=self.bins)
+            elif self.lookup == LOOKUP_BATCH:
+                self.tables[key] = BatchRefSeqResolver(self.conn,
+                    bins=self.bins)
+            elif self.lookup == LOOKUP_JOIN:
+                self.tables[key] = JoinRefSeqResolver(self.conn,
+                    lines=self._lines())
+            else:
+                self.tables[key] = SqlRefSeqResolver(self.conn,
+                    bins=self.bins)
+        return self.tables[key]
+
+    def transcriptTable(self, table='refGene', promoter_offset=500):
+        key = ('transcripts', table, promoter_offset)
+        if key not in self.tables:
+            if self.lookup == LOOKUP_BUNDLE:
+                cls, source = BundleTranscriptTable, self.bundle
+            elif self.lookup == LOOKUP_INDEX:
+                cls, source = IndexedTranscriptTable, self.conn
+            elif self.lookup == LOOKUP_BATCH:
+                cls, source = BatchTranscriptTable, self.conn
+            elif self.lookup == LOOKUP_JOIN:
+                self.tables[key] = JoinTranscriptTable(self.conn, table=table,
+                    promoter_offset=promoter_offset, version=self.version,
+                    lines=self._lines())
+                return self.tables[key]
+            else:
+                cls, source = SqlTranscriptTable, self.conn
+            self.tables[key] = cls(source, table=table,
+                promoter_offset=promoter_offset, version=self.version,
+                bins=self.bins)
+        return self.tables[key]
+
+    def _lines(self):
+        if self.lines is None:
+            raise ValueError("Join lookup needs the job's variants; " + \
+                "call loadVariants() first")
+        return self.lines
+
+    def close(self):
+        if self.lines is not None:
+            # The connection goes back to the pool; don't leave the
+            # job's variants behind in its session
+            self.conn.cursor().execute('drop table job_variants;')
+        if self.conn is not None:
+            self.conn.close()
+
+### EOF
@@ -0,0 +1,146 @@
+# shards.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Splits an input file into shards that can be annotated independently
+# and merges the annotated shards back in the original line order
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+from array import array
+from bisect import bisect_right
+
+import annotate as ann
+
+
+def isHeader(line):
+    return (line.startswith('#') or line.startswith('CHROM'))
+
+
+def _position(value):
+    try:
+        return int(value)
+    except ValueError:
+        return 0
+
+
+"""Decides how the records of a file are spread over shards
+   Chromosomes holding more than 1/workers of all records are cut into
+   balanced position ranges so that no shard is much bigger than that;
+   the others are packed, in the order they are first seen, into shards
+   of up to that size. A file with many contigs (unplaced or alt
+   scaffolds) still makes at most a few shards per worker, so splitting
+   and merging keep few files open. Returns a dict chrom -> (first shard,
+   list of range boundaries), the boundaries empty if the chromosome is
+   whole.
+"""
+def planShards(infile, workers, format='vcf', sep='\t'):
+    inds = ann.getFormatSpecificIndices(format=format)
+    positions = {}
+    total = 0
+
+    fh = open(infile)
+    for line in fh:
+        line = line.strip()
+        if isHeader(line):
+            continue
+        fields = line.split(sep)
+        chrom = fields[inds[0]].strip()
+        pos = fields[inds[1]] if (len(fields) > inds[1]) else ''
+        positions.setdefault(chrom, array('q')).append(_position(pos))
+        total += 1
+    fh.close()
+
+    target = max(1, -(-total // workers))
+    plan = {}
+    nshards = 0
+    # Shard whole chromosomes are being packed into, and its records
+    packing = None
+    packed = 0
+    for chrom, chrom_positions in positions.items():
+        pieces = -(-len(chrom_positions) // target)
+        if pieces <= 1:
+            if (packing is None or packed + len(chrom_positions) > target):
+                packing = nshards
+                packed = 0
+                nshards += 1
+            plan[chrom] = (packing, [])
+            packed += len(chrom_positions)
+            continue
+        ordered = sorted(chrom_positions)
+        boundaries = sorted(set(ordered[(k * len(ordered)) // pieces]
+            for k in range(1, pieces)))
+        plan[chrom] = (nshards, boundaries)
+        nshards += len(boundaries) + 1
+    return plan
+
+
+"""Input and output file names of shard k
+"""
+def shardPaths(infile, k):
+    shard = infile + '.shard' + str(k)
+    return (shard, shard + '.annot')
+
+
+"""Writes the records of infile into one file per shard
+   Returns (shard files, layout). layout lists, for every line of the
+   input in order, the shard that holds it, or -1 for header lines,
+   which are kept in headers.
+"""
+def splitShards(infile, plan, format='vcf', sep='\t'):
+    inds = ann.getFormatSpecificIndices(format=format)
+
+    nshards = max([first + len(boundaries) + 1
+        for first, boundaries in plan.values()] or [0])
+    files = [shardPaths(infile, k)[0] for k in range(nshards)]
+    fhs = [open(path, 'w') for path in files]
+    layout = array('i')
+    headers = []
+
+    fh = open(infile)
+    for line in fh:
+        line = line.strip()
+        if isHeader(line):
+            layout.append(-1)
+            headers.append(line)
+            continue
+        fields = line.split(sep)
+        chrom = fields[inds[0]].strip()
+        k, boundaries = plan[chrom]
+        if boundaries:
+            pos = fields[inds[1]] if (len(fields) > inds[1]) else ''
+            k += bisect_right(boundaries, _position(pos))
+        fhs[k].write(line + '\n')
+        layout.append(k)
+    fh.close()
+
+    for shard_fh in fhs:
+        shard_fh.close()
+    return (files, layout, headers)
+
+
+"""Interleaves the annotated shards back into the original line order
+"""
+def mergeShards(outfile, outputs, layout, headers):
+    fhs = [open(path) for path in outputs]
+    headers = iter(headers)
+    fh_out = open(outfile, 'w')
+    for k in layout:
+        if k < 0:
+            fh_out.write(next(headers) + '\n')
+        else:
+            fh_out.write(fhs[k].readline())
+    fh_out.close()
+    for fh in fhs:
+        fh.close()
+
+
+def removeShards(paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+### EOF
@@ -0,0 +1,175 @@
+# sorting.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Sorts an input file by chromosome and position in bounded memory, and
+# puts the annotated records back in the original line order afterwards
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import heapq
+from array import array
+from itertools import chain
+
+import annotate as ann
+import shards
+
+# Lines held in memory at a time; longer files are sorted in runs of this
+# many lines that are spilled next to the input and merged
+RUN_LINES = 500000
+# Runs merged in one pass
+MERGE_FANIN = 64
+
+
+"""Sort key of a chromosome, with or without 'chr': 1..22, X, Y, M and MT
+   first, in that order (their fixed annotate.chromIds), then the others
+   by name. The ids annotate.chromId hands the others depend on the order
+   a process meets them, so they aren't used here
+"""
+def chromKey(chrom):
+    chrom = chrom.strip()
+    if chrom.startswith("chr"):
+        chrom = chrom.replace('chr', '')
+    cid = ann.chromIds.get(chrom)
+    if (cid is None or cid > ann.CHROM_MT):
+        return (ann.CHROM_MT + 1, chrom)
+    return (cid, '')
+
+
+def _position(value):
+    try:
+        return int(value)
+    except ValueError:
+        return 0
+
+
+def _writeRun(path, block):
+    fh = open(path, 'w')
+    for ordinal, line in block:
+        fh.write(str(ordinal) + '\t' + line + '\n')
+    fh.close()
+
+
+def _readRun(path):
+    fh = open(path)
+    for line in fh:
+        ordinal, line = line.rstrip('\n').split('\t', 1)
+        yield (int(ordinal), line)
+    fh.close()
+
+
+def _mergeRuns(paths, key, out):
+    _writeRun(out, heapq.merge(*[_readRun(path) for path in paths], key=key))
+    shards.removeShards(paths)
+
+
+"""Yields items, (ordinal, line) pairs, in key order
+   At most run_lines items are held in memory; beyond that sorted runs
+   are spilled to prefix.runN files and merged, MERGE_FANIN at a time
+"""
+def externalSort(items, key, prefix, run_lines=RUN_LINES):
+    runs = []
+    try:
+        for block in ann.chunks(items, run_lines):
+            block.sort(key=key)
+            if (not runs and len(block) < run_lines):
+                # Everything fitted in memory
+                for item in block:
+                    yield item
+                return
+            runs.append(prefix + '.run' + str(len(runs)))
+            _writeRun(runs[-1], block)
+
+        merged = len(runs)
+        while len(runs) > MERGE_FANIN:
+            out = prefix + '.run' + str(merged)
+            merged += 1
+            _mergeRuns(runs[:MERGE_FANIN], key, out)
+            runs = runs[MERGE_FANIN:] + [out]
+
+        for item in heapq.merge(*[_readRun(path) for path in runs], key=key):
+            yield item
+    finally:
+        shards.removeShards(runs)
+
+
+"""Writes the records of infile to sortedfile, sorted by (chrom, pos)
+   and otherwise kept in file order, after all header lines
+   permfile receives the permutation: the original line number of every
+   line of sortedfile, as 64-bit ints
+"""
+def sortFile(infile, sortedfile, permfile, format='vcf', sep='\t',
+    run_lines=RUN_LINES):
+    inds = ann.getFormatSpecificIndices(format=format)
+    headers = []
+
+    def records(fh):
+        for ordinal, line in enumerate(fh):
+            line = line.strip()
+            if shards.isHeader(line):
+                headers.append((ordinal, line))
+            else:
+                yield (ordinal, line)
+
+    def key(item):
+        fields = item[1].split(sep, inds[1] + 1)
+        pos = fields[inds[1]] if (len(fields) > inds[1]) else ''
+        return (chromKey(fields[inds[0]]), _position(pos), item[0])
+
+    fh = open(infile)
+    data = externalSort(records(fh), key, sortedfile, run_lines=run_lines)
+    # Sorting has consumed the whole input by the time the first record
+    # comes out, so every header is known by then
+    first = next(data, None)
+    fh.close()
+
+    fh_out = open(sortedfile, 'w')
+    fh_perm = open(permfile, 'wb')
+    perm = array('q')
+    for ordinal, line in headers:
+        fh_out.write(line + '\n')
+        perm.append(ordinal)
+    if first is not None:
+        for ordinal, line in chain([first], data):
+            fh_out.write(line + '\n')
+            perm.append(ordinal)
+            if len(perm) >= run_lines:
+                perm.tofile(fh_perm)
+                perm = array('q')
+    perm.tofile(fh_perm)
+    fh_perm.close()
+    fh_out.close()
+
+
+def _permutation(permfile, run_lines=RUN_LINES):
+    fh = open(permfile, 'rb')
+    while True:
+        perm = array('q')
+        try:
+            perm.fromfile(fh, run_lines)
+        except EOFError:
+            pass
+        if not perm:
+            break
+        for ordinal in perm:
+            yield ordinal
+    fh.close()
+
+
+"""Writes the lines of sortedfile (the annotated output of a file sorted
+   by sortFile) to outfile in the original line order
+"""
+def restoreOrder(sortedfile, permfile, outfile, run_lines=RUN_LINES):
+    fh = open(sortedfile)
+    lines = zip(_permutation(permfile, run_lines=run_lines),
+        (line.rstrip('\n') for line in fh))
+    fh_out = open(outfile, 'w')
+    for ordinal, line in externalSort(lines, lambda item: item[0], outfile,
+        run_lines=run_lines):
+        fh_out.write(line + '\n')
+    fh_out.close()
+    fh.close()
+
+### EOF
@@ -0,0 +1,221 @@
+# statements.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Catalog of the SQL sent by the reference lookups: every statement is
+# parameterized, its text is built once per process, and the overlap
+# stages select only the columns they read
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import sys
+
+import bins as bn
+
+"""Columns the overlap stages read from their tables, in the order the
+   stages index them. Stages on tables whose columns they only know by
+   position (gadAll, hugo, dbSNP, refGene transcripts and the bigRefGene
+   tables) select whole rows
+"""
+STAGE_COLUMNS = {
+    'cytoBand': 'name',
+    'refGene': 'name2, name',
+    'gwasCatalog': 'pubMedID, trait',
+    'genomicSuperDups': 'otherChrom, otherStart, otherEnd',
+    'targetScanS': 'name, chrom, chromStart, chromEnd',
+    'tfbsConsSites': 'chrom, chromStart, chromEnd, name',
+    'cpgIslandExt': 'name',
+}
+
+# Column selected by stages that only ask whether anything overlaps (CNV)
+PRESENCE_COLUMNS = 'chromStart'
+
+# Statement texts, by (name, placeholder)
+catalog = {}
+
+# Expressions ordering the rows of a table as a scan returns them, by
+# (placeholder, table)
+tableOrders = {}
+
+
+def stageColumns(table):
+    return STAGE_COLUMNS.get(table, '*')
+
+
+"""Placeholder of the driver behind cursor ('%s' for pymysql, '?' for
+   sqlite3)
+"""
+def placeholder(cursor):
+    driver = sys.modules.get(type(cursor).__module__.split('.')[0])
+    return '?' if (getattr(driver, 'paramstyle', None) == 'qmark') else '%s'
+
+
+"""Text of statement name for the driver behind cursor; build() returns
+   it with '?' for every parameter and is only called the first time
+   Every lookup after that sends the same text with new parameters
+"""
+def prepare(cursor, name, build):
+    mark = placeholder(cursor)
+    sql = catalog.get((name, mark))
+    if sql is None:
+        sql = catalog[(name, mark)] = build().replace('?', mark)
+    return sql
+
+
+"""Expression giving the rows of table t in table order, as the sql lookup
+   scans them without bins: the rowid in SQLite, a single-column primary
+   key in MySQL, else 0 (the server's order)
+"""
+def tableOrder(cursor, table):
+    key = (placeholder(cursor), table)
+    if key not in tableOrders:
+        order = '0'
+        if key[0] == '?':
+            order = 't.rowid'
+        else:
+            cursor.execute('show keys from ' + table + \
+                ' where Key_name = "PRIMARY";')
+            keys = cursor.fetchall()
+            if len(keys) == 1:
+                order = 't.' + keys[0][4]
+        tableOrders[key] = order
+    return tableOrders[key]
+
+
+"""Number of parameters an 'in' list of n values is sent with: n rounded
+   up to a power of two, so batches of any size share a few statements
+"""
+def listSize(n):
+    size = 1
+    while size < n:
+        size = size * 2
+    return size
+
+
+"""values padded (with the last one) to listSize(len(values))
+"""
+def listParams(values):
+    values = list(values)
+    return values + values[-1:] * (listSize(len(values)) - len(values))
+
+
+def _columns(columns):
+    if columns == '*':
+        return 't.*'
+    return ', '.join(['t.' + c.strip() for c in columns.split(',')])
+
+
+def _bins():
+    return '(' + ' OR '.join(['t.bin between ? and ?'] * \
+        len(bn.BIN_OFFSETS)) + ') AND '
+
+
+"""Order by clause of a lookup of table, if binned: an index led by bin
+   hands out the rows in bin order, where other lookups scan them in table
+   order
+"""
+def _order(cursor, table, binned):
+    if not binned:
+        return ''
+    return ' order by ' + tableOrder(cursor, table)
+
+
+"""Parameters of the bin condition of a lookup of [lo, hi], or None if
+   it can't be restricted by bin
+"""
+def binParams(lo, hi):
+    ranges = bn.binRanges(lo, hi)
+    if ranges is None:
+        return None
+    return [b for r in ranges for b in r]
+
+
+"""Rows of a range table on one chromosome: columns, then start and end
+   if bounds is set
+   Parameters: chrom (unless chrom_col is None, for a table split by
+   chromosome); with window set, the bins (if binned) and then hi and lo
+   of the [lo, hi] window the rows must overlap
+"""
+def rangeRows(cursor, table, chrom_col, start_col, end_col, columns='*',
+    bounds=False, window=True, binned=False):
+
+    def build():
+        sql = 'select ' + _columns(columns)
+        if bounds:
+            sql = sql + ', t.' + start_col + ', t.' + end_col
+        conditions = []
+        if chrom_col is not None:
+            conditions.append('t.' + chrom_col + ' = ?')
+        if window:
+            conditions.append((_bins() if binned else '') + 't.' + \
+                start_col + ' <= ? AND ? <= t.' + end_col)
+        sql = sql + ' from ' + table + ' t'
+        if conditions:
+            sql = sql + ' where ' + ' AND '.join(conditions)
+        return sql + _order(cursor, table, window and binned) + ';'
+
+    return prepare(cursor, ('range', table, chrom_col, start_col, end_col,
+        columns, bounds, window, binned), build)
+
+
+"""dbSNP rows of one variant class on one chromosome, then POS and REF
+   Parameters: chrom, class and, for n > 0, n positions; with alleles
+   set (one position), the REF and its complement
+"""
+def dbSnpRows(cursor, n=0, alleles=False):
+
+    def build():
+        sql = 'select t.*, t.POS, t.REF from dbSNP t where t.CHR = ? ' + \
+            'AND t.INFO = ?'
+        if alleles:
+            sql = sql + ' AND t.POS = ? AND (t.REF = ? OR t.REF = ?)'
+        elif n > 0:
+            sql = sql + ' AND t.POS in (' + ','.join(['?'] * n) + ')'
+        return sql + ';'
+
+    return prepare(cursor, ('dbSNP', n, alleles), build)
+
+
+"""Rows of a transcript table on one chromosome
+   Parameters: chrom; with window set, the bins (if binned), then offset,
+   hi, lo and offset for the rows within offset of the [lo, hi] window
+"""
+def transcriptRows(cursor, table, window=True, binned=False):
+
+    def build():
+        sql = 'select t.* from ' + table + ' t where t.chrom = ?'
+        if window:
+            sql = sql + ' AND ' + (_bins() if binned else '') + \
+                '(t.txStart - ?) <= ? AND ? <= (t.txEnd + ?)'
+        return sql + _order(cursor, table, window and binned) + ';'
+
+    return prepare(cursor, ('transcripts', table, window, binned), build)
+
+
+"""Rows of a bigRefGene table on one chromosome
+   Parameters: chrom, then n positions if n > 0, the (REF, ALT) pair and
+   its complement if alleles is set, and with window set the bins (if
+   binned) and hi and lo of the window
+"""
+def refSeqRows(cursor, table, n=0, alleles=False, window=False,
+    binned=False):
+
+    def build():
+        sql = 'select t.* from ' + table + ' t where t.CHR = ?'
+        if n > 0:
+            sql = sql + ' AND t.start in (' + ','.join(['?'] * n) + ')'
+        if alleles:
+            sql = sql + ' AND ((t.haplotypeReference = ? AND ' + \
+                't.haplotypeAlternate = ?) OR (t.haplotypeReference = ? ' + \
+                'AND t.haplotypeAlternate = ?))'
+        if window:
+            sql = sql + ' AND ' + (_bins() if binned else '') + \
+                't.start <= ? AND ? <= t.end'
+        return sql + _order(cursor, table, window and binned) + ';'
+
+    return prepare(cursor, ('bigRefGene', table, n, alleles, window, binned),
+        build)
+
+### EOF
@@ -0,0 +1,80 @@
+# transcripts.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Precompiled refGene transcript models used to place a variant in a
+# gene structure
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+from bisect import bisect_right
+
+import fragments
+
+
+def _coords(blob, count):
+    if isinstance(blob, (bytes, bytearray, memoryview)):
+        blob = bytes(blob).decode('utf-8')
+    return [int(c) for c in str(blob).split(',')[:count]]
+
+
+"""A refGene row compiled once: transcript, CDS and exon bounds as ints,
+   the strand-aware label of every exon ('ex3/7') and the interned gene
+   names the stages annotate it with
+   Exons are searched with a bisect over their starts and a running
+   maximum of their ends, so exonsAt() finds the same exons, in the same
+   order, as a linear scan with u.isBetween would.
+"""
+class Transcript(object):
+    def __init__(self, row):
+        self.row = row
+        self.strand = str(row[3])
+        self.txStart = int(row[4])
+        self.txEnd = int(row[5])
+        self.cdsStart = int(row[6])
+        self.cdsEnd = int(row[7])
+        self.exonCount = int(row[8])
+        self.exonStarts = _coords(row[9], self.exonCount)
+        self.exonEnds = _coords(row[10], self.exonCount)
+
+        self.labels = []
+        for e in range(self.exonCount):
+            exnum = (self.exonCount - e) if (self.strand == '-') else (e + 1)
+            self.labels.append('ex' + str(exnum) + '/' + str(self.exonCount))
+        self.names = fragments.geneNames(row)
+
+        # Exon starts are sorted in refGene; fall back to a scan otherwise
+        self.sorted = (self.exonStarts == sorted(self.exonStarts))
+        self.maxEnds = []
+        maxEnd = None
+        for end in self.exonEnds:
+            maxEnd = end if (maxEnd is None or end > maxEnd) else maxEnd
+            self.maxEnds.append(maxEnd)
+
+    """Gene annotation of a variant in region of the transcript, as
+       fragments.collapseGeneNames renders it
+    """
+    def geneAnnotation(self, region):
+        return (self.names + ';' + region) if self.names else region
+
+    """Indices of the exons with start <= pos <= end, in exon order
+    """
+    def exonsAt(self, pos):
+        starts = self.exonStarts
+        ends = self.exonEnds
+        if not self.sorted:
+            return [e for e in range(len(starts))
+                if (starts[e] <= pos and pos <= ends[e])]
+
+        hits = []
+        e = bisect_right(starts, pos) - 1
+        while (e >= 0 and self.maxEnds[e] >= pos):
+            if pos <= ends[e]:
+                hits.append(e)
+            e = e - 1
+        hits.reverse()
+        return hits
+
+### EOF
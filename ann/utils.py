@@ -13,25 +13,67 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import json
+import time
+import threading
 import pymysql
 import boto3
 from botocore.exceptions import ClientError
 
-"""Get connection to reference database
+# Seconds the RDS secret is reused before it is fetched again
+DB_SECRET_TTL = int(os.environ.get('ANN_DB_SECRET_TTL', 900))
+# Most connections a process keeps open to the reference database; a job
+# with ConcurrentStages on uses one per overlap stage plus one
+DB_POOL_SIZE = int(os.environ.get('ANN_DB_POOL_SIZE', 16))
+# Idle connections are pinged before reuse once they've been idle this long
+DB_POOL_CHECK_AFTER = int(os.environ.get('ANN_DB_POOL_CHECK_AFTER', 30))
+# Seconds to wait for a free connection when the pool is exhausted
+DB_POOL_TIMEOUT = int(os.environ.get('ANN_DB_POOL_TIMEOUT', 60))
+
+# MySQL error raised when the credentials are rejected
+ER_ACCESS_DENIED = 1045
+
+
+"""Get the RDS secret from AWS Secrets Manager
+   The secret is cached for DB_SECRET_TTL seconds; refresh forces a fetch
+   (e.g. after the password has been rotated)
 """
-def db_connect():
-    AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
-        ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
+_secret = {'value': None, 'expires': 0}
+_secret_lock = threading.Lock()
 
-    # Get RDS secret from AWS Secrets Manager
-    asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
+def get_db_secret(refresh=False):
+    with _secret_lock:
+        if (refresh or _secret['value'] is None or
+            time.time() >= _secret['expires']):
+            AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
+                ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
+
+            asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
+            try:
+                asm_response = asm.get_secret_value(
+                    SecretId='rds/anntools_database')
+                _secret['value'] = json.loads(asm_response['SecretString'])
+            except ClientError as e:
+                print("Unable to retrieve RDS credentials from AWS " + \
+                    f"Secrets Manager: {e}")
+                raise e
+            _secret['expires'] = time.time() + DB_SECRET_TTL
+        return _secret['value']
+
+
+"""Open a new connection to the reference database
+"""
+def _open_connection():
+    rds_secret = get_db_secret()
     try:
-        asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
-        rds_secret = json.loads(asm_response['SecretString'])
-    except ClientError as e:
-        print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
-        raise e
+        return _connect(rds_secret)
+    except pymysql.err.OperationalError as e:
+        if e.args[0] != ER_ACCESS_DENIED:
+            raise e
+        # Cached credentials may have been rotated; retry once with fresh ones
+        return _connect(get_db_secret(refresh=True))
 
+
+def _connect(rds_secret):
     # Extract database connection parameters
     rds_host = rds_secret['host']
     mysql_port = rds_secret['port']
@@ -48,6 +90,124 @@ def db_connect():
         db=database_name)
 
 
+"""Connection checked out of a ConnectionPool
+   Behaves like the underlying connection, except that close() hands it
+   back to the pool instead of closing it
+"""
+class PooledConnection(object):
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def cursor(self, *args):
+        return self._conn.cursor(*args)
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.release(conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+"""Bounded pool of reference database connections
+   At most size connections are open at once; acquire() waits up to
+   timeout seconds for one to be returned. Connections that have sat idle
+   for longer than check_after seconds are pinged before being reused and
+   replaced if they have gone away.
+"""
+class ConnectionPool(object):
+    def __init__(self, size=DB_POOL_SIZE, check_after=DB_POOL_CHECK_AFTER,
+        timeout=DB_POOL_TIMEOUT):
+        self.size = size
+        self.check_after = check_after
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        # (connection, time it was returned), most recently used last
+        self.idle = []
+
+    def _healthy(self, conn):
+        try:
+            if hasattr(conn, 'ping'):
+                conn.ping(reconnect=False)
+            else:
+                conn.cursor().execute('select 1')
+            return True
+        except Exception:
+            return False
+
+    def acquire(self):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise RuntimeError("Timed out waiting for a reference " + \
+                f"database connection (pool size {self.size})")
+        try:
+            while True:
+                with self.lock:
+                    if not self.idle:
+                        break
+                    conn, returned = self.idle.pop()
+                if ((time.time() - returned) < self.check_after or
+                    self._healthy(conn)):
+                    return PooledConnection(self, conn)
+                self._discard(conn)
+            return PooledConnection(self, _open_connection())
+        except Exception as e:
+            self.slots.release()
+            raise e
+
+    def release(self, conn):
+        try:
+            # End the read transaction so the next user sees fresh data
+            conn.rollback()
+            with self.lock:
+                self.idle.append((conn, time.time()))
+        except Exception:
+            self._discard(conn)
+        self.slots.release()
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn, returned in idle:
+            self._discard(conn)
+
+
+"""Process-wide connection pool
+   Connections are never shared across a fork: a child process gets a
+   pool of its own the first time it asks
+"""
+_pool = {'pid': None, 'pool': None}
+_pool_lock = threading.Lock()
+
+def db_pool():
+    with _pool_lock:
+        if _pool['pid'] != os.getpid():
+            _pool['pool'] = ConnectionPool()
+            _pool['pid'] = os.getpid()
+        return _pool['pool']
+
+
+"""Get connection to reference database
+   The connection comes from the process-wide pool; close() returns it
+"""
+def db_connect():
+    return db_pool().acquire()
+
+
 """Column inices for pileup and VCF
 """
 def getFormatSpecificIndices(format='vcf'):